@@ -42,6 +42,9 @@ import src.online as online
 import src.net as net
 import src.core as core
 import src.ui as ui
+import src.components as components
+import src.profiler as profiler
+import random
 
 def showHelpInfo():
 	# Print help information
@@ -52,6 +55,7 @@ def showHelpInfo():
 	print "-p portnumber\t\tUse the specified port (for both client and server)"
 	print "-d map\t\t\tRun in dedicated server mode on the specified map"
 	print "-v\t\t\t(Daemon only) Run the game in survival mode"
+	print "-b bots [ticks]\t\t(Daemon only) Benchmark the map with the given number of AI droids, then exit"
 	print "-h\t\t\tShow help information"
 	print "-m\t\t\tDeveloper mode"
 	engine.exit()
@@ -70,6 +74,10 @@ SURVIVAL = 1
 mode = MODE_NORMAL
 gametype = DEATHMATCH
 
+BENCHMARK_SEED = 1337
+benchmarkBots = 0 # Zero means we're not running a benchmark
+benchmarkTicks = 2000
+
 customWindowSize = False
 i = 1
 while i < len(sys.argv):
@@ -138,6 +146,15 @@ while i < len(sys.argv):
 		engine.enablePause = True
 	elif sys.argv[i] == "-v":
 		pass # Already been processed.
+	elif sys.argv[i] == "-b":
+		try:
+			benchmarkBots = int(sys.argv[i + 1])
+			i += 1
+			if len(sys.argv) > i + 1 and sys.argv[i + 1][0] != "-":
+				benchmarkTicks = int(sys.argv[i + 1])
+				i += 1
+		except:
+			showHelpInfo()
 	else:
 		showHelpInfo()
 	i += 1
@@ -154,17 +171,54 @@ def goDaemon():
 	from direct.distributed.PyDatagram import PyDatagram
 	net.init(defaultPort, PyDatagram)
 
+	benchmarking = benchmarkBots > 0
+	if benchmarking:
+		# Simulated time and a fixed seed, so every run plays out the same way (as far as the path finding thread allows)
+		random.seed(BENCHMARK_SEED)
+		engine.clock.setFixedTimeStep(net.SERVER_TICK)
+
 	if gametype == DEATHMATCH:
-		gameBackend = core.PointControlBackend(True, username)
+		gameBackend = core.PointControlBackend(not benchmarking, username)
 	elif gametype == SURVIVAL:
-		gameBackend = core.SurvivalBackend(True, username)
+		gameBackend = core.SurvivalBackend(not benchmarking, username)
 	gameBackend.loadMap(defaultMap)
 
+	benchmarkTeams = []
+	tickTimes = []
+	if benchmarking:
+		benchmarkTeams = gameBackend.entityGroup.teams[:]
+		if gametype == SURVIVAL:
+			benchmarkTeams.append(gameBackend.zombieTeam)
+		weapons = [components.CHAINGUN, components.SHOTGUN, components.SNIPER, components.PISTOL, components.GRENADE_LAUNCHER, components.MOLOTOV_THROWER]
+		for i in range(benchmarkBots):
+			benchmarkTeams[i % len(benchmarkTeams)].purchaseUnit(weapons[i % len(weapons)], None)
+		engine.log.info("Benchmarking " + defaultMap + " with " + str(benchmarkBots) + " bots for " + str(benchmarkTicks) + " ticks.")
+
+	def reportBenchmark():
+		times = sorted(tickTimes)
+		def percentile(p):
+			return times[min(len(times) - 1, int(len(times) * p))] * 1000.0
+		overBudget = len([x for x in times if x > net.SERVER_TICK])
+		engine.log.info("Benchmark results (%s, %d bots, %d ticks): mean %.2f ms, p50 %.2f ms, p95 %.2f ms, p99 %.2f ms, max %.2f ms, %d ticks over the %.0f ms budget." \
+			% (defaultMap, benchmarkBots, len(times), sum(times) * 1000.0 / len(times), percentile(0.5), percentile(0.95), percentile(0.99), times[-1] * 1000.0, overBudget, net.SERVER_TICK * 1000.0))
+		engine.log.info("Frame times: " + profiler.report())
+		if gameBackend.aiWorld.navMesh != None:
+			engine.log.info("Path cache: " + gameBackend.aiWorld.navMesh.pathCache.report())
+
 	def gameLoop(task):
+		start = profiler.timer()
 		engine.update()
 		if gameBackend != None:
 			gameBackend.update()
 		engine.endUpdate()
+		if benchmarking:
+			# Keep every purchased unit alive
+			for team in benchmarkTeams:
+				team.respawnUnits()
+			tickTimes.append(profiler.timer() - start) # Same clock as the per-stage profiler
+			if len(tickTimes) >= benchmarkTicks:
+				reportBenchmark()
+				engine.exit()
 		return task.cont
 
 	taskMgr.add(gameLoop, "Game loop")
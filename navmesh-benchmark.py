@@ -0,0 +1,180 @@
+from pandac.PandaModules import loadPrcFileData
+loadPrcFileData("", "window-type none")
+loadPrcFileData("", "notify-level fatal")
+from direct.showbase.ShowBase import ShowBase
+ShowBase()
+
+from pandac.PandaModules import *
+from random import Random
+import glob
+import os
+import sys
+import time
+
+import src.ai as ai
+
+# Runs a fixed set of path searches over each navigation mesh and compares
+# the current NavMesh.findPathFromNodes against the original sorted-list A*.
+# The same searches are then run again, to time them when they're served from the path cache.
+# Then looks up the node under a fixed set of points and compares NavMesh.getNode against a scan over every node.
+# Finally, builds the optional hierarchical layer for each mesh and times its searches against the flat A*.
+# Usage: navmesh-benchmark.py [-n pairs] [-s seed] [mapname ...]
+
+def referenceFindPath(navMesh, startNode, endNode, startPos, endPos, radius = 1):
+	"The original A* implementation, which keeps its scratch data on the Edges and re-sorts the open list every iteration."
+	for edge in navMesh.edges:
+		edge.closed = False
+		edge.cameFrom = None
+		edge.gScore = 0
+		edge.hScore = 0
+		edge.fScore = 0
+		edge.open = False
+	path = ai.Path(startPos, endPos, startNode, endNode, radius)
+	openEdges = startNode.edges[:]
+	for edge in startNode.edges:
+		edge.gScore = 0
+		edge.hScore = edge.cost(endNode.center)
+		edge.fScore = edge.hScore
+		edge.open = True
+	def compare(x, y):
+		return (x.fScore > y.fScore) - (x.fScore < y.fScore)
+	iterations = 0
+	while len(openEdges) > 0:
+		openEdges.sort(compare)
+		currentEdge = openEdges.pop(0)
+		if endNode in currentEdge.nodes:
+			c = currentEdge
+			path.add(currentEdge)
+			while c.cameFrom != None:
+				c = c.cameFrom
+				path.add(c)
+			path.clean()
+			return path
+		currentEdge.closed = True
+		for neighbor in currentEdge.neighbors:
+			if neighbor.navigable and not neighbor.closed:
+				tentativeGScore = currentEdge.gScore + currentEdge.costToEdge(neighbor)
+				tentativeIsBetter = False
+				if not neighbor.open:
+					neighbor.open = True
+					openEdges.append(neighbor)
+					neighbor.hScore = neighbor.cost(endNode.center)
+					tentativeIsBetter = True
+				elif tentativeGScore < neighbor.gScore:
+					tentativeIsBetter = True
+				if tentativeIsBetter:
+					neighbor.cameFrom = currentEdge
+					neighbor.gScore = tentativeGScore
+					neighbor.fScore = neighbor.gScore + neighbor.hScore
+		iterations += 1
+		if iterations > 9:
+			time.sleep(0.0)
+			iterations = 0
+	return None
+
+def referenceGetNode(navMesh, pos, radius = 1):
+	"The original getNode without a last known node, which tests every node in the mesh."
+	nodes = [x for x in navMesh.nodes if x.containerTest(pos, radius)]
+	if len(nodes) == 0:
+		return None
+	highest = -100
+	highestNode = None
+	for node in nodes:
+		if node.highest > highest and node.lowest < pos.getZ():
+			highest = node.highest
+			highestNode = node
+	return highestNode if len(nodes) > 1 else nodes[0]
+
+def runLookups(points, getNode):
+	"Returns the total time taken and the list of nodes found."
+	results = []
+	start = time.clock()
+	for pos in points:
+		results.append(getNode(pos))
+	return time.clock() - start, results
+
+def runSearches(pairs, search):
+	"Returns the total time taken and the list of edge lists found."
+	results = []
+	start = time.clock()
+	for startNode, endNode in pairs:
+		results.append(search(startNode, endNode))
+	return time.clock() - start, results
+
+def pathLength(path):
+	if path == None:
+		return None
+	total = (path.waypoints[0] - path.start).length()
+	for i in range(1, len(path.waypoints)):
+		total += (path.waypoints[i] - path.waypoints[i - 1]).length()
+	return total
+
+def run(navMesh, pairs, search):
+	"Returns the total time taken and the list of path lengths."
+	lengths = []
+	start = time.clock()
+	for startNode, endNode in pairs:
+		lengths.append(pathLength(search(startNode, endNode, startNode.center, endNode.center)))
+	return time.clock() - start, lengths
+
+numPairs = 100
+seed = 0
+maps = []
+i = 1
+while i < len(sys.argv):
+	if sys.argv[i] == "-n":
+		numPairs = int(sys.argv[i + 1])
+		i += 1
+	elif sys.argv[i] == "-s":
+		seed = int(sys.argv[i + 1])
+		i += 1
+	else:
+		maps.append(sys.argv[i])
+	i += 1
+
+if len(maps) == 0:
+	maps = sorted([os.path.basename(x)[:-len("-nav.egg")] for x in glob.glob("maps/*-nav.egg")])
+
+print "%-16s %6s %6s %10s %10s %10s %8s %8s  %s" % ("map", "nodes", "edges", "old ms", "new ms", "cached ms", "speedup", "diffs", "path cache")
+for map in maps:
+	navMesh = ai.NavMesh("maps", map + "-nav.egg")
+	random = Random(seed)
+	pairs = [(random.choice(navMesh.nodes), random.choice(navMesh.nodes)) for x in range(numPairs)]
+	oldTime, oldLengths = run(navMesh, pairs, lambda *args: referenceFindPath(navMesh, *args))
+	navMesh.hierarchy = None # Hierarchical searches only refine part of the route, so their paths can't be compared here
+	navMesh.pathCache = ai.PathCache(len(pairs))
+	newTime, newLengths = run(navMesh, pairs, navMesh.findPathFromNodes)
+	cachedTime, cachedLengths = run(navMesh, pairs, navMesh.findPathFromNodes)
+	# Searches with equal f-scores may break ties differently, so only count paths that disagree on reachability or cost.
+	diffs = len([x for x in zip(oldLengths, newLengths) if (x[0] == None) != (x[1] == None) or (x[0] != None and abs(x[0] - x[1]) > 0.01)])
+	diffs += len([x for x in zip(newLengths, cachedLengths) if x[0] != x[1]])
+	print "%-16s %6d %6d %10.3f %10.3f %10.3f %7.1fx %8d  %s" % (map, len(navMesh.nodes), len(navMesh.edges), oldTime * 1000.0 / numPairs, newTime * 1000.0 / numPairs, cachedTime * 1000.0 / numPairs, oldTime / max(newTime, 0.000001), diffs, navMesh.pathCache.report())
+
+print
+print "%-16s %6s %10s %10s %8s %8s" % ("map", "nodes", "old us", "new us", "speedup", "diffs")
+for map in maps:
+	navMesh = ai.NavMesh("maps", map + "-nav.egg")
+	random = Random(seed)
+	points = []
+	for i in range(numPairs * 10):
+		center = random.choice(navMesh.nodes).center
+		points.append(center + Vec3(random.uniform(-4, 4), random.uniform(-4, 4), random.uniform(0, 1)))
+	oldTime, oldNodes = runLookups(points, lambda pos: referenceGetNode(navMesh, pos))
+	newTime, newNodes = runLookups(points, navMesh.getNode)
+	diffs = len([x for x in zip(oldNodes, newNodes) if x[0] != x[1]])
+	print "%-16s %6d %10.3f %10.3f %7.1fx %8d" % (map, len(navMesh.nodes), oldTime * 1000000.0 / len(points), newTime * 1000000.0 / len(points), oldTime / max(newTime, 0.000001), diffs)
+
+print
+print "%-16s %6s %8s %8s %10s %10s %10s %8s %8s" % ("map", "nodes", "clusters", "portals", "build ms", "flat ms", "hpa ms", "speedup", "diffs")
+for map in maps:
+	navMesh = ai.NavMesh("maps", map + "-nav.egg")
+	random = Random(seed)
+	pairs = [(random.choice(navMesh.nodes), random.choice(navMesh.nodes)) for x in range(numPairs)]
+	start = time.clock()
+	hierarchy = ai.NavHierarchy(navMesh)
+	buildTime = time.clock() - start
+	flatTime, flatEdges = runSearches(pairs, navMesh.searchEdges)
+	hpaTime, hpaEdges = runSearches(pairs, hierarchy.searchEdges)
+	# Hierarchical routes stop partway, so only count searches that disagree on reachability.
+	diffs = len([x for x in zip(flatEdges, hpaEdges) if (x[0] == None) != (x[1] == None)])
+	print "%-16s %6d %8d %8d %10.1f %10.3f %10.3f %7.1fx %8d" % (map, len(navMesh.nodes), len(hierarchy.clusters), len(hierarchy.portalLinks), buildTime * 1000.0, flatTime * 1000.0 / numPairs, hpaTime * 1000.0 / numPairs, flatTime / max(hpaTime, 0.000001), diffs)
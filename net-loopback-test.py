@@ -0,0 +1,69 @@
+import os
+import sys
+import threading
+import time
+
+import src.net as net
+
+# Round-trips a large payload between two contexts over the loopback interface,
+# to check that compression, fragmentation and reassembly survive the trip.
+# Half the payload is random and half is zeros, so it's compressed and still needs fragmenting.
+# Usage: net-loopback-test.py [payload size in bytes]
+
+PAYLOAD_SIZE = 64 * 1024
+SENDER_PORT = 41337
+RECEIVER_PORT = 41338
+
+if len(sys.argv) > 1:
+	PAYLOAD_SIZE = int(sys.argv[1])
+
+net.datagramType = net.CustomDatagram
+sender = net.PythonNetContext(SENDER_PORT)
+receiver = net.PythonNetContext(RECEIVER_PORT)
+
+payload = os.urandom(PAYLOAD_SIZE / 2) + "\x00" * (PAYLOAD_SIZE - PAYLOAD_SIZE / 2)
+p = net.Packet()
+p.add(net.Uint8(net.PACKET_EMPTY))
+p.add(net.Uint32(len(payload)))
+data = net.CustomDatagram()
+p.addTo(data)
+data.appendData(payload)
+sender.sendDatagram(data, ("127.0.0.1", RECEIVER_PORT))
+sentPackets, sentBytes, droppedPackets = sender.writeTick()
+
+received = []
+start = time.time()
+while len(received) == 0 and time.time() - start < 5.0:
+	received = receiver.readTick()
+	time.sleep(0.01)
+
+stats = sender.writeTick() # The write thread may not have sent anything yet when we first asked
+sentPackets += stats[0]
+sentBytes += stats[1]
+droppedPackets += stats[2]
+
+success = False
+if len(received) == 0:
+	print "FAIL: nothing received"
+else:
+	iterator = net.CustomDatagram(received[0][0])
+	net.Uint8.getFrom(iterator)
+	size = net.Uint32.getFrom(iterator)
+	if size == PAYLOAD_SIZE and iterator.extractBytes(size) == payload and iterator.getRemainingSize() == 0:
+		success = True
+		print "PASS: %d byte payload round-tripped in %.1f ms, %d bytes in %d datagrams on the wire, %d dropped" % (PAYLOAD_SIZE, (time.time() - start) * 1000.0, sentBytes, sentPackets, droppedPackets)
+	else:
+		print "FAIL: payload corrupted"
+
+sender.delete()
+receiver.delete()
+
+# Both contexts' read and write threads should exit once they're deleted
+start = time.time()
+while threading.activeCount() > 1 and time.time() - start < 2.0:
+	time.sleep(0.01)
+if threading.activeCount() > 1:
+	print "FAIL: %d worker threads still running after delete" % (threading.activeCount() - 1)
+	success = False
+
+sys.exit(0 if success else 1)
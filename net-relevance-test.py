@@ -0,0 +1,108 @@
+from pandac.PandaModules import loadPrcFileData
+loadPrcFileData("", "window-type none")
+loadPrcFileData("", "notify-level fatal")
+from direct.showbase.ShowBase import ShowBase
+ShowBase()
+
+from pandac.PandaModules import Vec3
+import sys
+
+import src.engine as engine
+import src.entities as entities
+import src.net as net
+import src.net2 as net2
+
+# Moves an entity around far outside a client's area of interest, so most of its updates are culled,
+# then brings it to rest and checks that the client gets one full update with the entity's final position.
+# Usage: net-relevance-test.py
+
+CLIENT_ADDRESS = ("127.0.0.1", 41339)
+ENTITY_ID = 5
+MOVING_TICKS = 40 # Ends between two far updates, so the client misses where the entity stops
+RESTING_TICKS = 20
+
+class TestController:
+	"Stands in for an ObjectController. Sends an update while the entity moves, or when a full update is requested."
+	def __init__(self):
+		self.criticalUpdate = False
+		self.fullUpdateRequested = False
+	def requestFullUpdate(self):
+		self.fullUpdateRequested = True
+
+class TestEntity(entities.ObjectEntity):
+	def __init__(self):
+		# No body or model needed, so ObjectEntity's initialization is skipped
+		self.controller = TestController()
+		self.active = True
+		self.radius = 1
+		self.position = Vec3(500, 0, 0)
+	def getId(self):
+		return ENTITY_ID
+	def getPosition(self):
+		return Vec3(self.position)
+
+class TestPlayer:
+	active = True
+	def getPosition(self):
+		return Vec3(0, 0, 0)
+
+class TestTeam:
+	def isAlly(self, team):
+		return False
+	def getPlayer(self):
+		return TestPlayer()
+
+class TestBackend:
+	def getClientTeam(self, address):
+		return TestTeam()
+
+class TestClient:
+	ready = True
+	address = CLIENT_ADDRESS
+
+class TestContext:
+	"Records the entity updates in each snapshot instead of sending it."
+	def __init__(self):
+		self.activeConnections = {CLIENT_ADDRESS:TestClient()}
+		self.received = [] # Fields of each update the client got
+	def send(self, packet, address):
+		for item in packet.dataObjects:
+			if isinstance(item, net2.DeltaControllerPacket) and item.id == ENTITY_ID:
+				self.received.append(item.fields)
+
+engine.clock = engine.Clock()
+net.netMode = net.MODE_SERVER
+net.context = TestContext()
+manager = net2.NetManager()
+backend = TestBackend()
+entity = TestEntity()
+
+def tick(moving):
+	updates = []
+	if moving:
+		entity.position += Vec3(1, 0, 0)
+	if moving or entity.controller.fullUpdateRequested:
+		entity.controller.fullUpdateRequested = False
+		updates.append((entity, [str(entity.getPosition())]))
+	manager.broadcastSnapshot(backend, updates, net.Packet(), engine.clock.time)
+
+for i in range(MOVING_TICKS):
+	tick(True)
+movingUpdates = len(net.context.received)
+for i in range(RESTING_TICKS):
+	tick(False)
+restingUpdates = net.context.received[movingUpdates:]
+
+success = False
+if movingUpdates >= MOVING_TICKS / 2:
+	print "FAIL: %d of %d far updates reached the client; they should have been culled" % (movingUpdates, MOVING_TICKS)
+elif len(restingUpdates) != 1:
+	print "FAIL: client got %d updates after the entity came to rest, expected 1" % len(restingUpdates)
+elif restingUpdates[0] != [str(entity.getPosition())]:
+	print "FAIL: client got %s after the entity came to rest at %s" % (restingUpdates[0], entity.getPosition())
+else:
+	print "PASS: %d of %d far updates culled, final position resent once the entity came to rest" % (MOVING_TICKS - movingUpdates, MOVING_TICKS)
+	success = True
+
+manager.delete()
+sys.exit(0 if success else 1)
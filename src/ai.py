@@ -3,6 +3,9 @@ from pandac.PandaModules import *
 from random import randint, random, choice
 import math
 import sys
+import os
+import struct
+import hashlib
 
 import engine
 import entities
@@ -11,42 +14,239 @@ import components
 import controllers
 import threading
 import time
+import heapq
+from collections import OrderedDict
 
 ACCURACY = 0.7 # Relative probability of an AI droid hitting its target.
+NAVMESH_CACHE_DIRECTORY = os.path.join(os.path.expanduser("~"), "a3p-navmesh-cache")
+NAVMESH_CACHE_VERSION = 1 # Increment whenever the compiled format or the way it's generated changes
+NAVMESH_GRID_CELL_SIZE = 8.0 # Size of the grid cells NavMesh.getNode uses to narrow down which nodes to test
+HIERARCHY_MIN_NODES = None # Meshes with at least this many nodes get a hierarchical search layer. None disables it. See navmesh-benchmark.py before turning it on.
+HIERARCHY_CLUSTER_SIZE = 32.0 # Width of the square clusters the hierarchical layer groups nodes into
+HIERARCHY_REFINE_PORTALS = 2 # Number of portals along the coarse route the detailed search runs to
+
+PATH_WORKERS = 2 # Number of path finding threads
+PATH_CACHE_SIZE = 256 # Number of search results each navigation mesh keeps, by start and goal node
+FLOW_FIELD_INTERVAL = 1.0 # Minimum seconds between flow field rebuilds for the same target
 
 currentWorld = None
-pathRequests = []
-pathFindThread = None
+pathQueue = None
+pathFindThreads = []
 
 class PathRequest:
-	def __init__(self, callback, aiNode, targetAiNode, position, targetPosition, radius):
+	def __init__(self, callback, aiNode, targetAiNode, position, targetPosition, radius, owner = None, priority = 0):
 		self.callback = callback
 		self.aiNode = aiNode
 		self.targetAiNode = targetAiNode
 		self.position = position
 		self.targetPosition = targetPosition
 		self.radius = radius
+		self.owner = owner
+		self.priority = priority
+		self.cancelled = False
+	
+	def search(self, navMesh):
+		return navMesh.findPathFromNodes(self.aiNode, self.targetAiNode, self.position, self.targetPosition, self.radius)
+
+class FlowFieldRequest(PathRequest):
+	def __init__(self, callback, targetAiNode, owner = None, priority = 0):
+		PathRequest.__init__(self, callback, None, targetAiNode, None, None, 0, owner, priority)
+	
+	def search(self, navMesh):
+		return FlowField(navMesh, self.targetAiNode)
+
+class PathQueue:
+	"""Thread-safe priority queue of path requests. Requests with lower priority values are served first.
+	Each owner has at most one pending request; a newer request from the same owner replaces the old one, even if a path finding thread is already working on it."""
+	def __init__(self):
+		self.condition = threading.Condition()
+		self.heap = [] # (priority, insertion count, request). Cancelled requests are skipped when popped.
+		self.pending = dict() # Owner -> pending PathRequest
+		self.running = dict() # Owner -> PathRequest a path finding thread is working on
+		self.count = 0
+	
+	def put(self, request):
+		self.condition.acquire()
+		if request.owner != None:
+			if request.owner in self.pending:
+				self.pending[request.owner].cancelled = True
+			if request.owner in self.running:
+				self.running[request.owner].cancelled = True
+			self.pending[request.owner] = request
+		heapq.heappush(self.heap, (request.priority, self.count, request))
+		self.count += 1
+		self.condition.notify()
+		self.condition.release()
+	
+	def get(self):
+		"Blocks until a request is available, then removes it from the queue and returns it."
+		self.condition.acquire()
+		try:
+			while True:
+				while len(self.heap) == 0:
+					self.condition.wait()
+				request = heapq.heappop(self.heap)[2]
+				if request.cancelled:
+					continue
+				if request.owner != None and self.pending.get(request.owner) == request:
+					del self.pending[request.owner]
+					self.running[request.owner] = request
+				return request
+		finally:
+			self.condition.release()
+	
+	def finish(self, request, result):
+		"""Calls the request's callback with the search result, unless the request was cancelled while the search ran.
+		The callback runs under the queue's lock, so once cancel or clear returns, the cancelled callback can't run anymore."""
+		self.condition.acquire()
+		try:
+			if request.owner != None and self.running.get(request.owner) == request:
+				del self.running[request.owner]
+			if not request.cancelled:
+				request.callback(result)
+		finally:
+			self.condition.release()
+	
+	def cancel(self, owner):
+		"Cancels the given owner's pending or running request, if there is one. Its callback won't be called."
+		self.condition.acquire()
+		if owner in self.pending:
+			self.pending[owner].cancelled = True
+			del self.pending[owner]
+		if owner in self.running:
+			self.running[owner].cancelled = True
+			del self.running[owner]
+		self.condition.release()
+	
+	def clear(self):
+		self.condition.acquire()
+		for entry in self.heap:
+			entry[2].cancelled = True
+		for request in self.running.values():
+			request.cancelled = True
+		del self.heap[:]
+		self.pending.clear()
+		self.running.clear()
+		self.condition.release()
 
 def init():
-	global pathFindThread
-	pathFindThread = threading.Thread(target = pathWorker)
-	pathFindThread.setDaemon(True)
-	pathFindThread.start()
+	global pathQueue
+	pathQueue = PathQueue()
+	for i in range(PATH_WORKERS):
+		thread = threading.Thread(target = pathWorker)
+		thread.setDaemon(True)
+		thread.start()
+		pathFindThreads.append(thread)
 
 def pathWorker():
-	global pathRequests, currentWorld
 	while True:
-		if len(pathRequests) > 0:
-			req = pathRequests.pop(0)
-			req.callback(currentWorld.navMesh.findPathFromNodes(req.aiNode, req.targetAiNode, req.position, req.targetPosition, req.radius))
-			del req
-		if len(pathRequests) > 5:
-			del pathRequests[:]
-		time.sleep(0.01)
+		req = pathQueue.get()
+		world = currentWorld
+		if world == None or world.navMesh == None:
+			req.cancelled = True # Nothing to search
+			pathQueue.finish(req, None)
+			continue
+		pathQueue.finish(req, req.search(world.navMesh))
+
+def requestPath(callback, aiNode, targetAiNode, position, targetPosition, radius, owner = None, priority = 0):
+	"""Queues a path request. The callback is called from a path finding thread.
+	Lower priority values are served first. A request replaces any request still pending from the same owner."""
+	pathQueue.put(PathRequest(callback, aiNode, targetAiNode, position, targetPosition, radius, owner, priority))
 
-def requestPath(callback, aiNode, targetAiNode, position, targetPosition, radius):
-	request = PathRequest(callback, aiNode, targetAiNode, position, targetPosition, radius)
-	pathRequests.append(request)
+def cancelPath(owner):
+	pathQueue.cancel(owner)
+
+class FlowField:
+	"""The cost of getting from every edge of the mesh to one target node, and the next edge to take from each (a Dijkstra map).
+	Any number of agents chasing the same target can follow it, instead of each running its own A* search."""
+	def __init__(self, navMesh, targetNode):
+		self.targetNode = targetNode
+		self.costs = dict() # Edge -> cost to the target node
+		self.nextEdges = dict() # Edge -> the next edge on the way to the target node
+		openEdges = [] # Heap of (cost, insertion count, edge)
+		count = 0
+		for edge in targetNode.edges:
+			self.costs[edge] = 0
+			heapq.heappush(openEdges, (0, count, edge))
+			count += 1
+		closed = set()
+		iterations = 0
+		while len(openEdges) > 0:
+			cost, _, currentEdge = heapq.heappop(openEdges)
+			if currentEdge in closed:
+				continue
+			closed.add(currentEdge)
+			for neighbor in currentEdge.neighbors:
+				if neighbor.navigable and not neighbor in closed:
+					tentativeCost = cost + currentEdge.costToEdge(neighbor)
+					if not neighbor in self.costs or tentativeCost < self.costs[neighbor]:
+						self.costs[neighbor] = tentativeCost
+						self.nextEdges[neighbor] = currentEdge
+						heapq.heappush(openEdges, (tentativeCost, count, neighbor))
+						count += 1
+			iterations += 1
+			if iterations > 9:
+				time.sleep(0.0)
+				iterations = 0
+	
+	def getPath(self, startNode, startPos, endPos, radius = 1):
+		"Follows the field downhill from the given node. Returns a Path to the target, or None if the target can't be reached."
+		edges = [x for x in startNode.edges if x in self.costs]
+		if len(edges) == 0:
+			return None
+		edge = min(edges, key = lambda x: self.costs[x])
+		edges = [edge]
+		while edge in self.nextEdges:
+			edge = self.nextEdges[edge]
+			edges.append(edge)
+		path = Path(startPos, endPos, startNode, self.targetNode, radius)
+		for edge in reversed(edges): # Path.add expects the edge nearest the target first
+			path.add(edge)
+		path.clean()
+		return path
+
+class PathCache:
+	"""Thread-safe LRU cache of A* results, keyed by (start node, goal node).
+	Only the edges are cached. Waypoints depend on each request's exact positions and radius, so they're rebuilt every time."""
+	def __init__(self, size = PATH_CACHE_SIZE):
+		self.size = size
+		self.entries = OrderedDict() # (start node, goal node) -> edges from the goal back to the start, or None if there's no path. Least recently used first.
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+	
+	def lookup(self, key):
+		"Returns a tuple: whether the key was found, and the cached edges."
+		self.lock.acquire()
+		try:
+			if key in self.entries:
+				edges = self.entries.pop(key)
+				self.entries[key] = edges # Move to the most recently used end
+				self.hits += 1
+				return True, edges
+			self.misses += 1
+			return False, None
+		finally:
+			self.lock.release()
+	
+	def put(self, key, edges):
+		self.lock.acquire()
+		if key in self.entries:
+			del self.entries[key]
+		self.entries[key] = edges
+		while len(self.entries) > self.size:
+			self.entries.popitem(last = False)
+		self.lock.release()
+	
+	def clear(self):
+		self.lock.acquire()
+		self.entries.clear()
+		self.lock.release()
+	
+	def report(self):
+		"Returns a one-line summary of the hits and misses so far."
+		total = max(self.hits + self.misses, 1)
+		return "%d hits, %d misses (%.1f%% hit rate), %d cached" % (self.hits, self.misses, self.hits * 100.0 / total, len(self.entries))
 
 class World:
 	"""The AI world models the world using a navigation mesh. AI entities navigate between edges in the mesh using an A* search algorithm.
@@ -65,6 +265,11 @@ class World:
 		else:
 			self.traverser = base.cTrav
 			self.traverser.clearColliders()
+		self.rayRoot = render.attachNewNode("rays")
+		self.rays = [] # Pool of ray collider NodePaths, reused by every ray query
+		self.queuedRays = [] # (traversal root, position, direction, callback) tuples waiting for the next update
+		self.flowFields = dict() # Target entity -> latest FlowField toward it
+		self.flowFieldRequests = dict() # Target entity -> (time, target node) of the last flow field requested
 		
 		# Setup the physics world
 		self.world = OdeWorld()
@@ -87,43 +292,42 @@ class World:
 		self.world.setSurfaceEntry(0, 0, 1.0, 0.3, 7, 0.9, 0.00001, 0.0, 0.01)
 	
 	def update(self):
-		"Steps the ODE simulation."
+		"Runs all queued ray tests and steps the ODE simulation."
+		for target in [x for x in self.flowFieldRequests.keys() if not x.active]:
+			pathQueue.cancel(("flow field", target))
+			del self.flowFieldRequests[target]
+			if target in self.flowFields:
+				del self.flowFields[target]
+		self.flushRays()
 		self.space.autoCollide()
 		self.world.quickStep(engine.clock.timeStep)
 		self.contactGroup.empty() # Clear the contact joints
 	
+	def getFlowField(self, target, targetNode):
+		"""Returns the latest flow field toward the given target entity, or None if the first one isn't ready yet.
+		A new field is requested at most once every FLOW_FIELD_INTERVAL seconds, and only once the target has moved to another node."""
+		request = self.flowFieldRequests.get(target)
+		if request == None or (engine.clock.time - request[0] > FLOW_FIELD_INTERVAL and request[1] != targetNode):
+			request = (engine.clock.time, targetNode)
+			self.flowFieldRequests[target] = request
+			def callback(field):
+				# A field for a target we've since dropped, or one that's been superseded by a newer request, isn't wanted.
+				if self.flowFieldRequests.get(target) is request:
+					self.flowFields[target] = field
+			pathQueue.put(FlowFieldRequest(callback, targetNode, ("flow field", target)))
+		return self.flowFields.get(target)
+	
 	def getNearestDroid(self, entityGroup, pos):
 		"Gets an entity on any opposing team with the smallest straight-line distance from the specified position."
-		distance = -1
-		droid = None
-		for entity in (x for x in entityGroup.entities.values() if isinstance(x, entities.BasicDroid)):
-			vector = pos - entity.getPosition()
-			if vector.length() < distance or distance == -1:
-				distance = vector.length()
-				droid = entity
-		return droid
+		return entityGroup.getNearest(pos, lambda x: isinstance(x, entities.BasicDroid))
 
 	def getNearestEnemy(self, entityGroup, pos, team, includeCloakedUnits = False):
 		"Gets an entity on any opposing team with the smallest straight-line distance from the specified position."
-		distance = -1
-		enemy = None
-		for entity in (x for x in entityGroup.entities.values() if isinstance(x, entities.BasicDroid) and ((not x.cloaked) or includeCloakedUnits) and (not team.isAlly(x.getTeam()))):
-			vector = pos - entity.getPosition()
-			if vector.length() < distance or distance == -1:
-				distance = vector.length()
-				enemy = entity
-		return enemy
+		return entityGroup.getNearest(pos, lambda x: isinstance(x, entities.BasicDroid) and ((not x.cloaked) or includeCloakedUnits) and (not team.isAlly(x.getTeam())))
 	
 	def getNearestDropPod(self, entityGroup, pos):
 		"Gets the nearest drop pod."
-		distance = -1
-		pod = None
-		for entity in (x for x in entityGroup.entities.values() if isinstance(x, entities.DropPod)):
-			vector = pos - entity.getPosition()
-			if vector.length() < distance or distance == -1:
-				distance = vector.length()
-				pod = entity
-		return pod
+		return entityGroup.getNearest(pos, lambda x: isinstance(x, entities.DropPod))
 	
 	def getNearestSpawnPoint(self, pos):
 		lowestDistance = -1
@@ -207,25 +411,60 @@ class World:
 		queue.sortEntries()
 		return queue
 		
-	def getCollisionQueue(self, position, direction, node = None):
-		"""Gets a CollisionHandlerQueue containing all collisions along the specified ray.
+	def _getRays(self, count):
+		"Returns count ray collider NodePaths from the pool, growing it if necessary."
+		while len(self.rays) < count:
+			cNode = CollisionNode("ray" + str(len(self.rays))) # The name tells us which ray a collision entry belongs to
+			cNode.setIntoCollideMask(BitMask32(0))
+			cNode.setFromCollideMask(BitMask32(1))
+			cNode.addSolid(CollisionRay())
+			self.rays.append(self.rayRoot.attachNewNode(cNode))
+		return self.rays[:count]
+	
+	def getCollisionQueues(self, rays, node = None):
+		"""Tests a list of (position, direction) rays in a single traversal. Returns a list with one sorted RayQueue per ray.
 		Only checks for collisions with the specified NodePath, if one is given."""
-		cNode = CollisionNode("cnode")
-		nodepath = render.attachNewNode(cNode)
-		cNode.setIntoCollideMask(BitMask32(0))
-		cNode.setFromCollideMask(BitMask32(1))
-		ray = CollisionRay(position.getX(), position.getY(), position.getZ(), direction.getX(), direction.getY(), direction.getZ())
-		cNode.addSolid(ray)
-		queue = CollisionHandlerQueue()
-		self.traverser.addCollider(nodepath, queue)
+		queues = [RayQueue() for x in rays]
+		if len(rays) == 0:
+			return queues
+		handler = CollisionHandlerQueue()
+		for nodePath, (position, direction) in zip(self._getRays(len(rays)), rays):
+			ray = nodePath.node().modifySolid(0)
+			ray.setOrigin(position.getX(), position.getY(), position.getZ())
+			ray.setDirection(direction.getX(), direction.getY(), direction.getZ())
+			self.traverser.addCollider(nodePath, handler)
 		if node == None:
 			self.traverser.traverse(engine.renderLit)
 		else:
 			self.traverser.traverse(node)
 		self.traverser.clearColliders()
-		nodepath.removeNode()
-		queue.sortEntries()
-		return queue
+		handler.sortEntries() # Sorts by distance from each entry's own ray origin, so each RayQueue ends up sorted too
+		for i in range(handler.getNumEntries()):
+			entry = handler.getEntry(i)
+			queues[int(entry.getFromNode().getName()[3:])].entries.append(entry)
+		return queues
+	
+	def getCollisionQueue(self, position, direction, node = None):
+		"""Gets a RayQueue containing all collisions along the specified ray.
+		Only checks for collisions with the specified NodePath, if one is given."""
+		return self.getCollisionQueues([(position, direction)], node)[0]
+	
+	def queueRay(self, position, direction, callback, node = None):
+		"""Defers a ray test until the next update, when all queued rays are tested together.
+		The callback receives the ray's RayQueue. Use this when the result isn't needed right away."""
+		self.queuedRays.append((node, position, direction, callback))
+	
+	def flushRays(self):
+		"Runs all queued ray tests, with one traversal per traversal root."
+		queuedRays = self.queuedRays
+		self.queuedRays = []
+		while len(queuedRays) > 0:
+			node = queuedRays[0][0]
+			batch = [x for x in queuedRays if x[0] == node]
+			queuedRays = [x for x in queuedRays if x[0] != node]
+			queues = self.getCollisionQueues([(x[1], x[2]) for x in batch], node)
+			for ray, queue in zip(batch, queues):
+				ray[3](queue)
 	
 	def getRayFirstCollision(self, rayNP, node = None):
 		"""Gets a CollisionEntry for the first collision along the specified ray.
@@ -266,34 +505,129 @@ class World:
 		del self.docks[:]
 		if self.navMesh != None:
 			self.navMesh.delete()
+		if pathQueue != None:
+			pathQueue.clear() # Pending requests refer to this world's navigation mesh
+		self.flowFields.clear()
+		self.flowFieldRequests.clear()
+		del self.queuedRays[:]
+		self.rayRoot.removeNode()
+		del self.rays[:]
 		self.world.destroy()
 		self.space.destroy()
 
+class RayQueue:
+	"The collision entries along a single ray, sorted by distance. Has the same interface as a sorted CollisionHandlerQueue."
+	def __init__(self):
+		self.entries = []
+	
+	def getNumEntries(self):
+		return len(self.entries)
+	
+	def getEntry(self, index):
+		return self.entries[index]
+
 navMeshCache = dict()
 class NavMesh:
 	def __init__(self, directory, filename):
 		global navMeshCache
 		self.edges = []
 		self.nodes = []
+		self.edgeGrid = dict() # Edges bucketed by center, for finding duplicates while processing the source geometry
+		self.nodeGrid = dict() # (x, y) cell -> nodes whose XY bounds overlap the cell
+		self.pathCache = PathCache() # Each mesh gets its own, so replacing the mesh throws the old paths away
+		self.hierarchy = None
 		self.filename = filename
 		if directory + "/" + self.filename in navMeshCache:
 			navMesh = navMeshCache[directory + "/" + self.filename]
 			self.edges = navMesh.edges
 			self.nodes = navMesh.nodes
+			self.nodeGrid = navMesh.nodeGrid
+			self.hierarchy = navMesh.hierarchy
 		else:
-			node = engine.loadModel(directory + "/" + self.filename)
-			self._processNode(node)
-			node.removeNode()
+			# The compiled mesh is keyed by a hash of the source file, so editing the source invalidates it.
+			source = engine.readFile(directory + "/" + self.filename + engine.modelFileSuffix)
+			cacheFile = None
+			if len(source) > 0:
+				cacheFile = os.path.join(NAVMESH_CACHE_DIRECTORY, os.path.basename(self.filename) + "-" + hashlib.sha1(source).hexdigest() + ".bin")
+			if cacheFile == None or not self._loadCompiled(cacheFile):
+				node = engine.loadModel(directory + "/" + self.filename)
+				self._processNode(node)
+				node.removeNode()
+				if cacheFile != None:
+					self._saveCompiled(cacheFile)
+			self._buildNodeGrid()
+			if HIERARCHY_MIN_NODES != None and len(self.nodes) >= HIERARCHY_MIN_NODES:
+				self.hierarchy = NavHierarchy(self)
 			navMeshCache[directory + "/" + self.filename] = self
 	
 	def delete(self):
-		pass
+		self.pathCache.clear()
+	
+	def _loadCompiled(self, cacheFile):
+		"""Loads the edges and nodes from a file written by _saveCompiled.
+		Returns false if the file doesn't exist or can't be read, in which case the mesh is left empty."""
+		if not os.path.exists(cacheFile):
+			return False
+		try:
+			f = open(cacheFile, "rb")
+			data = f.read()
+			f.close()
+			magic, version, numEdges, numNodes = struct.unpack_from("<4sHII", data, 0)
+			if magic != "A3PN" or version != NAVMESH_CACHE_VERSION:
+				return False
+			offset = struct.calcsize("<4sHII")
+			edgeFormat = struct.Struct("<6f")
+			for i in range(numEdges):
+				v = edgeFormat.unpack_from(data, offset)
+				offset += edgeFormat.size
+				self.edges.append(Edge(Vec3(v[0], v[1], v[2]), Vec3(v[3], v[4], v[5])))
+			for i in range(numNodes):
+				count = struct.unpack_from("<B", data, offset)[0]
+				indices = struct.unpack_from("<" + str(count) + "I", data, offset + 1)
+				offset += 1 + (count * 4)
+				edges = [self.edges[x] for x in indices]
+				# NavNode ignores duplicate edges, so padding the list out to three gives us back the same node.
+				edges = (edges * 3)[:3]
+				self.nodes.append(NavNode(edges[0], edges[1], edges[2]))
+		except (IOError, struct.error, IndexError):
+			engine.log.warning("Unable to read compiled navigation mesh " + cacheFile)
+			self.edges = []
+			self.nodes = []
+			return False
+		self._markNavigableEdges()
+		return True
+	
+	def _saveCompiled(self, cacheFile):
+		"Writes the edges and nodes to disk, so the next load can skip processing the source geometry."
+		edgeIndices = dict()
+		for i in range(len(self.edges)):
+			edgeIndices[self.edges[i]] = i
+		data = [struct.pack("<4sHII", "A3PN", NAVMESH_CACHE_VERSION, len(self.edges), len(self.nodes))]
+		for edge in self.edges:
+			data.append(struct.pack("<6f", edge.a.getX(), edge.a.getY(), edge.a.getZ(), edge.b.getX(), edge.b.getY(), edge.b.getZ()))
+		for node in self.nodes:
+			data.append(struct.pack("<B" + str(len(node.edges)) + "I", len(node.edges), *[edgeIndices[x] for x in node.edges]))
+		try:
+			if not os.path.exists(NAVMESH_CACHE_DIRECTORY):
+				os.makedirs(NAVMESH_CACHE_DIRECTORY)
+			# Write to a temporary file first so a half-written file never looks valid
+			f = open(cacheFile + ".tmp", "wb")
+			f.write("".join(data))
+			f.close()
+			if os.path.exists(cacheFile):
+				os.remove(cacheFile)
+			os.rename(cacheFile + ".tmp", cacheFile)
+		except (IOError, OSError):
+			engine.log.warning("Unable to write compiled navigation mesh " + cacheFile)
 	
 	def _processNode(self, node):
 		geomNodeCollection = node.findAllMatches('**/+GeomNode')
 		for nodePath in geomNodeCollection:
 			geomNode = nodePath.node()
 			self._processGeomNode(geomNode)
+		self._markNavigableEdges()
+
+	def _markNavigableEdges(self):
 		for edge in self.edges:
 			if len(edge.nodes) <= 1:
 				# This edge isn't between two nodes, so we don't need to worry about it when pathfinding. 
@@ -340,15 +674,51 @@ class NavMesh:
 		if edge == None:
 			edge = Edge(Vec3(v1), Vec3(v2))
 			self.edges.append(edge)
+			cell = self._getEdgeCell(edge.center)
+			if cell in self.edgeGrid:
+				self.edgeGrid[cell].append(edge)
+			else:
+				self.edgeGrid[cell] = [edge]
 		return edge
 	
+	def _getEdgeCell(self, center):
+		return (int(math.floor(center.getX())), int(math.floor(center.getY())), int(math.floor(center.getZ())))
+	
 	def _checkForEdge(self, v1, v2):
 		epsilon = 0.1
-		for edge in self.edges:
-			if (edge.a.almostEqual(v1, epsilon) and edge.b.almostEqual(v2, epsilon)) or (edge.a.almostEqual(v2, epsilon) and edge.b.almostEqual(v1, epsilon)):
-				return edge
+		# Matching edges have centers within epsilon of each other, so they're in the same or a neighboring grid cell.
+		x, y, z = self._getEdgeCell((Vec3(v1) + Vec3(v2)) / 2)
+		for cell in ((x + i, y + j, z + k) for i in (-1, 0, 1) for j in (-1, 0, 1) for k in (-1, 0, 1)):
+			for edge in self.edgeGrid.get(cell, []):
+				if (edge.a.almostEqual(v1, epsilon) and edge.b.almostEqual(v2, epsilon)) or (edge.a.almostEqual(v2, epsilon) and edge.b.almostEqual(v1, epsilon)):
+					return edge
 		return None
 
+	def _getNodeCell(self, x, y):
+		return (int(math.floor(x / NAVMESH_GRID_CELL_SIZE)), int(math.floor(y / NAVMESH_GRID_CELL_SIZE)))
+	
+	def _buildNodeGrid(self):
+		"""Buckets the nodes by the grid cells their XY bounds overlap.
+		A node can only contain points inside its bounds, so getNode only has to test the nodes in one cell."""
+		self.nodeGrid = dict()
+		for node in self.nodes:
+			xs = [v.getX() for edge in node.edges for v in (edge.a, edge.b)]
+			ys = [v.getY() for edge in node.edges for v in (edge.a, edge.b)]
+			minX, minY = self._getNodeCell(min(xs), min(ys))
+			maxX, maxY = self._getNodeCell(max(xs), max(ys))
+			for x in range(minX, maxX + 1):
+				for y in range(minY, maxY + 1):
+					if (x, y) in self.nodeGrid:
+						self.nodeGrid[(x, y)].append(node)
+					else:
+						self.nodeGrid[(x, y)] = [node]
+	
+	def getNodesNear(self, pos):
+		"Returns the nodes whose XY bounds overlap the grid cell containing the given position."
+		if pos.isNan():
+			return []
+		return self.nodeGrid.get(self._getNodeCell(pos.getX(), pos.getY()), [])
+	
 	def getNode(self, pos, radius = 1, lastKnownNode = None):
 		if lastKnownNode != None:
 			if lastKnownNode.containerTest(pos, radius):
@@ -357,9 +727,9 @@ class NavMesh:
 			for edge in lastKnownNode.edges:
 				nodes += [x for x in edge.getNodes() if x != lastKnownNode and x.containerTest(pos, radius)]
 			if len(nodes) == 0:
-				nodes = [x for x in self.nodes if x.containerTest(pos, radius)]
+				nodes = [x for x in self.getNodesNear(pos) if x.containerTest(pos, radius)]
 		else:
-			nodes = [x for x in self.nodes if x.containerTest(pos, radius)]
+			nodes = [x for x in self.getNodesNear(pos) if x.containerTest(pos, radius)]
 		size = len(nodes)
 		if size == 0:
 			return None
@@ -379,58 +749,191 @@ class NavMesh:
 		endNode = self.getNode(endPos, radius)
 		return self.findPathFromNodes(startNode, endNode, startPos, endPos, radius)
 	
-	def findPathFromNodes(self, startNode, endNode, startPos, endPos, radius = 1):	
-		# Clear pathfinding data
-		for edge in self.edges:
-			edge.closed = False
-			edge.cameFrom = None
-			edge.gScore = 0
-			edge.hScore = 0
-			edge.fScore = 0
-			edge.open = False
+	def findPathFromNodes(self, startNode, endNode, startPos, endPos, radius = 1):
+		"""Returns a Path between the given nodes, or None if there isn't one.
+		Searches between the same two nodes share their result through the path cache."""
+		key = (startNode, endNode)
+		found, edges = self.pathCache.lookup(key)
+		if not found:
+			if self.hierarchy != None:
+				edges = self.hierarchy.searchEdges(startNode, endNode)
+			else:
+				edges = self.searchEdges(startNode, endNode)
+			self.pathCache.put(key, edges)
+		if edges == None:
+			return None
 		path = Path(startPos, endPos, startNode, endNode, radius)
-		openEdges = startNode.edges[:]
+		for edge in edges:
+			path.add(edge)
+		path.clean()
+		return path
+	
+	def searchEdges(self, startNode, endNode, goalEdge = None):
+		"""A* over the mesh edges. Returns the edges of the route from the goal back to the start, or None.
+		If a goal edge is given, the search heads for it instead, and stops when it gets there or to the end node.
+		All search state is local to the call, so several searches can run on the same mesh at once."""
+		goal = endNode.center if goalEdge == None else goalEdge.center
+		gScores = dict() # Edge -> cost of the cheapest route found so far
+		hScores = dict()
+		cameFrom = dict()
+		closed = set()
+		openEdges = [] # Heap of (fScore, insertion count, edge). Entries made stale by a cheaper route are skipped.
+		count = 0
 		for edge in startNode.edges:
-			edge.gScore = 0
-			edge.hScore = edge.cost(endNode.center)
-			edge.fScore = edge.hScore
-			edge.open = True
-		def compare(x, y):
-			return (x.fScore > y.fScore) - (x.fScore < y.fScore)
+			gScores[edge] = 0
+			hScores[edge] = edge.cost(goal)
+			heapq.heappush(openEdges, (hScores[edge], count, edge))
+			count += 1
 		iterations = 0
 		while len(openEdges) > 0:
-			openEdges.sort(compare)
-			currentEdge = openEdges.pop(0)
-			if endNode in currentEdge.nodes:
+			currentEdge = heapq.heappop(openEdges)[2]
+			if currentEdge in closed:
+				continue
+			if endNode in currentEdge.nodes or currentEdge == goalEdge:
 				c = currentEdge
-				path.add(currentEdge)
-				while c.cameFrom != None:
-					c = c.cameFrom
-					path.add(c)
-				path.clean()
-				return path
-			currentEdge.closed = True
+				edges = [currentEdge]
+				while c in cameFrom:
+					c = cameFrom[c]
+					edges.append(c)
+				return edges
+			closed.add(currentEdge)
+			gScore = gScores[currentEdge]
 			for neighbor in currentEdge.neighbors:
-				if neighbor.navigable and not neighbor.closed:
-					tentativeGScore = currentEdge.gScore + currentEdge.costToEdge(neighbor)
-					tentativeIsBetter = False
-					if not neighbor.open:
-						neighbor.open = True
-						openEdges.append(neighbor)
-						neighbor.hScore = neighbor.cost(endNode.center)
-						tentativeIsBetter = True
-					elif tentativeGScore < neighbor.gScore:
-						tentativeIsBetter = True
-					if tentativeIsBetter:
-						neighbor.cameFrom = currentEdge
-						neighbor.gScore = tentativeGScore
-						neighbor.fScore = neighbor.gScore + neighbor.hScore
+				if neighbor.navigable and not neighbor in closed:
+					tentativeGScore = gScore + currentEdge.costToEdge(neighbor)
+					if not neighbor in gScores:
+						hScores[neighbor] = neighbor.cost(goal)
+					elif tentativeGScore >= gScores[neighbor]:
+						continue
+					cameFrom[neighbor] = currentEdge
+					gScores[neighbor] = tentativeGScore
+					heapq.heappush(openEdges, (tentativeGScore + hScores[neighbor], count, neighbor))
+					count += 1
 			iterations += 1
 			if iterations > 9:
 				time.sleep(0.0)
 				iterations = 0
 		return None
 
+class NavCluster:
+	def __init__(self):
+		self.nodes = set()
+		self.portals = [] # Navigable edges between one of our nodes and a node in another cluster
+
+class NavHierarchy:
+	"""Coarse layer over a NavMesh for long searches (HPA*). Nodes are grouped into square clusters.
+	The edges between clusters are portals, linked by the cost of the best route between them within each cluster.
+	A search first finds a route over the portals, then runs the detailed A* only as far as the first few portals.
+	Agents ask for a new path as they move, so the rest of the route gets refined along the way."""
+	def __init__(self, navMesh):
+		self.navMesh = navMesh
+		self.clusters = dict() # (x, y) cell -> NavCluster
+		self.nodeClusters = dict() # NavNode -> NavCluster
+		self.portalLinks = dict() # Portal edge -> list of (portal edge, cost)
+		self.nodePortalCosts = dict() # NavNode -> dictionary of portal edge -> cost within the node's cluster. Filled in as searches need them.
+		for node in navMesh.nodes:
+			cell = (int(math.floor(node.center.getX() / HIERARCHY_CLUSTER_SIZE)), int(math.floor(node.center.getY() / HIERARCHY_CLUSTER_SIZE)))
+			if not cell in self.clusters:
+				self.clusters[cell] = NavCluster()
+			self.clusters[cell].nodes.add(node)
+			self.nodeClusters[node] = self.clusters[cell]
+		for edge in (x for x in navMesh.edges if x.navigable):
+			clusters = set([self.nodeClusters[x] for x in edge.nodes])
+			if len(clusters) > 1:
+				self.portalLinks[edge] = []
+				for cluster in clusters:
+					cluster.portals.append(edge)
+		for cluster in self.clusters.values():
+			for portal in cluster.portals:
+				costs = self.getCosts(cluster, [portal])
+				self.portalLinks[portal] += [(x, costs[x]) for x in cluster.portals if x != portal and x in costs]
+	
+	def getCosts(self, cluster, startEdges):
+		"Dijkstra from the given edges, through the cluster's nodes only. Returns a dictionary of edge -> cost."
+		costs = dict()
+		openEdges = []
+		count = 0
+		for edge in startEdges:
+			costs[edge] = 0
+			heapq.heappush(openEdges, (0, count, edge))
+			count += 1
+		closed = set()
+		while len(openEdges) > 0:
+			cost, _, currentEdge = heapq.heappop(openEdges)
+			if currentEdge in closed:
+				continue
+			closed.add(currentEdge)
+			for node in (x for x in currentEdge.nodes if x in cluster.nodes):
+				for neighbor in node.edges:
+					if neighbor.navigable and not neighbor in closed:
+						tentativeCost = cost + currentEdge.costToEdge(neighbor)
+						if not neighbor in costs or tentativeCost < costs[neighbor]:
+							costs[neighbor] = tentativeCost
+							heapq.heappush(openEdges, (tentativeCost, count, neighbor))
+							count += 1
+		return costs
+	
+	def getPortalCosts(self, node):
+		"Returns a dictionary of the costs from the given node to each portal of its cluster that it can reach."
+		if not node in self.nodePortalCosts:
+			cluster = self.nodeClusters[node]
+			costs = self.getCosts(cluster, node.edges)
+			# Several path threads may get here at once. They'd all store the same thing.
+			self.nodePortalCosts[node] = dict([(x, costs[x]) for x in cluster.portals if x in costs])
+		return self.nodePortalCosts[node]
+	
+	def searchPortals(self, startNode, endNode):
+		"A* over the portal graph. Returns the portals along the cheapest route from start to end, or None."
+		startCosts = self.getPortalCosts(startNode)
+		endCosts = self.getPortalCosts(endNode) # Costs are symmetric, so these are also the costs from each portal to the end node
+		goal = endNode.center
+		gScores = dict()
+		cameFrom = dict()
+		closed = set()
+		openPortals = [] # Heap of (fScore, insertion count, portal). None stands for the end node.
+		count = 0
+		for portal in startCosts.keys():
+			gScores[portal] = startCosts[portal]
+			heapq.heappush(openPortals, (gScores[portal] + portal.cost(goal), count, portal))
+			count += 1
+		while len(openPortals) > 0:
+			fScore, _, portal = heapq.heappop(openPortals)
+			if portal == None:
+				route = []
+				portal = cameFrom[None]
+				while portal != None:
+					route.insert(0, portal)
+					portal = cameFrom.get(portal)
+				return route
+			if portal in closed:
+				continue
+			closed.add(portal)
+			gScore = gScores[portal]
+			if portal in endCosts:
+				if not None in gScores or gScore + endCosts[portal] < gScores[None]:
+					gScores[None] = gScore + endCosts[portal]
+					cameFrom[None] = portal
+					heapq.heappush(openPortals, (gScores[None], count, None))
+					count += 1
+			for neighbor, cost in self.portalLinks[portal]:
+				if not neighbor in closed and (not neighbor in gScores or gScore + cost < gScores[neighbor]):
+					gScores[neighbor] = gScore + cost
+					cameFrom[neighbor] = portal
+					heapq.heappush(openPortals, (gScores[neighbor] + neighbor.cost(goal), count, neighbor))
+					count += 1
+		return None
+	
+	def searchEdges(self, startNode, endNode):
+		"Same as NavMesh.searchEdges, except that long routes are only refined as far as the first few portals."
+		if self.nodeClusters[startNode] == self.nodeClusters[endNode]:
+			return self.navMesh.searchEdges(startNode, endNode)
+		route = self.searchPortals(startNode, endNode)
+		if route == None:
+			return None
+		if len(route) <= HIERARCHY_REFINE_PORTALS:
+			return self.navMesh.searchEdges(startNode, endNode)
+		return self.navMesh.searchEdges(startNode, endNode, route[HIERARCHY_REFINE_PORTALS - 1])
+
 class NavNode:
 	def __init__(self, edge1, edge2, edge3):
 		self.highest = -10000
@@ -496,13 +999,6 @@ class Edge:
 		self.flatCenter = Vec3(self.center.getX(), self.center.getY(), 0)
 		self.neighbors = []
 		self.nodes = []
-		# Temporary pathfinding data
-		self.closed = False
-		self.open = False
-		self.cameFrom = None
-		self.gScore = 0
-		self.hScore = 0
-		self.fScore = 0
 		self.navigable = True
 	
 	def intersects(self, c, d, radius = 0):
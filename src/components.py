@@ -10,6 +10,24 @@ import net2
 import particles
 import controllers
 
+shotHeader = None # Firing, bullet direction
+bulletHit = None # Hit something, hit position, hit an entity
+bulletDamage = None # Entity ID, damage
+spikePin = None # Pinning the entity against a wall, spike position
+clawImpale = None # 1, impale succeeded
+clawDamage = None # 2, target entity ID
+grenadeLaunch = None # Firing, grenade ID
+
+def init():
+	global shotHeader, bulletHit, bulletDamage, spikePin, clawImpale, clawDamage, grenadeLaunch
+	shotHeader = net.Schema([net.Boolean, net2.StandardVec3])
+	bulletHit = net.Schema([net.Boolean, net2.StandardVec3, net.Boolean])
+	bulletDamage = net.Schema([net.Uint16, net.Uint16])
+	spikePin = net.Schema([net.Boolean, net2.HighResVec3])
+	clawImpale = net.Schema([net.Uint8, net.Boolean])
+	clawDamage = net.Schema([net.Uint8, net.Uint16])
+	grenadeLaunch = net.Schema([net.Boolean, net.Uint16])
+
 class Component(DirectObject):
 	"A component is an object (weapon, etc) of an actor. Components can take damage and be repaired."
 	def __init__(self, actor, id):
@@ -190,19 +208,21 @@ class Gun(Weapon):
 			self.reload()
 		return False
 	
-	def bulletTest(self, aiWorld, entityGroup, origin, direction):
-		"""Low-level bullet ray test used by most guns.
-		Returns the position of the bullet hit, and the ObjectEntity damaged, if any."""
-		queue = aiWorld.getCollisionQueue(origin, direction)
-		for i in range(queue.getNumEntries()):
-			entry = queue.getEntry(i)
-			pos = entry.getSurfacePoint(render)
-			normal = entry.getSurfaceNormal(render)
-			entity = entityGroup.getEntityFromEntry(entry)
-			if entity == self.actor:
-				continue
-			return (entity, pos, normal, queue)
-		return (None, None, None, None)
+	def queueBulletTest(self, aiWorld, entityGroup, origin, direction, callback):
+		"""Low-level bullet ray test used by most guns. The ray is tested along with the rest of the frame's rays, before the update packets are sent.
+		The callback receives the ObjectEntity damaged (if any), the position and normal of the bullet hit, and the ray's queue."""
+		def bulletHit(queue):
+			for i in range(queue.getNumEntries()):
+				entry = queue.getEntry(i)
+				pos = entry.getSurfacePoint(render)
+				normal = entry.getSurfaceNormal(render)
+				entity = entityGroup.getEntityFromEntry(entry)
+				if entity == self.actor:
+					continue
+				callback(entity, pos, normal, queue)
+				return
+			callback(None, None, None, None)
+		aiWorld.queueRay(origin, direction, bulletHit)
 
 	def serverUpdate(self, aiWorld, entityGroup, packetUpdate):
 		p = Weapon.serverUpdate(self, aiWorld, entityGroup, packetUpdate)
@@ -222,20 +242,23 @@ class Gun(Weapon):
 				self.newReloadActive = False
 				self.activeSound = 2 # Reload ready sound
 				self.addCriticalPacket(p, packetUpdate)
-		p.add(net.Uint8(self.activeSound))
-		p.add(net.Boolean(self.selected))
 		self.ammo += self.ammoAdditions
 		self.ammoAdditions = 0
+		status = net.BitWriter()
+		status.write(self.activeSound, 2)
+		status.writeBool(self.selected)
 		if self.selected:
-			p.add(net.Uint8(self.ammo))
+			status.writeVarint(self.ammo)
+		p.add(status)
 		return p
 
 	def clientUpdate(self, aiWorld, entityGroup, iterator = None):
 		Weapon.clientUpdate(self, aiWorld, entityGroup, iterator)
 		if iterator != None:
-			self.activeSound = net.Uint8.getFrom(iterator)
-			if net.Boolean.getFrom(iterator):
-				self.ammo = net.Uint8.getFrom(iterator)
+			status = net.BitReader(iterator)
+			self.activeSound = status.read(2)
+			if status.readBool():
+				self.ammo = status.readVarint()
 		if self.actor.active:
 			offset = 0
 			angleOffset = 0
@@ -286,7 +309,6 @@ class ChainGun(Gun):
 		
 		if self.active and self.firing:
 			self.addCriticalPacket(p, packetUpdate)
-			p.add(net.Boolean(True))
 			
 			vector = self.actor.controller.targetPos - self.actor.getPosition()
 			pos = vector.cross(Vec3(0, 0, 1))
@@ -309,24 +331,23 @@ class ChainGun(Gun):
 			mat.setRotateMatNormaxis(angleY, render.getRelativeVector(self.node, Vec3(1, 0, 0)))
 			direction = mat.xformVec(direction)
 			
-			p.add(net2.StandardVec3(direction))
+			p.add(shotHeader.record(True, direction)) # We're firing
 			
-			entity = None
-			hitPos = None
+			shot = net.Packet() # Filled in once the bullet's ray has been tested
+			p.add(shot)
+			def writeShot(entity, hitPos, normal, queue):
+				if hitPos == None:
+					shot.add(net.Boolean(False)) # Bullet didn't hit anything
+				else:
+					if entity != None:
+						shot.add(bulletHit.record(True, hitPos, True)) # Bullet hit an entity
+						shot.add(bulletDamage.record(entity.getId(), self.damage * max(0, 1 - (vector.length() / 70)) * max(0, normal.dot(-direction) + 0.1)))
+					else:
+						shot.add(bulletHit.record(True, hitPos, False)) # Bullet hit the environment
 			if direction.length() > 0:
-				entity, hitPos, normal, queue = self.bulletTest(aiWorld, entityGroup, origin, direction)
-			if hitPos == None:
-				p.add(net.Boolean(False)) # Bullet didn't hit anything
+				self.queueBulletTest(aiWorld, entityGroup, origin, direction, writeShot)
 			else:
-				p.add(net.Boolean(True)) # Bullet hit something
-				p.add(net2.StandardVec3(hitPos))
-			
-				if entity != None:
-					p.add(net.Boolean(True))
-					p.add(net.Uint8(entity.getId()))
-					p.add(net.Uint16(self.damage * max(0, 1 - (vector.length() / 70)) * max(0, normal.dot(-direction) + 0.1)))
-				else:
-					p.add(net.Boolean(False))
+				writeShot(None, None, None, None)
 		else:
 			p.add(net.Boolean(False))
 		self.firing = False
@@ -353,9 +374,8 @@ class ChainGun(Gun):
 						self.tracer.draw(origin, pos)
 					
 					if net.Boolean.getFrom(iterator):
-						entityId = net.Uint8.getFrom(iterator)
+						entityId, damage = bulletDamage.getFrom(iterator)
 						entity = entityGroup.getEntity(entityId)
-						damage = net.Uint16.getFrom(iterator)
 						if entity != None:
 							entity.damage(self.actor, damage)
 							if isinstance(entity, entities.Actor):
@@ -396,7 +416,6 @@ class Shotgun(Gun):
 		
 		if self.active and self.firing:
 			self.addCriticalPacket(p, packetUpdate)
-			p.add(net.Boolean(True))
 			
 			vector = self.actor.controller.targetPos - self.actor.getPosition()
 			pos = vector.cross(Vec3(0, 0, 1))
@@ -405,28 +424,27 @@ class Shotgun(Gun):
 			direction = self.actor.controller.targetPos - origin
 			direction.normalize()
 
-			p.add(net2.StandardVec3(direction))
+			p.add(shotHeader.record(True, direction)) # We're firing
 			
-			entity = None
-			hitPos = None
+			shot = net.Packet() # Filled in once the bullet's ray has been tested
+			p.add(shot)
+			def writeShot(entity, hitPos, normal, queue):
+				if hitPos == None:
+					shot.add(net.Boolean(False)) # Bullet didn't hit anything
+				else:
+					if entity != None:
+						shot.add(bulletHit.record(True, hitPos, True)) # Bullet hit an entity
+						vector = entity.getPosition() - self.getPosition()
+						range = self.range
+						if self.zoomed:
+							range *= 1.5
+						shot.add(bulletDamage.record(entity.getId(), self.damage * max(0, 1 - (vector.length() / range) * max(0, normal.dot(-direction) * 1.25))))
+					else:
+						shot.add(bulletHit.record(True, hitPos, False)) # Bullet hit the environment
 			if direction.length() > 0:
-				entity, hitPos, normal, queue = self.bulletTest(aiWorld, entityGroup, origin, direction)
-			if hitPos == None:
-				p.add(net.Boolean(False)) # Bullet didn't hit anything
+				self.queueBulletTest(aiWorld, entityGroup, origin, direction, writeShot)
 			else:
-				p.add(net.Boolean(True)) # Bullet hit something
-				p.add(net2.StandardVec3(hitPos))
-			
-				if entity != None:
-					p.add(net.Boolean(True))
-					p.add(net.Uint8(entity.getId()))
-					vector = entity.getPosition() - self.getPosition()
-					range = self.range
-					if self.zoomed:
-						range *= 1.5
-					p.add(net.Uint16(self.damage * max(0, 1 - (vector.length() / range) * max(0, normal.dot(-direction) * 1.25))))
-				else:
-					p.add(net.Boolean(False))
+				writeShot(None, None, None, None)
 		else:
 			p.add(net.Boolean(False))
 		self.firing = False
@@ -456,9 +474,8 @@ class Shotgun(Gun):
 						self.tracer.draw(origin, pos)
 					
 					if net.Boolean.getFrom(iterator):
-						entityId = net.Uint8.getFrom(iterator)
+						entityId, damage = bulletDamage.getFrom(iterator)
 						entity = entityGroup.getEntity(entityId)
-						damage = net.Uint16.getFrom(iterator)
 						if entity != None:
 							entity.damage(self.actor, damage)
 							if isinstance(entity, entities.Actor):
@@ -501,7 +518,6 @@ class SniperRifle(Gun):
 		
 		if self.active and self.firing:
 			self.addCriticalPacket(p, packetUpdate)
-			p.add(net.Boolean(True))
 
 			vector = self.actor.controller.targetPos - self.actor.getPosition()
 			pos = vector.cross(Vec3(0, 0, 1))
@@ -510,25 +526,24 @@ class SniperRifle(Gun):
 			direction = self.actor.controller.targetPos - origin
 			direction.normalize()
 
-			p.add(net2.StandardVec3(direction))
-			
-			entity, hitPos, normal, queue = self.bulletTest(aiWorld, entityGroup, origin, direction)
-			if hitPos == None:
-				p.add(net.Boolean(False)) # Bullet didn't hit anything
-			else:
-				p.add(net.Boolean(True)) # Bullet hit something
-				p.add(net2.StandardVec3(hitPos))
+			p.add(shotHeader.record(True, direction)) # We're firing
 			
-				if entity != None:
-					p.add(net.Boolean(True))
-					p.add(net.Uint8(entity.getId()))
-					dot = normal.dot(-direction)
-					if dot > 0.95:
-						p.add(net.Uint16(self.damage * 4))
-					else:
-						p.add(net.Uint16(self.damage * max(0, dot * 1.5)))
+			shot = net.Packet() # Filled in once the bullet's ray has been tested
+			p.add(shot)
+			def writeShot(entity, hitPos, normal, queue):
+				if hitPos == None:
+					shot.add(net.Boolean(False)) # Bullet didn't hit anything
 				else:
-					p.add(net.Boolean(False))
+					if entity != None:
+						shot.add(bulletHit.record(True, hitPos, True)) # Bullet hit an entity
+						dot = normal.dot(-direction)
+						if dot > 0.95:
+							shot.add(bulletDamage.record(entity.getId(), self.damage * 4))
+						else:
+							shot.add(bulletDamage.record(entity.getId(), self.damage * max(0, dot * 1.5)))
+					else:
+						shot.add(bulletHit.record(True, hitPos, False)) # Bullet hit the environment
+			self.queueBulletTest(aiWorld, entityGroup, origin, direction, writeShot)
 		else:
 			p.add(net.Boolean(False))
 		self.firing = False
@@ -552,9 +567,8 @@ class SniperRifle(Gun):
 						pos = hitPos - (direction * random() * 4)
 						self.tracer.draw(origin, pos)
 					if net.Boolean.getFrom(iterator):
-						entityId = net.Uint8.getFrom(iterator)
+						entityId, damage = bulletDamage.getFrom(iterator)
 						entity = entityGroup.getEntity(entityId)
-						damage = net.Uint16.getFrom(iterator)
 						if entity != None:
 							entity.damage(self.actor, damage)
 							if isinstance(entity, entities.Actor):
@@ -614,7 +628,6 @@ class MeleeClaw(Weapon):
 		p = Weapon.serverUpdate(self, aiWorld, entityGroup, packetUpdate)
 		if self.firing and self.active:
 			self.addCriticalPacket(p, packetUpdate)
-			p.add(net.Uint8(1)) # 1 = We're starting to impale an entity
 			enemy = aiWorld.getNearestEnemy(entityGroup, self.actor.getPosition(), self.actor.getTeam(), includeCloakedUnits = True)
 			if enemy != None:
 				vector = self.actor.controller.targetPos - base.camera.getPos()
@@ -623,21 +636,20 @@ class MeleeClaw(Weapon):
 				vector.normalize()
 				vector2.normalize()
 				if math.acos(vector.getX() * vector2.getX() + vector.getY() * vector2.getY() + vector.getZ() * vector2.getZ()) < math.pi / 5 and vector3.length() < 8:
-					p.add(net.Boolean(True))
+					p.add(clawImpale.record(1, True)) # 1 = We're starting to impale an entity
 					vector3.normalize()
 					self.actor.addForce(engine.impulseToForce(vector3 * 1000))
 					self.impulseVector = vector3
 					self.impaleTarget = enemy
 				else:
-					p.add(net.Boolean(False))
+					p.add(clawImpale.record(1, False))
 			else:
-				p.add(net.Boolean(False))
+				p.add(clawImpale.record(1, False))
 			self.firing = False
 		elif self.active and self.impaleStart != -1 and self.impaleTarget != None and self.impaleTarget.active and (self.actor.getPosition() - self.impaleTarget.getPosition()).length() < self.actor.radius + self.impaleTarget.radius + 0.5:
 			self.addCriticalPacket(p, packetUpdate)
 			# At this point, the blade is actually in the target.
-			p.add(net.Uint8(2)) # 2 = We're now actually damaging the entity
-			p.add(net.Uint8(self.impaleTarget.getId()))
+			p.add(clawDamage.record(2, self.impaleTarget.getId())) # 2 = We're now actually damaging the entity
 			
 			# Stop the player from flying past the target.
 			if self.impaleTarget.health > self.damage: # Only add force if we don't kill the target. If the target dies, the explosion will already push us away.
@@ -662,7 +674,7 @@ class MeleeClaw(Weapon):
 				else: # Fail!
 					self.clawFailSound.play(entity = self.actor)
 			elif state == 2: # We're damaging an entity
-				enemy = entityGroup.getEntity(net.Uint8.getFrom(iterator))
+				enemy = entityGroup.getEntity(net.Uint16.getFrom(iterator))
 				if enemy != None and enemy.active:
 					pos = (enemy.getPosition() + self.actor.getPosition()) * 0.5
 					particles.add(particles.HitRegisterParticleGroup(pos, enemy.getTeam().color, 2))
@@ -711,7 +723,6 @@ class GrenadeLauncher(Weapon):
 
 	def serverUpdate(self, aiWorld, entityGroup, packetUpdate):
 		p = Weapon.serverUpdate(self, aiWorld, entityGroup, packetUpdate)
-		p.add(net.Boolean(self.firing))
 		if self.firing:
 			self.addCriticalPacket(p, packetUpdate)
 			direction = self.actor.controller.targetPos - self.actor.getPosition()
@@ -726,7 +737,9 @@ class GrenadeLauncher(Weapon):
 			grenade.setPosition(origin)
 			grenade.setLinearVelocity(direction * 40)
 			entityGroup.spawnEntity(grenade)
-			p.add(net.Uint8(grenade.getId()))
+			p.add(grenadeLaunch.record(True, grenade.getId()))
+		else:
+			p.add(net.Boolean(False))
 		self.firing = False
 		return p
 	
@@ -736,7 +749,7 @@ class GrenadeLauncher(Weapon):
 			if net.Boolean.getFrom(iterator):
 				# We're firing, play the launch sound. Everything else is taken care of by the Grenade being spawned.
 				self.grenadeLaunchSound.play(entity = self.actor)
-				self.grenadeId = net.Uint8.getFrom(iterator)
+				self.grenadeId = net.Uint16.getFrom(iterator)
 		grenade = entityGroup.getEntity(self.grenadeId)
 		if grenade != None and isinstance(grenade, entities.Grenade):
 			grenade.setActor(self.actor)
@@ -755,7 +768,6 @@ class MolotovThrower(Weapon):
 
 	def serverUpdate(self, aiWorld, entityGroup, packetUpdate):
 		p = Weapon.serverUpdate(self, aiWorld, entityGroup, packetUpdate)
-		p.add(net.Boolean(self.firing))
 		if self.firing:
 			self.addCriticalPacket(p, packetUpdate)
 			direction = self.actor.controller.targetPos - self.actor.getPosition()
@@ -770,7 +782,9 @@ class MolotovThrower(Weapon):
 			grenade.setPosition(origin)
 			grenade.setLinearVelocity(direction * 40)
 			entityGroup.spawnEntity(grenade)
-			p.add(net.Uint8(grenade.getId()))
+			p.add(grenadeLaunch.record(True, grenade.getId()))
+		else:
+			p.add(net.Boolean(False))
 		self.firing = False
 		return p
 	
@@ -780,7 +794,7 @@ class MolotovThrower(Weapon):
 			if net.Boolean.getFrom(iterator):
 				# We're firing, play the launch sound. Everything else is taken care of by the Grenade being spawned.
 				self.grenadeLaunchSound.play(entity = self.actor)
-				self.grenadeId = net.Uint8.getFrom(iterator)
+				self.grenadeId = net.Uint16.getFrom(iterator)
 		grenade = entityGroup.getEntity(self.grenadeId)
 		if grenade != None and isinstance(grenade, entities.Grenade):
 			grenade.setActor(self.actor)
@@ -809,7 +823,6 @@ class Pistol(Gun):
 		
 		if self.active and self.firing:
 			self.addCriticalPacket(p, packetUpdate)
-			p.add(net.Boolean(True))
 			
 			vector = self.actor.controller.targetPos - self.actor.getPosition()
 			pos = vector.cross(Vec3(0, 0, 1))
@@ -828,39 +841,37 @@ class Pistol(Gun):
 			mat.setRotateMatNormaxis(angleY, render.getRelativeVector(self.node, Vec3(1, 0, 0)))
 			direction = mat.xformVec(direction)
 			
-			p.add(net2.StandardVec3(direction))
+			p.add(shotHeader.record(True, direction)) # We're firing
 			
-			entity = None
-			hitPos = None
+			shot = net.Packet() # Filled in once the bullet's ray has been tested
+			p.add(shot)
+			def writeShot(entity, hitPos, normal, queue):
+				if hitPos == None:
+					shot.add(net.Boolean(False)) # Bullet didn't hit anything
+				else:
+					if entity != None:
+						shot.add(bulletHit.record(True, hitPos, True)) # Bullet hit an entity
+						totalDamage = self.damage * max(0, 1 - (vector.length() / 200)) * max(0, normal.dot(-direction) + 0.1)
+						shot.add(bulletDamage.record(entity.getId(), totalDamage))
+					
+						pinned = False
+						if isinstance(entity, entities.BasicDroid):
+							for i in range(queue.getNumEntries()):
+								entry = queue.getEntry(i)
+								pos = entry.getSurfacePoint(render)
+								testEntity = entityGroup.getEntityFromEntry(entry)
+								if testEntity == None and (pos - hitPos).length() < 5:
+									shot.add(spikePin.record(True, pos))
+									pinned = True
+									break
+						if not pinned:
+							shot.add(spikePin.record(False, hitPos))
+					else:
+						shot.add(bulletHit.record(True, hitPos, False)) # Bullet hit the environment
 			if direction.length() > 0:
-				entity, hitPos, normal, queue = self.bulletTest(aiWorld, entityGroup, origin, direction)
-			if hitPos == None:
-				p.add(net.Boolean(False)) # Bullet didn't hit anything
+				self.queueBulletTest(aiWorld, entityGroup, origin, direction, writeShot)
 			else:
-				p.add(net.Boolean(True)) # Bullet hit something
-				p.add(net2.StandardVec3(hitPos))
-				if entity != None:
-					p.add(net.Boolean(True))
-					p.add(net.Uint8(entity.getId()))
-					totalDamage = self.damage * max(0, 1 - (vector.length() / 200)) * max(0, normal.dot(-direction) + 0.1)
-					p.add(net.Uint16(totalDamage))
-				
-					pinned = False
-					if isinstance(entity, entities.BasicDroid):
-						for i in range(queue.getNumEntries()):
-							entry = queue.getEntry(i)
-							pos = entry.getSurfacePoint(render)
-							testEntity = entityGroup.getEntityFromEntry(entry)
-							if testEntity == None and (pos - hitPos).length() < 5:
-								p.add(net.Boolean(True))
-								p.add(net2.HighResVec3(pos))
-								pinned = True
-								break
-					if not pinned:
-						p.add(net.Boolean(False))
-						p.add(net2.HighResVec3(hitPos))
-				else:
-					p.add(net.Boolean(False))
+				writeShot(None, None, None, None)
 		else:
 			p.add(net.Boolean(False))
 		self.firing = False
@@ -887,12 +898,9 @@ class Pistol(Gun):
 						self.tracer.draw(origin, pos)
 					
 					if net.Boolean.getFrom(iterator):
-						entityId = net.Uint8.getFrom(iterator)
+						entityId, damage = bulletDamage.getFrom(iterator)
 						entity = entityGroup.getEntity(entityId)
-						damage = net.Uint16.getFrom(iterator)
-						pin = False
-						pin = net.Boolean.getFrom(iterator) # Whether we're pinning the entity against the wall
-						pinPos = net2.HighResVec3.getFrom(iterator)
+						pin, pinPos = spikePin.getFrom(iterator) # Whether we're pinning the entity against the wall
 						if entity != None:
 							if pin:
 								self.pinSound.play(position = hitPos)
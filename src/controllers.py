@@ -14,12 +14,52 @@ import ai
 
 types = None
 specialTypes = None
+# Compiled layouts for the fixed-size parts of controller updates. Built in init, once net2 has finished loading.
+controllerHeader = None # Packet code, entity ID
+positionUpdate = None # POSITION_BOUNDED, snapshot
+fullPositionUpdate = None # POSITION_FULL, full-precision snapshot
+noPositionUpdate = None # POSITION_NONE
+spawnHeader = None # PACKET_SPAWN, controller type, entity ID
+deletePacket = None # PACKET_DELETE, entity ID, killed
+objectSpawn = None # Position, velocity, rotation
+teamSpawn = None # Color, dock index, number of allies
+teamScores = None # Score, match score, survivors, zombies
+teamUpdate = None # Score, money
+glassSpawn = None # Position, rotation, width, height
+podSpawn = None # Final position, time since spawn, money
+podPayout = None # Paid, team ID, money left
+podUpdate = None # Paid, money left
+molotovSpawn = None # Actor ID, team ID
+droidSpawn = None # Special ID, active weapon
+
+# What an ObjectController update says about the entity's position
+POSITION_NONE = 0 # Unchanged
+POSITION_BOUNDED = 1 # An EntitySnapshot follows, quantized within the world bounds
+POSITION_FULL = 2 # A FullEntitySnapshot follows. For entities outside the world bounds, like drop pods on their way in.
+
 def init():
-	global types, specialTypes
+	global types, specialTypes, controllerHeader, positionUpdate, fullPositionUpdate, noPositionUpdate, spawnHeader, deletePacket
+	global objectSpawn, teamSpawn, teamScores, teamUpdate, glassSpawn, podSpawn, podPayout, podUpdate, molotovSpawn, droidSpawn
 	# Important: Shield droid and cloak droid MUST come before chaingun droid, due to inheritance issues.
 	# When determining the controller's type, readSpawnPacket stops at the first match.
 	types = {net.SPAWN_BOT:AIController, net.SPAWN_PLAYER:PlayerController, net.SPAWN_TEAMENTITY:TeamEntityController, net.SPAWN_PHYSICSENTITY:PhysicsEntityController, net.SPAWN_GRENADE:GrenadeController, net.SPAWN_GLASS:GlassController, net.SPAWN_MOLOTOV:MolotovController, net.SPAWN_POD:DropPodController}
 	specialTypes = {KAMIKAZE_SPECIAL:KamikazeSpecial, SHIELD_SPECIAL:ShieldSpecial, CLOAK_SPECIAL:CloakSpecial, AWESOME_SPECIAL:AwesomeSpecial, ROCKET_SPECIAL:RocketSpecial}
+	controllerHeader = net.Schema([net.Uint8, net.Uint16])
+	positionUpdate = net.Schema([net.Uint8, net2.EntitySnapshot])
+	fullPositionUpdate = net.Schema([net.Uint8, net2.FullEntitySnapshot])
+	noPositionUpdate = net.Schema([net.Uint8])
+	spawnHeader = net.Schema([net.Uint8, net.Uint8, net.Uint16])
+	deletePacket = net.Schema([net.Uint8, net.Uint16, net.Boolean])
+	objectSpawn = net.Schema([net2.HighResVec3, net2.StandardVec3, net2.StandardVec3])
+	teamSpawn = net.Schema([net2.HighResVec4, net.Uint8, net.Uint8])
+	teamScores = net.Schema([net.Int16, net.Int16, net.Boolean, net.Boolean])
+	teamUpdate = net.Schema([net.Int16, net.Int16])
+	glassSpawn = net.Schema([net2.StandardVec3, net2.StandardVec3, net.StandardFloat, net.StandardFloat])
+	podSpawn = net.Schema([net2.HighResVec3, net.StandardFloat, net.Uint16])
+	podPayout = net.Schema([net.Boolean, net.Uint16, net.Uint16])
+	podUpdate = net.Schema([net.Boolean, net.Uint16])
+	molotovSpawn = net.Schema([net.Uint16, net.Uint16])
+	droidSpawn = net.Schema([net.Uint8, net.Uint8])
 
 class Controller(DirectObject):
 	def __init__(self):
@@ -49,20 +89,18 @@ class Controller(DirectObject):
 	def buildSpawnPacket(self):
 		"""Builds a packet instructing client(s) to spawn the correct ObjectEntity with the correct ID."""
 		p = net.Packet()
-		p.add(net.Uint8(net.PACKET_SPAWN))
 		controllerType = 0
 		for type in types.items():
 			if isinstance(self, type[1]):
 				controllerType = type[0]
 				break
-		p.add(net.Uint8(controllerType))
-		p.add(net.Uint8(self.entity.getId()))
+		p.add(spawnHeader.record(net.PACKET_SPAWN, controllerType, self.entity.getId()))
 		return p
 	
 	@staticmethod
 	def readSpawnPacket(aiWorld, entityGroup, iterator, entity = None):
 		"Static method called by descendants. Assumes entity has already been initialized by the descendant."
-		id = net.Uint8.getFrom(iterator)
+		id = net.Uint16.getFrom(iterator)
 		entity.setLocal(net.netMode == net.MODE_SERVER)
 		entity.setId(id)
 		return entity
@@ -70,9 +108,7 @@ class Controller(DirectObject):
 	def buildDeletePacket(self, killed = False):
 		"""Builds a packet instructing clients to delete the Entity."""
 		p = net.Packet()
-		p.add(net.Uint8(net.PACKET_DELETE))
-		p.add(net.Uint8(self.entity.getId()))
-		p.add(net.Boolean(killed))
+		p.add(deletePacket.record(net.PACKET_DELETE, self.entity.getId(), killed))
 		return p
 	
 	def serverUpdate(self, aiWorld, entityGroup, packetUpdate):
@@ -90,12 +126,15 @@ class Controller(DirectObject):
 				del self.criticalPackets[:]
 			else:
 				self.criticalUpdate = False
-			p.add(net.Uint8(net.PACKET_CONTROLLER))
-			p.add(net.Uint8(self.entity.getId()))
+			p.add(controllerHeader.record(net.PACKET_CONTROLLER, self.entity.getId()))
 		return p
 	
 	def needsToSendUpdate(self):
 		return self.criticalUpdate
+	
+	def queueRayTests(self, aiWorld):
+		"""Called on local entities before the server update. Rays queued here are tested together, and their callbacks run before serverUpdate."""
+		pass
 
 	def clientUpdate(self, aiWorld, entityGroup, iterator = None):
 		"""The client update function applies the changes calculated by the server update function, even on the server machine.
@@ -125,18 +164,11 @@ class TeamEntityController(Controller):
 	
 	def buildSpawnPacket(self):
 		p = Controller.buildSpawnPacket(self)
-		p.add(net2.HighResVec4(self.entity.color))
-		if self.entity.dock != None:
-			p.add(net.Uint8(self.entity.dock.teamIndex))
-		else:
-			p.add(net.Uint8(0))
-		p.add(net.Uint8(len(self.entity.allies)))
+		dockIndex = self.entity.dock.teamIndex if self.entity.dock != None else 0
+		p.add(teamSpawn.record(self.entity.color, dockIndex, len(self.entity.allies)))
 		for allyId in self.entity.allies:
-			p.add(net.Uint8(allyId))
-		p.add(net.Int16(self.entity.score))
-		p.add(net.Int16(self.entity.matchScore))
-		p.add(net.Boolean(self.entity.isSurvivors))
-		p.add(net.Boolean(self.entity.isZombies))
+			p.add(net.Uint16(allyId))
+		p.add(teamScores.record(self.entity.score, self.entity.matchScore, self.entity.isSurvivors, self.entity.isZombies))
 		p.add(net.String(self.entity.username))
 		p.add(net.Int16(self.entity.money))
 		return p
@@ -145,17 +177,12 @@ class TeamEntityController(Controller):
 	def readSpawnPacket(aiWorld, entityGroup, iterator, entity = None):
 		entity = entities.TeamEntity()
 		entity = Controller.readSpawnPacket(aiWorld, entityGroup, iterator, entity)
-		entity.color = net2.HighResVec4.getFrom(iterator)
-		dockIndex = net.Uint8.getFrom(iterator)
+		entity.color, dockIndex, numAllies = teamSpawn.getFrom(iterator)
 		if len(aiWorld.docks) > 0:
 			entity.dock = [x for x in aiWorld.docks if x.teamIndex == dockIndex][0]
-		numAllies = net.Uint8.getFrom(iterator)
 		for i in range(numAllies):
-			entity.addAlly(net.Uint8.getFrom(iterator))
-		entity.score = net.Int16.getFrom(iterator)
-		entity.matchScore = net.Int16.getFrom(iterator)
-		entity.isSurvivors = net.Boolean.getFrom(iterator)
-		entity.isZombies = net.Boolean.getFrom(iterator)
+			entity.addAlly(net.Uint16.getFrom(iterator))
+		entity.score, entity.matchScore, entity.isSurvivors, entity.isZombies = teamScores.getFrom(iterator)
 		entity.username = net.String.getFrom(iterator)
 		entity.money = net.Int16.getFrom(iterator)
 		if not entity.isZombies:
@@ -189,8 +216,7 @@ class TeamEntityController(Controller):
 		self.scoreAdditions = 0
 		if not self.tutorialMode and self.entity.getPlayer() == None:
 			self.entity.score = 0
-		p.add(net.Int16(self.entity.score))
-		p.add(net.Int16(self.entity.money))
+		p.add(teamUpdate.record(self.entity.score, self.entity.money))
 		if self.entity.username != self.oldUsername:
 			self.addCriticalPacket(p, packetUpdate)
 			p.add(net.Boolean(True))
@@ -249,8 +275,7 @@ class TeamEntityController(Controller):
 	def clientUpdate(self, aiWorld, entityGroup, data = None):
 		Controller.clientUpdate(self, aiWorld, entityGroup, data)
 		if data != None:
-			self.entity.score = net.Int16.getFrom(data)
-			self.entity.money = net.Int16.getFrom(data)
+			self.entity.score, self.entity.money = teamUpdate.getFrom(data)
 			if net.Boolean.getFrom(data):
 				self.entity.username = net.String.getFrom(data)
 			numPurchases = net.Uint8.getFrom(data)
@@ -286,12 +311,52 @@ class ObjectController(Controller):
 		self.lastSnapshot = net2.EntitySnapshot()
 		self.upperHeightLimit = 70
 		self.lowerHeightLimit = -30
+		self.lastPosition = None
+		self.fullUpdateRequested = False
 	
 	def setEntity(self, entity):
 		"""ObjectEntity calls this function on initialization."""
 		assert isinstance(entity, entities.ObjectEntity)
 		Controller.setEntity(self, entity)
 	
+	def queueClipTest(self, aiWorld, minDistance = 0):
+		"""Queues a ray test along the entity's path since the last test, to make sure it didn't go through a wall.
+		If it did, the entity is moved back in front of the wall. Either way, clipTestDone is called with the result."""
+		pos = self.entity.getPosition()
+		if self.lastPosition == None:
+			self.lastPosition = pos
+			return
+		lastPosition = self.lastPosition
+		vector = pos - lastPosition
+		distance = vector.length()
+		if distance <= minDistance:
+			self.lastPosition = pos
+			self.clipTestDone(False)
+			return
+		vector.normalize()
+		def clipCallback(queue):
+			clipped = False
+			for i in range(queue.getNumEntries()):
+				entry = queue.getEntry(i)
+				collision = entry.getSurfacePoint(render)
+				v = collision - lastPosition
+				if v.length() < distance:
+					clipped = True
+					self.entity.setPosition(collision - (vector * self.entity.radius))
+					self.entity.commitChanges()
+					break
+			self.lastPosition = self.entity.getPosition()
+			self.clipTestDone(clipped)
+		aiWorld.queueRay(lastPosition, vector, clipCallback, engine.renderEnvironment)
+	
+	def clipTestDone(self, clipped):
+		pass
+	
+	def requestFullUpdate(self):
+		"""Makes the next update carry the entity's position, even if it hasn't moved.
+		The server asks for this when a client missed updates that were culled to its area of interest."""
+		self.fullUpdateRequested = True
+	
 	def buildSpawnPacket(self, isPhysicsEntity = False):
 		"""Builds a packet instructing client(s) to spawn the correct ObjectEntity with the correct ID."""
 		p = Controller.buildSpawnPacket(self)
@@ -299,9 +364,7 @@ class ObjectController(Controller):
 		if isPhysicsEntity:
 			p.add(net.String(self.entity.directory))
 			p.add(net.String(self.entity.dataFile))
-		p.add(net2.HighResVec3(self.entity.getPosition()))
-		p.add(net2.StandardVec3(self.entity.getLinearVelocity()))
-		p.add(net2.StandardVec3(self.entity.getRotation()))
+		p.add(objectSpawn.record(self.entity.getPosition(), self.entity.getLinearVelocity(), self.entity.getRotation()))
 		return p
 	
 	@staticmethod
@@ -312,9 +375,7 @@ class ObjectController(Controller):
 			directory = net.String.getFrom(iterator)
 			dataFile = net.String.getFrom(iterator)
 			entity.loadDataFile(aiWorld.world, aiWorld.space, engine.readPhysicsEntityFile(dataFile + ".txt"), directory, dataFile)
-		pos = net2.HighResVec3.getFrom(iterator)
-		vel = net2.StandardVec3.getFrom(iterator)
-		rot = net2.StandardVec3.getFrom(iterator)
+		pos, vel, rot = objectSpawn.getFrom(iterator)
 		entity.setPosition(pos)
 		entity.setRotation(Vec3(rot.getX(), rot.getY(), rot.getZ()))
 		entity.setLinearVelocity(vel)
@@ -338,14 +399,18 @@ class ObjectController(Controller):
 			self.entity.commitChanges()
 			snapshot = net2.EntitySnapshot()
 			snapshot.takeSnapshot(self.entity)
-			if not packetUpdate or self.isStatic or (self.lastSentSnapshot.almostEquals(snapshot) and self.entity.body.getLinearVel().length() < 0.5):
-				p.add(net.Boolean(False))
+			fullUpdate = packetUpdate and self.fullUpdateRequested
+			if not fullUpdate and (not packetUpdate or self.isStatic or (self.lastSentSnapshot.almostEquals(snapshot) and self.entity.body.getLinearVel().length() < 0.5)):
+				p.add(noPositionUpdate.record(POSITION_NONE))
 				self.newPositionData = False
 			else:
 				self.newPositionData = True
-				p.add(net.Boolean(True))
+				self.fullUpdateRequested = False
 				self.lastSnapshot = snapshot
-				p.add(snapshot)
+				if snapshot.isInBounds():
+					p.add(positionUpdate.record(POSITION_BOUNDED, snapshot))
+				else:
+					p.add(fullPositionUpdate.record(POSITION_FULL, snapshot))
 			z = self.entity.getPosition().getZ()
 			if z < self.lowerHeightLimit or z > self.upperHeightLimit:
 				self.entity.killer = None
@@ -369,8 +434,11 @@ class ObjectController(Controller):
 				self.snapshots.append(net2.EntitySnapshot())
 				self.snapshots[0].takeSnapshot(self.entity)
 			if iterator != None:
-				if net.Boolean.getFrom(iterator):
+				position = net.Uint8.getFrom(iterator)
+				if position == POSITION_BOUNDED:
 					snapshot = net2.EntitySnapshot.getFrom(iterator)
+				elif position == POSITION_FULL:
+					snapshot = net2.FullEntitySnapshot.getFrom(iterator)
 				else:
 					snapshot = net2.EntitySnapshot()
 					snapshot.setFrom(self.snapshots[0])
@@ -436,19 +504,15 @@ class GlassController(Controller):
 	
 	def buildSpawnPacket(self):
 		p = Controller.buildSpawnPacket(self)
-		p.add(net2.StandardVec3(self.entity.getPosition()))
-		p.add(net2.StandardVec3(self.entity.getRotation()))
-		p.add(net.StandardFloat(self.entity.glassWidth))
-		p.add(net.StandardFloat(self.entity.glassHeight))
+		p.add(glassSpawn.record(self.entity.getPosition(), self.entity.getRotation(), self.entity.glassWidth, self.entity.glassHeight))
 		return p
 	
 	@staticmethod
 	def readSpawnPacket(aiWorld, entityGroup, iterator, entity = None):
 		entity = entities.Glass(aiWorld.world, aiWorld.space)
 		entity = Controller.readSpawnPacket(aiWorld, entityGroup, iterator, entity)
-		pos = net2.StandardVec3.getFrom(iterator)
-		hpr = net2.StandardVec3.getFrom(iterator)
-		entity.initGlass(aiWorld.world, aiWorld.space, net.StandardFloat.getFrom(iterator), net.StandardFloat.getFrom(iterator))
+		pos, hpr, width, height = glassSpawn.getFrom(iterator)
+		entity.initGlass(aiWorld.world, aiWorld.space, width, height)
 		entity.setPosition(pos)
 		entity.setRotation(Vec3(hpr.getX(), hpr.getY(), hpr.getZ()))
 		return entity
@@ -511,9 +575,7 @@ class DropPodController(ObjectController):
 	def buildSpawnPacket(self, isPhysicsEntity = False):
 		"""Builds a packet instructing client(s) to spawn the correct Entity with the correct ID."""
 		p = ObjectController.buildSpawnPacket(self)
-		p.add(net2.HighResVec3(self.finalPosition))
-		p.add(net.StandardFloat(engine.clock.time - self.entity.spawnTime))
-		p.add(net.Uint16(self.money))
+		p.add(podSpawn.record(self.finalPosition, engine.clock.time - self.entity.spawnTime, self.money))
 		return p
 	
 	@staticmethod
@@ -521,9 +583,9 @@ class DropPodController(ObjectController):
 		"Static method called by descendants. Assumes entity has already been initialized by the descendant."
 		entity = entities.DropPod(aiWorld.world, aiWorld.space, False)
 		entity = ObjectController.readSpawnPacket(aiWorld, entityGroup, iterator, entity)
-		entity.controller.setFinalPosition(net2.HighResVec3.getFrom(iterator))
-		entity.spawnTime = engine.clock.time - net.StandardFloat.getFrom(iterator)
-		entity.controller.money = net.Uint16.getFrom(iterator)
+		finalPosition, aliveTime, entity.controller.money = podSpawn.getFrom(iterator)
+		entity.controller.setFinalPosition(finalPosition)
+		entity.spawnTime = engine.clock.time - aliveTime
 		return entity
 	
 	def serverUpdate(self, aiWorld, entityGroup, packetUpdate):
@@ -531,19 +593,18 @@ class DropPodController(ObjectController):
 			aliveTime = engine.clock.time - self.entity.spawnTime
 			self.entity.setPosition(self.startPosition + (self.finalPosition - self.startPosition) * min(1, (aliveTime / self.inAirTime)))
 		p = ObjectController.serverUpdate(self, aiWorld, entityGroup, packetUpdate)
-		paid = False
+		paidTeam = None
 		if self.landed and engine.clock.time - self.lastPayout > self.payoutDelay and self.warningTime == -1:
 			droid = aiWorld.getNearestDroid(entityGroup, self.entity.getPosition())
 			if droid != None and (droid.getPosition() - self.entity.getPosition()).length() < self.captureDistance:
-				p.add(net.Boolean(True))
-				p.add(net.Uint8(droid.getTeam().getId()))
-				paid = True
+				paidTeam = droid.getTeam()
 				self.money -= self.payoutAmount
 				self.lastPayout = engine.clock.time
 				self.addCriticalPacket(p, packetUpdate)
-		if not paid:
-			p.add(net.Boolean(False))
-		p.add(net.Uint16(max(self.money, 0)))
+		if paidTeam != None:
+			p.add(podPayout.record(True, paidTeam.getId(), max(self.money, 0)))
+		else:
+			p.add(podUpdate.record(False, max(self.money, 0)))
 		if self.warningTime != -1 and engine.clock.time - self.warningTime > 3.0:
 			self.entity.killer = None
 			self.entity.kill(aiWorld, entityGroup)
@@ -553,7 +614,7 @@ class DropPodController(ObjectController):
 		ObjectController.clientUpdate(self, aiWorld, entityGroup, data)
 		if data != None:
 			if net.Boolean.getFrom(data): # Pay money to some team or other
-				team = entityGroup.getEntity(net.Uint8.getFrom(data))
+				team = entityGroup.getEntity(net.Uint16.getFrom(data))
 				if team != None:
 					team.controller.addMoney(self.payoutAmount)
 			self.money = net.Uint16.getFrom(data)
@@ -589,21 +650,20 @@ class GrenadeController(ObjectController):
 		ObjectController.__init__(self)
 		self.bounceTime = -1
 		self.bounceSound = audio.SoundPlayer("grenade-bounce")
-		self.lastPosition = None
 		self.particleGroup = None
 		self.light = engine.Light(color = Vec4(1.0, 0.7, 0.4, 1), attenuation = Vec3(0, 0, 0.01))
 		self.light.add()
 	
 	def buildSpawnPacket(self):
 		p = ObjectController.buildSpawnPacket(self)
-		p.add(net.Uint8(self.entity.getTeam().getId()))
+		p.add(net.Uint16(self.entity.getTeam().getId()))
 		return p
 	
 	@staticmethod
 	def readSpawnPacket(aiWorld, entityGroup, iterator, entity = None):
 		entity = entities.Grenade(aiWorld.world, aiWorld.space)
 		entity = ObjectController.readSpawnPacket(aiWorld, entityGroup, iterator, entity)
-		entity.setTeamId(net.Uint8.getFrom(iterator))
+		entity.setTeamId(net.Uint16.getFrom(iterator))
 		return entity
 		
 	def setEntity(self, entity):
@@ -625,29 +685,15 @@ class GrenadeController(ObjectController):
 			particles.add(self.particleGroup)
 		self.particleGroup.setPosition(pos)
 
-	def serverUpdate(self, aiWorld, entityGroup, packetUpdate):
-		pos = self.entity.getPosition()
-		if self.lastPosition == None:
-			self.lastPosition = pos
-		else:
-			# Check to make sure the grenade didn't go through a wall
-			vector = self.entity.getPosition() - self.lastPosition
-			distance = vector.length()
-			if distance > 0:
-				vector.normalize()
-				queue = aiWorld.getCollisionQueue(self.lastPosition, vector, engine.renderEnvironment)
-				for i in range(queue.getNumEntries()):
-					entry = queue.getEntry(i)
-					collision = entry.getSurfacePoint(render)
-					v = collision - self.lastPosition
-					if v.length() < distance:
-						self.entity.setPosition(collision - (vector * self.entity.radius))
-						self.entity.commitChanges()
-						self.trigger()
-						break
-		
-		self.lastPosition = self.entity.getPosition()
+	def queueRayTests(self, aiWorld):
+		# Check to make sure the grenade didn't go through a wall
+		self.queueClipTest(aiWorld)
+	
+	def clipTestDone(self, clipped):
+		if clipped:
+			self.trigger()
 	
+	def serverUpdate(self, aiWorld, entityGroup, packetUpdate):
 		p = ObjectController.serverUpdate(self, aiWorld, entityGroup, packetUpdate)
 		
 		enemy = aiWorld.getNearestEnemy(entityGroup, self.entity.getPosition(), self.entity.getTeam())
@@ -669,7 +715,6 @@ class MolotovController(ObjectController):
 	"MolotovController handles particles and fire damage."
 	def __init__(self):
 		ObjectController.__init__(self)
-		self.lastPosition = None
 		self.particleGroup = None
 		self.light = engine.Light(color = Vec4(1.0, 0.6, 0.2, 1), attenuation = Vec3(0, 0, 0.005))
 		self.light.add()
@@ -678,44 +723,27 @@ class MolotovController(ObjectController):
 	
 	def buildSpawnPacket(self):
 		p = ObjectController.buildSpawnPacket(self)
-		p.add(net.Uint8(self.entity.actor.getId()))
-		p.add(net.Uint8(self.entity.getTeam().getId()))
+		p.add(molotovSpawn.record(self.entity.actor.getId(), self.entity.getTeam().getId()))
 		return p
 	
 	@staticmethod
 	def readSpawnPacket(aiWorld, entityGroup, iterator, entity = None):
 		entity = entities.Molotov(aiWorld.world, aiWorld.space)
 		entity = ObjectController.readSpawnPacket(aiWorld, entityGroup, iterator, entity)
-		entity.setActor(entityGroup.getEntity(net.Uint8.getFrom(iterator)))
-		entity.setTeamId(net.Uint8.getFrom(iterator))
+		actorId, teamId = molotovSpawn.getFrom(iterator)
+		entity.setActor(entityGroup.getEntity(actorId))
+		entity.setTeamId(teamId)
 		return entity
 		
 	def setEntity(self, entity):
 		assert isinstance(entity, entities.Molotov)
 		ObjectController.setEntity(self, entity)
 
-	def serverUpdate(self, aiWorld, entityGroup, packetUpdate):	
-		pos = self.entity.getPosition()
-		if self.lastPosition == None:
-			self.lastPosition = pos
-		else:
-			# Check to make sure the grenade didn't go through a wall
-			vector = self.entity.getPosition() - self.lastPosition
-			distance = vector.length()
-			if distance > 0:
-				vector.normalize()
-				queue = aiWorld.getCollisionQueue(self.lastPosition, vector, engine.renderEnvironment)
-				for i in range(queue.getNumEntries()):
-					entry = queue.getEntry(i)
-					collision = entry.getSurfacePoint(render)
-					v = collision - self.lastPosition
-					if v.length() < distance:
-						self.entity.setPosition(collision - (vector * self.entity.radius))
-						self.entity.commitChanges()
-						break
-		
-		self.lastPosition = self.entity.getPosition()
+	def queueRayTests(self, aiWorld):
+		# Check to make sure the molotov didn't go through a wall
+		self.queueClipTest(aiWorld)
 	
+	def serverUpdate(self, aiWorld, entityGroup, packetUpdate):	
 		p = ObjectController.serverUpdate(self, aiWorld, entityGroup, packetUpdate)
 		
 		if engine.clock.time - self.entity.spawnTime > self.lifeTime:
@@ -755,13 +783,13 @@ class ActorController(ObjectController):
 	
 	def buildSpawnPacket(self):
 		p = ObjectController.buildSpawnPacket(self)
-		p.add(net.Uint8(self.entity.getTeam().getId()))
+		p.add(net.Uint16(self.entity.getTeam().getId()))
 		return p
 	
 	@staticmethod
 	def readSpawnPacket(aiWorld, entityGroup, iterator, entity = None):
 		entity = ObjectController.readSpawnPacket(aiWorld, entityGroup, iterator, entity)
-		entity.setTeamId(net.Uint8.getFrom(iterator))
+		entity.setTeamId(net.Uint16.getFrom(iterator))
 		if not isinstance(entity, entities.PlayerDroid):
 			entity.getTeam().actors.append(entity)
 		return entity
@@ -777,17 +805,28 @@ class ActorController(ObjectController):
 				if needUpdate:
 					self.componentsNeedUpdate = True
 					p.add(p2)
-		p.add(net.Uint8(255)) # End of component packets
-		p.add(net.Boolean(self.onFire))
 		if self.entity.health < self.entity.maxHealth and (engine.clock.time - self.lastDamage > 4.0 or (self.entity.getTeam().dock != None and (self.entity.getTeam().dock.getPosition() - self.entity.getPosition()).length() < self.entity.getTeam().dock.radius)):
 			self.healthAddition += 60 * engine.clock.timeStep
 		self.entity.health += int(self.healthAddition)
 		self.lastHealthAddition = self.healthAddition
 		self.healthAddition = 0
-		p.add(net.Int16(self.entity.health))
+		p.add(net.Uint8(255)) # End of component packets
+		status = net.BitWriter()
+		status.writeBool(self.onFire)
+		status.writeSignedVarint(self.entity.health)
+		self.writeStatus(status, p, packetUpdate)
+		p.add(status)
 		if self.entity.health <= 0:
 			self.entity.kill(aiWorld, entityGroup, True)
 		return p
+	
+	def writeStatus(self, status, p, packetUpdate):
+		"Derived controllers can add their own flags and small values to the actor's bit-packed status here."
+		pass
+	
+	def readStatus(self, status):
+		"Reads back whatever writeStatus wrote."
+		pass
 
 	def actorDamaged(self, entity, damage, ranged):
 		self.healthAddition -= int(damage)
@@ -804,8 +843,10 @@ class ActorController(ObjectController):
 			for id in (x for x in range(len(self.entity.components)) if not x in updatedComponents):
 				self.entity.components[id].clientUpdate(aiWorld, entityGroup)
 			
-			self.onFire = net.Boolean.getFrom(data)
-			self.entity.health = net.Int16.getFrom(data)
+			status = net.BitReader(data)
+			self.onFire = status.readBool()
+			self.entity.health = status.readSignedVarint()
+			self.readStatus(status)
 		else:
 			for component in self.entity.components:
 				component.clientUpdate(aiWorld, entityGroup)
@@ -826,7 +867,6 @@ class DroidController(ActorController):
 		self.lastSentTargetPos = Vec3()
 		self.targetedEnemy = None
 		self.lastTargetedEnemy = None
-		self.lastPosition = None
 		self.onFire = False
 		self.fireTimer = -1
 		self.lastFireDamage = -1
@@ -842,8 +882,7 @@ class DroidController(ActorController):
 				p.add(net.Uint8(255))
 			else:
 				p.add(net.Uint8(id))
-		p.add(net.Uint8(255 if self.entity.specialId == None else self.entity.specialId))
-		p.add(net.Uint8(self.activeWeapon))
+		p.add(droidSpawn.record(255 if self.entity.specialId == None else self.entity.specialId, self.activeWeapon))
 		return p
 	
 	@staticmethod
@@ -857,11 +896,10 @@ class DroidController(ActorController):
 				id = None
 			weapons.append(id)
 		entity.setWeapons(weapons)
-		specialId = net.Uint8.getFrom(iterator)
+		specialId, entity.controller.activeWeapon = droidSpawn.getFrom(iterator)
 		if specialId == 255:
 			specialId = None
 		entity.setSpecial(specialId)
-		entity.controller.activeWeapon = net.Uint8.getFrom(iterator)
 		entity.components[entity.controller.activeWeapon].show()
 		return entity
 	
@@ -893,6 +931,20 @@ class DroidController(ActorController):
 		else:
 			return False
 	
+	def queueRayTests(self, aiWorld):
+		if self.clipCheckCount < 10:
+			# Check to make sure we didn't go through a wall
+			self.queueClipTest(aiWorld, self.entity.radius * 0.9)
+		else:
+			self.lastPosition = self.entity.getPosition()
+			self.clipTestDone(False)
+	
+	def clipTestDone(self, clipped):
+		if clipped:
+			self.clipCheckCount += 1
+		else:
+			self.clipCheckCount = 0 # We didn't clip this time, so reset the count.
+	
 	def serverUpdate(self, aiWorld, entityGroup, packetUpdate):
 		if self.entity.pinned:
 			if engine.clock.time - self.entity.pinTime > 5.0:
@@ -906,34 +958,6 @@ class DroidController(ActorController):
 	
 		if self.entity.special != None:
 			specialPacket = self.entity.special.serverUpdate(aiWorld, entityGroup, packetUpdate)
-			
-		pos = self.entity.getPosition()
-		if self.lastPosition == None:
-			self.lastPosition = pos
-		else:
-			clipped = False
-			if self.clipCheckCount < 10:
-				# Check to make sure we didn't go through a wall
-				vector = self.entity.getPosition() - self.lastPosition
-				distance = vector.length()
-				if distance > self.entity.radius * 0.9:
-					vector.normalize()
-					queue = aiWorld.getCollisionQueue(self.lastPosition, vector, engine.renderEnvironment)
-					for i in range(queue.getNumEntries()):
-						entry = queue.getEntry(i)
-						collision = entry.getSurfacePoint(render)
-						v = collision - self.lastPosition
-						if v.length() < distance:
-							clipped = True
-							self.entity.setPosition(collision - (vector * self.entity.radius))
-							self.entity.commitChanges()
-							break
-			if clipped:
-				self.clipCheckCount += 1
-			else:
-				self.clipCheckCount = 0 # We didn't clip this time, so reset the count.
-		
-		self.lastPosition = self.entity.getPosition()
 		
 		if self.onFire:
 			if engine.clock.time - self.fireTimer > 2.0:
@@ -946,19 +970,29 @@ class DroidController(ActorController):
 
 		p = ActorController.serverUpdate(self, aiWorld, entityGroup, packetUpdate)
 		
-		p.add(net.Boolean(self.onFire))
-			
-		if self.activeWeapon != self.lastActiveWeapon:
-			p.add(net.Boolean(True))
-			p.add(net.Uint8(self.activeWeapon))
-			self.addCriticalPacket(p, packetUpdate)
-		else:
-			p.add(net.Boolean(False))
 		p.add(net2.LowResVec3(self.targetPos))
 		if self.entity.special != None:
 			p.add(specialPacket)
 		return p
 	
+	def writeStatus(self, status, p, packetUpdate):
+		ActorController.writeStatus(self, status, p, packetUpdate)
+		if self.activeWeapon != self.lastActiveWeapon:
+			status.writeBool(True)
+			status.write(self.activeWeapon, net.bitsFor(len(self.entity.components)))
+			self.addCriticalPacket(p, packetUpdate)
+		else:
+			status.writeBool(False)
+	
+	def readStatus(self, status):
+		ActorController.readStatus(self, status)
+		if status.readBool():
+			if self.lastActiveWeapon != -1:
+				self.entity.components[self.lastActiveWeapon].hide()
+			self.activeWeapon = status.read(net.bitsFor(len(self.entity.components)))
+			self.entity.components[self.activeWeapon].show()
+			self.lastActiveWeapon = self.activeWeapon
+	
 	def actorDamaged(self, entity, damage, ranged):
 		ActorController.actorDamaged(self, entity, damage, ranged)
 		self.lastDamage = engine.clock.time
@@ -968,13 +1002,6 @@ class DroidController(ActorController):
 	def clientUpdate(self, aiWorld, entityGroup, iterator = None):
 		ActorController.clientUpdate(self, aiWorld, entityGroup, iterator)
 		if iterator != None:
-			self.onFire = net.Boolean.getFrom(iterator) # We're on fire
-			if net.Boolean.getFrom(iterator):
-				if self.lastActiveWeapon != -1:
-					self.entity.components[self.lastActiveWeapon].hide()
-				self.activeWeapon = net.Uint8.getFrom(iterator)
-				self.entity.components[self.activeWeapon].show()
-				self.lastActiveWeapon = self.activeWeapon
 			self.targetPos = net2.LowResVec3.getFrom(iterator)
 		
 		if self.entity.health <= self.entity.maxHealth * 0.15:
@@ -1303,10 +1330,10 @@ class PlayerController(DroidController):
 		if cmds > 0:
 			self.addCriticalPacket(p, packetUpdate)
 		for c in self.commands:
-			p.add(net.Uint8(c[0])) # The ID of our actor
+			p.add(net.Uint16(c[0])) # The ID of our actor
 			p.add(net.Boolean(c[1] == -1)) # True if this is a special attack
 			if c[1] != -1: # Setting the bot's target
-				p.add(net.Uint8(c[1])) # The ID of the target entity
+				p.add(net.Uint16(c[1])) # The ID of the target entity
 		del self.commands[:]
 		
 		return p
@@ -1318,17 +1345,17 @@ class PlayerController(DroidController):
 			self.sprinting = net.Boolean.getFrom(iterator)
 			cmds = net.Uint8.getFrom(iterator)
 			for i in range(cmds):
-				id = net.Uint8.getFrom(iterator)
+				id = net.Uint16.getFrom(iterator)
 				entity = entityGroup.getEntity(id)
 				if entity == None: # Do nothing
 					if net.Boolean.getFrom(iterator):
-						net.Uint8.getFrom(iterator)
+						net.Uint16.getFrom(iterator)
 				else:
 					controller = entity.controller
 					if net.Boolean.getFrom(iterator):
 						controller.enableSpecial()
 					else:
-						target = entityGroup.getEntity(net.Uint8.getFrom(iterator))
+						target = entityGroup.getEntity(net.Uint16.getFrom(iterator))
 						if target == self.entity:
 							controller.setTarget(None)
 						else:
@@ -1395,6 +1422,9 @@ class AIController(DroidController):
 	
 	def pathCallback(self, path):
 		self.path = path
+	
+	def visibilityCallback(self, entityGroup, enemy, queue):
+		self.enemyLastVisible = queue.getNumEntries() > 0 and entityGroup.getEntityFromEntry(queue.getEntry(0)) == enemy
 
 	def serverUpdate(self, aiWorld, entityGroup, packetUpdate):
 		# PATH FIND UPDATE
@@ -1421,8 +1451,19 @@ class AIController(DroidController):
 			if target != None:
 				targetAiNode = aiWorld.navMesh.getNode(target.getPosition(), target.radius)
 				if (target.getPosition() - self.entity.getPosition()).length() > 10:
-					if (targetAiNode != None and aiNode != None) and (targetAiNode != self.lastTargetAiNode or (aiNode != self.lastAiNode and (aiNode not in self.path.nodes))):
-						ai.requestPath(self.pathCallback, aiNode, targetAiNode, self.entity.getPosition(), target.getPosition(), self.entity.radius + 0.5)
+					field = None
+					if self.entity.getTeam().isZombies and isinstance(target, entities.PlayerDroid) and targetAiNode != None:
+						# Survival zombies mostly chase the same one or two players, so they all follow one flow field per player.
+						field = aiWorld.getFlowField(target, targetAiNode)
+					if field != None and aiNode != None:
+						path = field.getPath(aiNode, self.entity.getPosition(), target.getPosition(), self.entity.radius + 0.5)
+						if path != None:
+							ai.cancelPath(self) # Don't let an older search replace this path
+							self.path = path
+					elif (targetAiNode != None and aiNode != None) and (targetAiNode != self.lastTargetAiNode or (aiNode != self.lastAiNode and (aiNode not in self.path.nodes))):
+						# Chasing a human player is what people actually see, so it goes first. Otherwise, closer targets go first.
+						priority = 0 if isinstance(target, entities.PlayerDroid) else (target.getPosition() - self.entity.getPosition()).length()
+						ai.requestPath(self.pathCallback, aiNode, targetAiNode, self.entity.getPosition(), target.getPosition(), self.entity.radius + 0.5, self, priority)
 				else:
 					self.path.clear()
 					self.path.end = target.getPosition() + Vec3(uniform(-12, 12), uniform(-12, 12), 0)
@@ -1480,7 +1521,9 @@ class AIController(DroidController):
 					vector.normalize()
 					if engine.clock.time - self.lastTargetCheck > 1.0:
 						self.lastTargetCheck = engine.clock.time
-						self.enemyLastVisible = entityGroup.getEntityFromEntry(aiWorld.getFirstCollision(self.entity.getPosition() + (vector * (self.entity.radius + 0.2)), vector)) == self.nearestEnemy
+						# The result can wait a frame, so this ray gets tested along with everyone else's.
+						enemy = self.nearestEnemy
+						aiWorld.queueRay(self.entity.getPosition() + (vector * (self.entity.radius + 0.2)), vector, lambda queue: self.visibilityCallback(entityGroup, enemy, queue))
 					if self.enemyLastVisible:
 						weapon.burstTimer = engine.clock.time
 						weapon.burstDelayTimer = -1
@@ -1514,6 +1557,10 @@ class AIController(DroidController):
 	
 	def clientUpdate(self, aiWorld, entityGroup, iterator = None):
 		DroidController.clientUpdate(self, aiWorld, entityGroup, iterator)
+	
+	def delete(self, killed = False):
+		ai.cancelPath(self)
+		DroidController.delete(self, killed)
 
 class Special(DirectObject):
 	def __init__(self, actor):
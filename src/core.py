@@ -17,6 +17,7 @@ import audio
 import online
 import net2
 import particles
+import profiler
 
 import gc
 from random import uniform, choice
@@ -34,6 +35,7 @@ class GameInfo(DirectObject): # Data structure containing game setup information
 		self.scoreLimit = 0
 		self.enableRespawn = True
 		self.type = DEATHMATCH
+		self.idBlock = 0
 	
 class Backend(DirectObject):
 	def __init__(self, username):
@@ -43,9 +45,11 @@ class Backend(DirectObject):
 		self.map = engine.Map()
 		self.aiWorld = ai.World()
 		self.netManager = net2.NetManager()
-		self.entityGroup = entities.EntityGroup(self.netManager)
+		self.entityIdBlock = 0 # Which block of networked entity IDs we hand out. 0 is the server's.
+		self.entityGroup = entities.EntityGroup(self.netManager, self.entityIdBlock)
 		self.game = None
 		self.lastGc = engine.clock.time
+		self.lastProfilerLog = engine.clock.time
 		self.scoreLimit = 3000
 		self.username = username
 		self.enableRespawn = True
@@ -64,12 +68,26 @@ class Backend(DirectObject):
 				gc.collect()
 				self.lastGc = engine.clock.time
 			if not engine.paused:
+				start = profiler.timer()
 				self.aiWorld.update()
+				profiler.record("aiWorld", start)
+				start = profiler.timer()
 				self.netManager.update(self)
+				profiler.record("netManager", start)
 			if self.entityGroup != None:
+				start = profiler.timer()
 				self.entityGroup.update()
+				profiler.record("entityGroup", start)
 			if self.map != None:
+				start = profiler.timer()
 				self.map.update()
+				profiler.record("map", start)
+			if engine.isDaemon and engine.clock.time - self.lastProfilerLog > profiler.LOG_INTERVAL:
+				self.lastProfilerLog = engine.clock.time
+				engine.log.info("Frame times: " + profiler.report())
+				engine.log.info("Network: " + self.netManager.getStats())
+				if self.aiWorld.navMesh != None:
+					engine.log.info("Path cache: " + self.aiWorld.navMesh.pathCache.report())
 
 	def loadMap(self, mapFile):
 		self.reset()
@@ -77,6 +95,8 @@ class Backend(DirectObject):
 			self.game.reset()
 		engine.log.info("Loading map: " + mapFile)
 		self.map.load(mapFile, self.aiWorld, self.entityGroup)
+		size = self.map.worldSize
+		net2.setWorldBounds(Vec3(-size, -size, -size), Vec3(size, size, size))
 		engine.log.info("Map loaded: " + self.map.filename)
 
 	def reset(self):
@@ -91,7 +111,8 @@ class Backend(DirectObject):
 		self.aiWorld = None
 		self.map = None
 		engine.clearLights()
-		self.entityGroup = entities.EntityGroup(self.netManager)
+		self.netManager.resetChannels()
+		self.entityGroup = entities.EntityGroup(self.netManager, self.entityIdBlock)
 		self.aiWorld = ai.World()
 		self.map = engine.Map()
 		self.matchNumber = 0
@@ -174,6 +195,12 @@ class ServerBackend(Backend):
 		self.numClients += 1 # Count ourselves as a client since we have a Game attached
 		self.clients.append(("127.0.0.1", 0)) # Reserve a spot here; we are our own client.
 	
+	def getClientTeam(self, address):
+		"Returns the team controlled by the client at the given address, or None."
+		if address in self.clients:
+			return self.entityGroup.teams[self.clients.index(address)]
+		return None
+	
 	def lobbyServerRegistrationCallback(self):
 		self.registrationConfirmed = True
 	
@@ -204,13 +231,13 @@ class ServerBackend(Backend):
 		p = net.Packet()
 		p.add(net.Uint8(net.PACKET_ENDMATCH))
 		p.add(net.Boolean(self.gameOver))
-		p.add(net.Uint8(winningTeam.getId()))
+		p.add(net.Uint16(winningTeam.getId()))
 		engine.log.info("Broadcasted match end packet.")
 		for team in self.entityGroup.teams:
 			team.lastMatchPosition = len([x for x in self.entityGroup.teams if x.score > team.score])
-			p.add(net.Uint8(team.getId()))
+			p.add(net.Uint16(team.getId()))
 			p.add(net.Uint8(team.lastMatchPosition))
-		net.context.broadcast(p)
+		self.netManager.sendReliable(p)
 		for team in self.entityGroup.teams:
 			team.resetScore() # Just in case some packets came in late after the match ended.
 		if self.game != None:
@@ -229,6 +256,9 @@ class ServerBackend(Backend):
 			team.resetScore()
 			for actor in team.actors:
 				actor.delete(self.entityGroup)
+			# Anything else the client spawned goes too, so its block of entity IDs is empty before another client gets it.
+			for entity in self.entityGroup.getEntitiesInIdBlock(teamId + 1):
+				entity.delete(self.entityGroup)
 			self.clients[self.clients.index(address)] = None
 			self.numClients -= 1
 		else:
@@ -236,15 +266,13 @@ class ServerBackend(Backend):
 	
 	def newConnectionCallback(self, client, username):
 		if not client in self.clients: # We may receive multiple "new client" packets. We need to ignore all but the first.
-			if self.numClients < len(self.entityGroup.teams):
+			slot = self.getFreeClientSlot() if self.numClients < len(self.entityGroup.teams) else None
+			if slot != None:
 				engine.log.info("New connection from " + username + " (" + net.addressToString(client) + ")")
 				messenger.send("chat-outgoing", ["Console", username + " connected."])
 				self.numClients += 1
-				if None in self.clients:
-					self.clients[self.clients.index(None)] = client
-				else:
-					self.clients.append(client)
-				team = self.entityGroup.teams[self.clients.index(client)]
+				self.clients[slot] = client
+				team = self.entityGroup.teams[slot]
 				team.setLocal(False)
 				team.setUsername(username)
 				net.context.addClient(client)
@@ -256,6 +284,17 @@ class ServerBackend(Backend):
 		else:
 			self.sendSetupPackets(client)
 	
+	def getFreeClientSlot(self):
+		"""Returns the index of a free client slot, or None if there isn't one.
+		A slot's block of entity IDs starts over at generation 0 for the next client, so a slot is held back while entities from its block are still around."""
+		for i in range(len(self.clients)):
+			if self.clients[i] == None and len(self.entityGroup.getEntitiesInIdBlock(i + 1)) == 0:
+				return i
+		if len(self.clients) < len(self.entityGroup.teams):
+			self.clients.append(None)
+			return len(self.clients) - 1
+		return None
+	
 	def sendSetupPackets(self, client):
 		engine.log.info("Constructing initialization packet for client " + net.addressToString(client))
 		net.context.send(self.makeSetupPacket(client), client)
@@ -263,16 +302,17 @@ class ServerBackend(Backend):
 	def makeSetupPacket(self, client):
 		p = net.Packet()
 		p.add(net.Uint8(net.PACKET_SETUP))
-		p.add(net.Uint8(self.entityGroup.teams[self.clients.index(client)].getId()))
+		p.add(net.Uint16(self.entityGroup.teams[self.clients.index(client)].getId()))
 		p.add(net.String(self.map.name))
 		p.add(net.Uint16(self.scoreLimit))
 		p.add(net.Boolean(self.enableRespawn))
 		p.add(net.Uint8(self.type))
+		p.add(net.Uint8(self.clients.index(client) + 1)) # Entity ID block
 		return p
 	
 	def clientReadyCallback(self, client):
 		engine.log.info("Client " + net.addressToString(client) + " completed loading. Sending spawn packets...")
-		net.context.send(self.makeUberSpawnPacket(), client)
+		self.netManager.sendReliable(self.makeUberSpawnPacket(), client)
 	
 	def makeUberSpawnPacket(self):
 		p = net.Packet()
@@ -415,9 +455,9 @@ class ClientBackend(Backend):
 		self.matchNumber += 1
 		try:
 			self.gameOver = net.Boolean.getFrom(iterator)
-			winningTeam = self.entityGroup.getEntity(net.Uint8.getFrom(iterator))
+			winningTeam = self.entityGroup.getEntity(net.Uint16.getFrom(iterator))
 			for i in range(len(self.entityGroup.teams)):
-				id = net.Uint8.getFrom(iterator)
+				id = net.Uint16.getFrom(iterator)
 				team = self.entityGroup.getEntity(id)
 				pos = net.Uint8.getFrom(iterator)
 				if team != None:
@@ -507,12 +547,14 @@ class Game(DirectObject):
 	def gameInfoCallback(self, iterator):
 		engine.log.info("Processing game setup information...")
 		info = GameInfo()
-		info.teamId = net.Uint8.getFrom(iterator) # Find out which team we are on this computer
+		info.teamId = net.Uint16.getFrom(iterator) # Find out which team we are on this computer
 		info.mapFile = net.String.getFrom(iterator) # Map filename
 		info.scoreLimit = net.Uint16.getFrom(iterator) # Score limit
 		info.enableRespawn = net.Boolean.getFrom(iterator) # Whether we should respawn our local player
 		info.type = net.Uint8.getFrom(iterator) # Game type
+		info.idBlock = net.Uint8.getFrom(iterator) # Block of entity IDs we hand out
 		self.localTeamID = info.teamId
+		self.backend.entityIdBlock = info.idBlock
 		self.backend.loadMap(info.mapFile)
 		self.backend.scoreLimit = info.scoreLimit
 		self.backend.enableRespawn = info.enableRespawn
@@ -1,10 +1,12 @@
 import ai
 import controllers
+import components
 import entities
 import ui
 import net
 import audio
 import particles
+import profiler
 import traceback
 
 from direct.showbase.DirectObject import DirectObject
@@ -210,6 +212,7 @@ def init(showFrameRate = False, daemon = False):
 	renderObjects = renderLit.attachNewNode("renderObjects")
 	renderEnvironment = renderLit.attachNewNode("renderEnvironment")
 	controllers.init()
+	components.init()
 	ai.init()
 	audio.init(dropOffFactor = 1.4, distanceFactor = 14, dopplerFactor = 0.0)
 	numMaxDynamicLights = 0
@@ -321,8 +324,10 @@ def update():
 		clock.update()
 	else:
 		clock.timeStep = 0
+	start = profiler.timer()
 	particles.ParticleGroup.begin()
 	particles.update(not paused)
+	profiler.record("particles", start)
 
 def endUpdate():
 	particles.ParticleGroup.end()
@@ -340,10 +345,19 @@ class Clock:
 		self._time = self.timerFunction()
 		self.timeStep = 0
 		self.lastFrameTime = self.time
+		self.fixedTimeStep = None
+	
+	def setFixedTimeStep(self, step):
+		"Makes every frame advance the clock by exactly the given step, regardless of real time. Pass None to follow real time again."
+		self.fixedTimeStep = step
 		
 	def update(self):
 		"Call once every frame."
 		self.lastFrameTime = self.time
+		if self.fixedTimeStep != None:
+			self._time += self.fixedTimeStep
+			self.timeStep = self.fixedTimeStep
+			return
 		self._time = self.timerFunction()
 		self.timeStep = min(0.1, max(0.005, self.time - self.lastFrameTime))
 	
@@ -1,6 +1,7 @@
 from direct.showbase.DirectObject import DirectObject
 from pandac.PandaModules import *
 from random import random, uniform
+from collections import deque
 import math
 import engine
 import components
@@ -10,11 +11,135 @@ import net
 import net2
 import particles
 
+ENTITY_SLOT_BITS = 12 # Low bits of a networked entity ID. The high four bits are the slot's generation.
+ENTITY_GENERATIONS = 16
+SERVER_ID_SLOTS = 2048 # Slots handed out by the server
+CLIENT_ID_SLOTS = 128 # Slots handed out by each client, in blocks after the server's, so no two machines hand out the same ID
+LOCAL_ID_OFFSET = 65536 # Local-only entities (fragments and other debris) get IDs above the 16-bit networked range
+
+def getIdBlock(id):
+	"Returns the block of networked IDs the given entity ID came from. 0 is the server's. Local IDs don't belong to a block, so they return None."
+	if id >= LOCAL_ID_OFFSET:
+		return None
+	slot = id & ((1 << ENTITY_SLOT_BITS) - 1)
+	if slot < SERVER_ID_SLOTS:
+		return 0
+	return (slot - SERVER_ID_SLOTS) / CLIENT_ID_SLOTS + 1
+
+class EntityIdAllocator:
+	"""Hands out entity IDs from a range of slots in constant time.
+	Freed slots go to the back of a queue. Each time a slot is reused, its generation goes up,
+	so late packets about the entity that used to have the slot don't match the new one."""
+	def __init__(self, firstSlot, numSlots, slotBits = ENTITY_SLOT_BITS, generations = ENTITY_GENERATIONS, offset = 0):
+		self.firstSlot = firstSlot
+		self.endSlot = firstSlot + numSlots
+		self.slotBits = slotBits
+		self.generations = generations
+		self.offset = offset
+		self.nextSlot = firstSlot # Slots from here on have never been used
+		self.freeSlots = deque()
+		self.slotGenerations = dict() # Slot -> current generation
+	
+	def allocate(self):
+		"Returns an unused ID, or None if every slot is taken."
+		if len(self.freeSlots) > 0:
+			slot = self.freeSlots.popleft()
+		elif self.nextSlot < self.endSlot:
+			slot = self.nextSlot
+			self.nextSlot += 1
+			self.slotGenerations[slot] = 0
+		else:
+			return None
+		return self.offset + (self.slotGenerations[slot] << self.slotBits) + slot
+	
+	def release(self, id):
+		"Returns the given ID's slot to the queue. IDs this allocator didn't hand out are ignored."
+		id -= self.offset
+		if id < 0:
+			return
+		slot = id & ((1 << self.slotBits) - 1)
+		generation = id >> self.slotBits
+		if self.slotGenerations.get(slot) == generation and slot < self.nextSlot:
+			self.slotGenerations[slot] = (generation + 1) % self.generations
+			self.freeSlots.append(slot)
+
+class SpatialGrid:
+	"""Buckets ObjectEntities into square cells on the XY plane for fast proximity queries.
+	EntityGroup rebuilds the grid at most once per frame, the first time it's queried."""
+	def __init__(self, cellSize = 16.0):
+		self.cellSize = cellSize
+		self.cells = dict() # (x, y) cell coordinates -> list of entities
+		self.bounds = None # (minX, minY, maxX, maxY) of occupied cells
+		self.lastRefresh = None
+	
+	def _getCell(self, pos):
+		return (int(math.floor(pos.getX() / self.cellSize)), int(math.floor(pos.getY() / self.cellSize)))
+	
+	def refresh(self, entities):
+		self.cells = dict()
+		self.bounds = None
+		for entity in (x for x in entities if x.active and isinstance(x, ObjectEntity)):
+			pos = entity.getPosition()
+			if pos.isNan():
+				continue
+			cell = self._getCell(pos)
+			if cell in self.cells:
+				self.cells[cell].append(entity)
+			else:
+				self.cells[cell] = [entity]
+			if self.bounds == None:
+				self.bounds = (cell[0], cell[1], cell[0], cell[1])
+			else:
+				self.bounds = (min(self.bounds[0], cell[0]), min(self.bounds[1], cell[1]), max(self.bounds[2], cell[0]), max(self.bounds[3], cell[1]))
+		self.lastRefresh = engine.clock.time
+	
+	def invalidate(self):
+		self.lastRefresh = None
+	
+	def getEntitiesInRadius(self, pos, radius):
+		"Returns all active entities whose position is within the given radius of pos."
+		results = []
+		minCell = self._getCell(pos - Vec3(radius, radius, 0))
+		maxCell = self._getCell(pos + Vec3(radius, radius, 0))
+		for x in range(minCell[0], maxCell[0] + 1):
+			for y in range(minCell[1], maxCell[1] + 1):
+				for entity in self.cells.get((x, y), []):
+					if entity.active and (entity.getPosition() - pos).length() < radius:
+						results.append(entity)
+		return results
+	
+	def getNearest(self, pos, test):
+		"""Returns the active entity closest to pos for which test(entity) is true, or None.
+		Searches outward one ring of cells at a time, stopping once no closer entity is possible."""
+		if self.bounds == None:
+			return None
+		center = self._getCell(pos)
+		maxRing = max(abs(center[0] - self.bounds[0]), abs(center[0] - self.bounds[2]), abs(center[1] - self.bounds[1]), abs(center[1] - self.bounds[3]))
+		closest = None
+		closestDist = -1
+		for ring in range(maxRing + 1):
+			# Everything in this ring is at least (ring - 1) cells away
+			if closest != None and closestDist <= (ring - 1) * self.cellSize:
+				break
+			for x in range(center[0] - ring, center[0] + ring + 1):
+				if x == center[0] - ring or x == center[0] + ring:
+					ys = range(center[1] - ring, center[1] + ring + 1)
+				else:
+					ys = (center[1] - ring, center[1] + ring)
+				for y in ys:
+					for entity in self.cells.get((x, y), []):
+						if entity.active and test(entity):
+							dist = (entity.getPosition() - pos).length()
+							if dist < closestDist or closestDist == -1:
+								closest = entity
+								closestDist = dist
+		return closest
+
 class EntityGroup(DirectObject):
 	"""An entity group handles all the logistics of Entities and Impostors.
 	The entity group actually steps the ODE world and space in the AI world, and it updates all the controllers as well."""
 	default = None
-	def __init__(self, netManager):
+	def __init__(self, netManager, idBlock = 0):
 		self.entities = dict()
 		self.graphicsObjects = []
 		self.deletedEntities = []
@@ -26,6 +151,13 @@ class EntityGroup(DirectObject):
 		self.cameraShakeTime = 0.9
 		self.manager = netManager
 		self.teams = []
+		self.grid = SpatialGrid()
+		# Block 0 is the server's. Each client gets its own block of networked IDs.
+		if idBlock == 0:
+			self.networkedIds = EntityIdAllocator(0, SERVER_ID_SLOTS)
+		else:
+			self.networkedIds = EntityIdAllocator(SERVER_ID_SLOTS + (idBlock - 1) * CLIENT_ID_SLOTS, CLIENT_ID_SLOTS)
+		self.localIds = EntityIdAllocator(0, LOCAL_ID_OFFSET, slotBits = 16, generations = 1, offset = LOCAL_ID_OFFSET)
 		EntityGroup.default = self
 		TeamEntity.default = TeamEntity()
 
@@ -42,7 +174,7 @@ class EntityGroup(DirectObject):
 		self.clearDeletedEntities()
 
 	def getEntity(self, id):
-		"Gets the ObjectEntity associated with the given NodePath (which has a unique 8-bit identifier). Returns None if no ObjectEntity has the given NodePath."
+		"Gets the ObjectEntity associated with the given NodePath (which has a unique numeric identifier). Returns None if no ObjectEntity has the given NodePath."
 		try:
 			i = int(id)
 		except ValueError:
@@ -78,6 +210,7 @@ class EntityGroup(DirectObject):
 		if isinstance(entity, ObjectEntity):
 			entity.node.reparentTo(engine.renderObjects)
 		self.entities[entity.getId()] = entity
+		self.grid.invalidate()
 	
 	def removeEntity(self, entity):
 		"Removes the ObjectEntity from the entity list. Also schedules the ObjectEntity's resources to be cleared, as soon as possible."
@@ -85,18 +218,21 @@ class EntityGroup(DirectObject):
 		if entity.getId() in self.entities:
 			self.deletedEntities.append(entity)
 	
-	# offset is used to ensure Fragments and other local-only entities don't interfere
+	# local is used to ensure Fragments and other local-only entities don't interfere
 	# with IDs from server-client synched entities.
-	def generateEntityId(self, entity, offset = 0):
-		id = offset + int(round(random() * 255))
-		while id in self.entities:
-			id = offset + int(round(random() * 255))
+	def generateEntityId(self, entity, local = False):
+		allocator = self.localIds if local else self.networkedIds
+		id = allocator.allocate()
+		if id == None:
+			raise RuntimeError("Out of " + ("local" if local else "networked") + " entity IDs")
 		entity.setId(id)
 	
 	def clearDeletedEntities(self):
 		for entity in self.deletedEntities:
 			if entity.getId() in self.entities:
 				del self.entities[entity.getId()]
+				self.networkedIds.release(entity.getId())
+				self.localIds.release(entity.getId())
 			entity.clear(self)
 		del self.deletedEntities[:]
 	
@@ -109,15 +245,25 @@ class EntityGroup(DirectObject):
 		if obj in self.graphicsObjects:
 			self.graphicsObjects.remove(obj)
 	
+	def getSpatialGrid(self):
+		"Returns the spatial index of all active ObjectEntities, rebuilding it if it hasn't been refreshed this frame."
+		if self.grid.lastRefresh != engine.clock.time:
+			self.grid.refresh(self.entities.values())
+		return self.grid
+	
+	def getNearest(self, pos, test):
+		"Gets the closest active ObjectEntity to the given position for which test(entity) is true."
+		return self.getSpatialGrid().getNearest(pos, test)
+	
+	def getEntitiesInRadius(self, pos, radius):
+		return self.getSpatialGrid().getEntitiesInRadius(pos, radius)
+	
 	def getNearestPhysicsEntity(self, pos):
-		closest = None
-		closestDist = 1000000
-		for entity in (x for x in self.entities.values() if isinstance(x, PhysicsEntity)):
-			dist = (entity.getPosition() - pos).length()
-			if dist < closestDist:
-				closest = entity
-				closestDist = dist
-		return closest
+		return self.getNearest(pos, lambda x: isinstance(x, PhysicsEntity))
+	
+	def getEntitiesInIdBlock(self, idBlock):
+		"Returns every entity, deleted or not, that hasn't been cleared yet and has an ID from the given block."
+		return [x for x in self.entities.values() if getIdBlock(x.getId()) == idBlock]
 
 	def resetMatch(self):
 		for entity in (x for x in self.entities.values() if isinstance(x, Actor) or isinstance(x, Fragment)):
@@ -155,7 +301,7 @@ class EntityGroup(DirectObject):
 		particles.add(particles.SparkParticleGroup(position, numParticles = 500, speed = damageRadius * 2.5, lifeTime = 1.0, size = 6.0))
 		particles.add(particles.ExplosionParticleGroup(position))
 		
-		for entity in (entity for entity in self.entities.values() if entity != sourceEntity and isinstance(entity, ObjectEntity)):
+		for entity in (entity for entity in self.getEntitiesInRadius(position, damageRadius) if entity != sourceEntity):
 			vector = entity.getPosition() - position
 			distance = vector.length()
 			if distance >= damageRadius or distance == 0:
@@ -379,7 +525,7 @@ class DropPod(ObjectEntity):
 				offset = Vec3(uniform(-1, 1), uniform(-1, 1), uniform(0, 1))
 				offset.normalize()
 				fragment = Fragment(aiWorld.world, aiWorld.space, position + (offset * 1.5), offset * 30)
-				entityGroup.generateEntityId(fragment, 1024)
+				entityGroup.generateEntityId(fragment, local = True)
 				entityGroup.addEntity(fragment)
 		ObjectEntity.kill(self, aiWorld, entityGroup, localDelete)
 
@@ -483,7 +629,7 @@ class Glass(ObjectEntity):
 		for _ in range(40):
 			offset = Vec3(uniform(-self.glassWidth / 2.0, self.glassWidth / 2.0), 0, uniform(-self.glassHeight / 2.0, self.glassHeight / 2.0))
 			fragment = GlassFragment(aiWorld.world, aiWorld.space, render.getRelativePoint(self.node, offset), Vec3())
-			entityGroup.generateEntityId(fragment, 1024)
+			entityGroup.generateEntityId(fragment, local = True)
 			entityGroup.addEntity(fragment)
 		ObjectEntity.kill(self, aiWorld, entityGroup, localDelete)
 
@@ -4,8 +4,11 @@ import os
 import zlib
 import time
 import sys
+import struct
+import threading
 
 from socket import *
+from Queue import Queue, Empty, Full
 
 netMode = 0
 
@@ -26,9 +29,9 @@ PACKET_SERVERFULL = 8 # Server can't take any more clients
 PACKET_CHAT = 9 # Chat data
 PACKET_EMPTY = 10 # No data. Used for establishing and maintaining connections
 PACKET_CLIENTREADY = 11 # Client is done loading
-PACKET_ENTITYCHECKSUM = 12 # Packet contains the number of currently active entities
-PACKET_REQUESTENTITYLIST = 13 # Client has the wrong number of active entities, so it needs a full list of IDs
-PACKET_ENTITYLIST = 14 # Packet contains a list of active entity IDs
+PACKET_ENTITYCHECKSUM = 12 # Packet contains a hash of the active entity IDs in each bucket
+PACKET_REQUESTENTITYLIST = 13 # Client's hashes don't match for some buckets, so it needs the IDs in those buckets. Contains a bitfield of the buckets.
+PACKET_ENTITYLIST = 14 # Packet contains the bucket bitfield and the active entity IDs in those buckets
 
 # For communication with lobby server
 PACKET_REQUESTHOSTLIST = 15 # Client requesting the host list from the lobby server
@@ -38,6 +41,18 @@ PACKET_NEWCLIENTNOTIFICATION = 18 # Lobby server notifying the server that a new
 PACKET_CLIENTCONNECTNOTIFICATION = 19 # Client notifying lobby server of its intention to connect to a host
 PACKET_CONFIRMREGISTER = 20 # Lobby server confirms host registration
 
+# Snapshot replication
+PACKET_SNAPSHOT = 21 # Server tick header. Contains the snapshot sequence number
+PACKET_SNAPSHOTACK = 22 # Client acknowledges the last snapshot it received
+PACKET_DELTACONTROLLER = 23 # Controller update, delta-compressed against an acknowledged snapshot
+
+# Reliable ordered channel
+PACKET_RELIABLE = 24 # A message on the reliable channel. Contains the channel epoch, sequence number and message data
+PACKET_RELIABLEACK = 25 # Acknowledges reliable messages. Contains the channel epoch, cumulative ack and selective ack bitfield
+
+# Relaying
+PACKET_RELAYED = 26 # A client packet the server merged into its snapshot. Contains the data length and the data
+
 # Spawn types
 SPAWN_PLAYER = 0
 SPAWN_BOT = 1
@@ -54,11 +69,42 @@ MODE_CLIENT = 1
 
 SERVER_TICK = 0.03 # Transfer update packets 20 times per second
 
+READ_QUEUE_SIZE = 1024 # Received datagrams waiting for the game loop. Datagrams arriving when this is full are dropped.
+WRITE_QUEUE_SIZE = 1024 # Datagrams waiting for the write thread. Datagrams sent when this is full are dropped.
+
+# Transport layer. Every datagram on the wire starts with a code byte: one of these transport types, plus a compression type.
+TRANSPORT_WHOLE = 0 # The rest of the datagram is a complete message
+TRANSPORT_FRAGMENT = 1 # The datagram is one piece of a message too big for the MTU
+TRANSPORT_MASK = 1
+COMPRESSION_NONE = 0 # The message is sent as-is
+COMPRESSION_DEFLATE = 2 # The message is raw deflate data, compressed against the preset dictionary
+COMPRESSION_MASK = 2
+COMPRESSION_THRESHOLD = 48 # Messages shorter than this (keepalives, acks) are never compressed. Deflate rarely saves enough on them to be worth the CPU.
+COMPRESSION_LEVEL = 6
+MTU = 1200 # Largest datagram we send. Keeps us under the typical 1500 byte Ethernet MTU, with room for IP/UDP headers.
+FRAGMENT_TIMEOUT = 2.0 # Seconds to wait for the rest of a fragmented message
+fragmentHeader = struct.Struct("<BHBB") # Transport code, message ID, fragment index, fragment count
+
 if sys.platform == "win32":
 	timeFunction = time.clock
 else:
 	timeFunction = time.time
 
+def buildCompressionDictionary():
+	"""Returns the preset dictionary messages are compressed against. Both ends must build the same one.
+	It holds byte sequences that show up in most ticks: the headers of snapshot and controller packets, and runs of zero and 0xff bytes
+	from small quantized values and component terminators. Deflate encodes closer matches more cheaply, so the most common sequences go last."""
+	parts = ["Unnamed", "\xff" * 16, "\x00" * 32]
+	for id in range(32):
+		parts.append(chr(PACKET_DELTACONTROLLER) + struct.pack("<H", id))
+	for id in range(32):
+		parts.append(chr(PACKET_CONTROLLER) + struct.pack("<H", id) + "\x00")
+	parts.append(chr(PACKET_ENTITYCHECKSUM))
+	parts.append(chr(PACKET_SNAPSHOT))
+	return "".join(parts)
+
+compressionDictionary = buildCompressionDictionary()
+
 clientLimit = 0 # Number of clients we can accept
 
 datagramType = None # If we're using Panda3D, this should be set to PyDatagram.
@@ -103,7 +149,7 @@ class PythonNetContext(NetworkContext):
 		self.port = localPort
 		self.socket = socket(AF_INET, SOCK_DGRAM)
 		self.bindSocket(localPort)
-		self.socket.setblocking(0)
+		self.socket.settimeout(0.5) # So the I/O threads notice when we shut down
 		self.clientConnected = False
 		self.activeConnections = dict() # Server only - connected clients
 		self.hostConnection = Connection() # Client only - connection to server
@@ -114,6 +160,132 @@ class PythonNetContext(NetworkContext):
 		self.clientUsername = "Unnamed"
 		self.lastConnectionAttempt = 0
 		self.connectionAttempts = 0
+		# Socket reads, writes and (de)compression happen on background threads
+		self.running = True
+		self.readQueue = Queue(READ_QUEUE_SIZE) # (message, address) tuples, already decompressed
+		self.sendQueue = Queue(WRITE_QUEUE_SIZE) # (message, list of addresses) tuples, not yet compressed
+		self.statsLock = threading.Lock()
+		self.sentPackets = 0
+		self.sentBytes = 0
+		self.droppedPackets = 0
+		self.mtu = MTU
+		self.nextMessageId = 0 # Write thread only
+		self.fragments = dict() # Read thread only - (address, message ID) -> [fragment count, index -> data, time of first fragment]
+		self.lastFragmentCleanup = timeFunction()
+		# Python 2's zlib has no preset dictionary support, so we run the dictionary through a compressor and a decompressor once,
+		# and start every message from a copy of their state. Raw deflate, so there's no zlib header or checksum either.
+		self.compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS) # Write thread only
+		primer = self.compressor.compress(compressionDictionary) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+		self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS) # Read thread only
+		self.decompressor.decompress(primer)
+		for worker in [self.readWorker, self.writeWorker]:
+			thread = threading.Thread(target = worker)
+			thread.setDaemon(True)
+			thread.start()
+	
+	def compress(self, message):
+		"Returns the compression type and the data to send. Short messages, and ones deflate can't shrink, go out as they are."
+		if len(message) < COMPRESSION_THRESHOLD:
+			return COMPRESSION_NONE, message
+		compressor = self.compressor.copy()
+		data = compressor.compress(message) + compressor.flush()
+		if len(data) >= len(message):
+			return COMPRESSION_NONE, message
+		return COMPRESSION_DEFLATE, data
+	
+	def decompress(self, compression, data):
+		if compression == COMPRESSION_NONE:
+			return data
+		decompressor = self.decompressor.copy()
+		return decompressor.decompress(data) + decompressor.flush()
+	
+	def fragment(self, compression, message):
+		"Splits a message into datagrams no bigger than the MTU, each starting with a transport header."
+		if len(message) + 1 <= self.mtu:
+			return [chr(TRANSPORT_WHOLE | compression) + message]
+		size = self.mtu - fragmentHeader.size
+		count = (len(message) + size - 1) / size
+		if count > 255:
+			return [] # Too big to send at all
+		messageId = self.nextMessageId
+		self.nextMessageId = (self.nextMessageId + 1) % 65536
+		return [fragmentHeader.pack(TRANSPORT_FRAGMENT | compression, messageId, i, count) + message[i * size:(i + 1) * size] for i in range(count)]
+	
+	def reassemble(self, datagram, address):
+		"Strips the transport header. Returns the compression type and the complete message, or None if we're still waiting on fragments."
+		code = ord(datagram[0])
+		if code & TRANSPORT_MASK == TRANSPORT_WHOLE:
+			return code & COMPRESSION_MASK, datagram[1:]
+		if len(datagram) < fragmentHeader.size:
+			return None
+		code, messageId, index, count = fragmentHeader.unpack_from(datagram)
+		if index >= count:
+			return None
+		key = (address, messageId)
+		entry = self.fragments.get(key)
+		if entry == None or entry[0] != count:
+			entry = [count, dict(), timeFunction()]
+			self.fragments[key] = entry
+		entry[1][index] = datagram[fragmentHeader.size:]
+		if len(entry[1]) < count:
+			return None
+		del self.fragments[key]
+		return code & COMPRESSION_MASK, "".join([entry[1][i] for i in range(count)])
+	
+	def readWorker(self):
+		while self.running:
+			if timeFunction() - self.lastFragmentCleanup > FRAGMENT_TIMEOUT:
+				self.lastFragmentCleanup = timeFunction()
+				for key in [key for key, entry in self.fragments.items() if self.lastFragmentCleanup - entry[2] > FRAGMENT_TIMEOUT]:
+					del self.fragments[key]
+			try:
+				datagram, address = self.socket.recvfrom(65536)
+			except timeout:
+				continue
+			except error:
+				if not self.running:
+					break
+				continue # On Windows, an unreachable peer shows up as an error on the next read
+			if len(datagram) == 0:
+				continue
+			message = self.reassemble(datagram, address)
+			if message == None:
+				continue
+			try:
+				message = self.decompress(*message)
+			except zlib.error:
+				continue
+			try:
+				self.readQueue.put_nowait((message, address))
+			except Full:
+				self.statsLock.acquire()
+				self.droppedPackets += 1
+				self.statsLock.release()
+	
+	def writeWorker(self):
+		while self.running:
+			item = self.sendQueue.get()
+			if item == None: # Shutdown
+				self.sendQueue.task_done()
+				break
+			message, addresses = item
+			datagrams = self.fragment(*self.compress(message))
+			size = sum([len(x) for x in datagrams])
+			sent = 0
+			for address in addresses:
+				try:
+					for datagram in datagrams:
+						self.socket.sendto(datagram, address)
+					sent += 1
+				except error:
+					pass
+			self.statsLock.acquire()
+			self.sentPackets += sent * len(datagrams)
+			self.sentBytes += sent * size
+			if len(datagrams) == 0:
+				self.droppedPackets += len(addresses)
+			self.statsLock.release()
+			self.sendQueue.task_done()
 	
 	def connectToServer(self, arg, username):
 		global netMode
@@ -189,35 +361,42 @@ class PythonNetContext(NetworkContext):
 			connection.ready = False
 	
 	def writeTick(self):
+		"""Hands everything in the write queue to the write thread.
+		Returns the number of datagrams and bytes the write thread has sent since the last call, and the number of datagrams dropped in either direction."""
 		for data in self.writeQueue:
 			# data[0] = action code. 0 for broadcast or broadcastExcept. 1 for send.
 			# for broadcasting, the given connection is excluded, if one is given.
 			# for sending, the given connection is the only one we send the data to.
-			compressedData = zlib.compress(data[1].getMessage())
+			addresses = []
 			if data[0] == 0: # Broadcast
 				for c in (x for x in self.activeConnections.values() if x.ready):
 					c.lastSentPacketTime = timeFunction()
-					try:
-						self.socket.sendto(compressedData, c.address)
-					except error:
-						pass
+					addresses.append(c.address)
 			elif data[0] == 1: # Send to specific machine
-				try:
-					self.socket.sendto(compressedData, data[2])
-				except error:
-					pass
+				addresses.append(data[2])
 				if data[2] in self.activeConnections:
 					self.activeConnections[data[2]].lastSentPacketTime = timeFunction()
 				elif compareAddresses(data[2], self.hostConnection.address):
 					self.hostConnection.lastSentPacketTime = timeFunction()
 			elif data[0] == 2: # Broadcast, excluding one machine
 				for c in (x for x in self.activeConnections.values() if x.ready and not compareAddresses(x.address, data[2])):
-					try:
-						self.socket.sendto(compressedData, c.address)
-					except error:
-						pass
+					addresses.append(c.address)
 					c.lastSentPacketTime = timeFunction()
+			if len(addresses) > 0:
+				try:
+					self.sendQueue.put_nowait((data[1].getMessage(), addresses))
+				except Full:
+					self.statsLock.acquire()
+					self.droppedPackets += 1
+					self.statsLock.release()
 		del self.writeQueue[:]
+		self.statsLock.acquire()
+		stats = (self.sentPackets, self.sentBytes, self.droppedPackets)
+		self.sentPackets = 0
+		self.sentBytes = 0
+		self.droppedPackets = 0
+		self.statsLock.release()
+		return stats
 
 	def readTick(self):
 		if self.mode == MODE_SERVER:
@@ -245,14 +424,11 @@ class PythonNetContext(NetworkContext):
 		readQueue = []
 		while True:
 			try:
-				message, address = self.socket.recvfrom(1024)
-			except error:
+				message, address = self.readQueue.get_nowait()
+			except Empty:
 				return readQueue
-			if len(message) == 0:
-				continue
 			if address in self.activeConnections:
 				self.activeConnections[address].lastPacketTime = timeFunction()
-			message = zlib.decompress(message)
 			iterator = CustomDatagram(message)
 			if iterator.getRemainingSize() < 1:
 				continue
@@ -328,6 +504,9 @@ class PythonNetContext(NetworkContext):
 		p.addTo(data)
 		self.broadcastDatagram(data)
 		self.writeTick()
+		self.sendQueue.join() # Wait for the write thread to send everything
+		self.running = False
+		self.sendQueue.put(None) # Wakes the write thread so it can exit
 		time.sleep(0.25)
 		self.socket.close()
 	
@@ -379,34 +558,93 @@ class Packet:
 	def addTo(self, datagram):
 		for dataObject in self.dataObjects:
 			dataObject.addTo(datagram)
+	def addFieldsTo(self, datagram, offsets):
+		"Same as addTo, but records the length of the datagram after each individual field."
+		for dataObject in self.dataObjects:
+			if isinstance(dataObject, Packet):
+				dataObject.addFieldsTo(datagram, offsets)
+			else:
+				dataObject.addTo(datagram)
+				offsets.append(datagram.getLength())
+
+# Precompiled little-endian formats, matching Panda3D's datagram encoding
+formatInt8 = struct.Struct("<b")
+formatUint8 = struct.Struct("<B")
+formatInt16 = struct.Struct("<h")
+formatUint16 = struct.Struct("<H")
+formatUint32 = struct.Struct("<I")
+formatFloat32 = struct.Struct("<f")
 
 class CustomDatagram:
+	"""Pure Python stand-in for Panda3D's PyDatagram and PyDatagramIterator.
+	Writes are buffered in a list of strings. Reads unpack directly from the message at a cursor position, so nothing gets copied until a string is extracted."""
 	def __init__(self, x = ""):
-		self.data = x
+		self.chunks = [x]
+		self.length = len(x)
+		self.message = x # Joined chunks; None if there's been a write since the last join
+		self.offset = 0 # Read cursor
+	def appendData(self, x):
+		self.chunks.append(x)
+		self.length += len(x)
+		self.message = None
+	def _add(self, format, x):
+		self.appendData(format.pack(x))
+	def _get(self, format):
+		value = format.unpack_from(self.getMessage(), self.offset)[0]
+		self.offset += format.size
+		return value
+	def addInt8(self, x):
+		self._add(formatInt8, x)
+	def getInt8(self):
+		return self._get(formatInt8)
 	def addUint8(self, x):
-		self.data += chr(x)
+		self._add(formatUint8, x)
 	def getUint8(self):
-		value = ord(self.data[0])
-		self.data = self.data[1:]
-		return value
+		return self._get(formatUint8)
+	def addInt16(self, x):
+		self._add(formatInt16, x)
+	def getInt16(self):
+		return self._get(formatInt16)
 	def addUint16(self, x):
-		self.data += chr(x % 256) + chr(int(x) / 256)
+		self._add(formatUint16, int(x))
 	def getUint16(self):
-		value = ord(self.data[0]) + ord(self.data[1]) * 256
-		self.data = self.data[2:]
-		return value
+		return self._get(formatUint16)
+	def addUint32(self, x):
+		self._add(formatUint32, x)
+	def getUint32(self):
+		return self._get(formatUint32)
+	def addFloat32(self, x):
+		self._add(formatFloat32, x)
+	def getFloat32(self):
+		return self._get(formatFloat32)
+	def addBool(self, x):
+		self._add(formatUint8, 1 if x else 0)
+	def getBool(self):
+		return self._get(formatUint8) != 0
 	def addString(self, x):
 		self.addUint16(len(x))
-		self.data += x
+		self.appendData(x)
 	def getString(self):
-		length = self.getUint16()
-		value = self.data[:length]
-		self.data = self.data[length:]
+		return self.extractBytes(self.getUint16())
+	def extractBytes(self, length):
+		if self.offset + length > self.length:
+			raise struct.error("Not enough data remaining in datagram")
+		value = self.getMessage()[self.offset:self.offset + length]
+		self.offset += length
 		return value
+	def skipBytes(self, length):
+		if self.offset + length > self.length:
+			raise struct.error("Not enough data remaining in datagram")
+		self.offset += length
 	def getRemainingSize(self):
-		return len(self.data)
+		return self.length - self.offset
+	def getLength(self):
+		return self.length
 	def getMessage(self):
-		return self.data
+		if self.message == None:
+			self.message = "".join(self.chunks)
+			self.chunks = [self.message]
+		return self.message
 
 def clamp(a, min, max):
 	if min <= a <= max:
@@ -417,6 +655,7 @@ def clamp(a, min, max):
 
 class Object:
 		data = None
+		format = None # struct format characters. Types with a fixed-size format can be compiled into a Schema.
 		def __init__(self, data):
 			self.data = data
 		def addTo(self, datagram):
@@ -424,49 +663,100 @@ class Object:
 		@staticmethod
 		def getFrom(iterator):
 			pass
+		@staticmethod
+		def encode(data):
+			"Converts a value into the tuple of raw values that format packs."
+			return (data,)
+		@staticmethod
+		def decode(values, index):
+			"Builds a value out of the raw values starting at the given index."
+			return values[index]
+class FixedSizeObject(Object):
+	"""Base for multi-component types with a fixed-size format.
+	addTo and getFrom pack and unpack all components in one struct call, without a wrapper object per component."""
+	@classmethod
+	def getStruct(cls):
+		if not "packer" in cls.__dict__:
+			cls.packer = struct.Struct("<" + cls.format)
+		return cls.packer
+	def addTo(self, datagram):
+		datagram.appendData(self.getStruct().pack(*self.encode(self.data)))
+	@classmethod
+	def getFrom(cls, iterator):
+		packer = cls.getStruct()
+		return cls.decode(packer.unpack(iterator.extractBytes(packer.size)), 0)
 class HighResFloat(Object):
+	format = "f"
 	def addTo(self, datagram):
 		datagram.addFloat32(self.data)
 	@staticmethod
 	def getFrom(iterator):
 		return iterator.getFloat32()
 class StandardFloat(Object):
+	format = "h"
 	def addTo(self, datagram):
 		datagram.addInt16(clamp(int(self.data * 110.0), -32768, 32767))
 	@staticmethod
 	def getFrom(iterator):
 		return float(iterator.getInt16()) / 110.0
+	@staticmethod
+	def encode(data):
+		return (clamp(int(data * 110.0), -32768, 32767),)
+	@staticmethod
+	def decode(values, index):
+		return float(values[index]) / 110.0
 class LowResFloat(Object):
+	format = "h"
 	def addTo(self, datagram):
 		datagram.addInt16(clamp(int(self.data * 50.0), -32768, 32767))
 	@staticmethod
 	def getFrom(iterator):
 		return float(iterator.getInt16()) / 50.0
+	@staticmethod
+	def encode(data):
+		return (clamp(int(data * 50.0), -32768, 32767),)
+	@staticmethod
+	def decode(values, index):
+		return float(values[index]) / 50.0
 class SmallFloat(Object):
+	format = "b"
 	def addTo(self, datagram):
 		datagram.addInt8(clamp(int(self.data * (127.0 / 35.0)), -128, 127))
 	@staticmethod
 	def getFrom(iterator):
 		return float(iterator.getInt8()) * (35.0 / 127.0)
+	@staticmethod
+	def encode(data):
+		return (clamp(int(data * (127.0 / 35.0)), -128, 127),)
+	@staticmethod
+	def decode(values, index):
+		return float(values[index]) * (35.0 / 127.0)
 class Uint8(Object):
+	format = "B"
 	def addTo(self, datagram):
 		datagram.addUint8(self.data)
 	@staticmethod
 	def getFrom(iterator):
 		return iterator.getUint8()
 class Uint16(Object):
+	format = "H"
 	def addTo(self, datagram):
 		datagram.addUint16(self.data)
 	@staticmethod
 	def getFrom(iterator):
 		return iterator.getUint16()
+	@staticmethod
+	def encode(data):
+		return (int(data),)
 class Uint32(Object):
+	format = "I"
 	def addTo(self, datagram):
 		datagram.addUint32(self.data)
 	@staticmethod
 	def getFrom(iterator):
 		return iterator.getUint32()
 class Int16(Object):
+	format = "h"
 	def addTo(self, datagram):
 		datagram.addInt16(self.data)
 	@staticmethod
@@ -479,8 +769,125 @@ class String(Object):
 	def getFrom(iterator):
 		return iterator.getString()
 class Boolean(Object):
+	format = "B"
 	def addTo(self, datagram):
 		datagram.addBool(self.data)
 	@staticmethod
 	def getFrom(iterator):
-		return iterator.getBool()
\ No newline at end of file
+		return iterator.getBool()
+	@staticmethod
+	def encode(data):
+		return (1 if data else 0,)
+	@staticmethod
+	def decode(values, index):
+		return values[index] != 0
+
+class Schema:
+	"""A fixed packet layout, declared once as a list of Object types, for example [Uint8, net2.StandardVec3, Boolean].
+	The whole layout is compiled into a single struct.Struct, so packing it doesn't allocate a wrapper object per field.
+	The encoding is byte-for-byte the same as adding the individual objects to a Packet."""
+	def __init__(self, fields):
+		format = "<"
+		self.encoders = []
+		self.decoders = [] # (decode function, index of the field's first raw value)
+		index = 0
+		for field in fields:
+			if field.format == None:
+				raise TypeError(field.__name__ + " has no fixed-size format and can't be part of a Schema")
+			format += field.format
+			self.encoders.append(field.encode)
+			self.decoders.append((field.decode, index))
+			index += len(field.format)
+		self.struct = struct.Struct(format)
+		self.size = self.struct.size
+	def pack(self, *values):
+		raw = []
+		for encode, value in zip(self.encoders, values):
+			raw.extend(encode(value))
+		return self.struct.pack(*raw)
+	def unpack(self, message, offset = 0):
+		raw = self.struct.unpack_from(message, offset)
+		return [decode(raw, index) for decode, index in self.decoders]
+	def record(self, *values):
+		"Returns the values as a Record, which can be added to a Packet."
+		return Record(self, values)
+	def addTo(self, datagram, *values):
+		datagram.appendData(self.pack(*values))
+	def getFrom(self, iterator):
+		"Reads one instance of the layout. Returns a list of values, one per field."
+		return self.unpack(iterator.extractBytes(self.size))
+
+VARINT_CHUNK = 4 # Bits per varint chunk. Each chunk is followed by one bit that says whether another chunk follows.
+
+def bitsFor(count):
+	"Number of bits needed for an enumeration with the given number of values."
+	bits = 0
+	while (1 << bits) < count:
+		bits += 1
+	return bits
+
+class BitWriter(Object):
+	"""Packs booleans, small enumerations and variable-length integers into only the bits they need.
+	Adds to a Packet as a single field, padded to a whole byte. Read it back with a BitReader, in the same order."""
+	def __init__(self):
+		self.data = 0 # The first bit written is the lowest
+		self.bits = 0
+	def write(self, value, bits):
+		self.data |= (value & ((1 << bits) - 1)) << self.bits
+		self.bits += bits
+	def writeBool(self, value):
+		self.write(1 if value else 0, 1)
+	def writeVarint(self, value):
+		"Writes a non-negative integer of any size. Values below 16 take 5 bits, values below 256 take 10."
+		if value < 0:
+			raise ValueError("Varint can't hold the negative value " + str(value) + "; use writeSignedVarint")
+		while True:
+			chunk = value & ((1 << VARINT_CHUNK) - 1)
+			value >>= VARINT_CHUNK
+			self.write(chunk, VARINT_CHUNK)
+			self.writeBool(value > 0)
+			if value == 0:
+				break
+	def writeSignedVarint(self, value):
+		"Zigzag encoded, so small negative numbers stay small."
+		self.writeVarint(value << 1 if value >= 0 else ((-value) << 1) - 1)
+	def getBytes(self):
+		return "".join([chr((self.data >> i) & 0xff) for i in range(0, self.bits, 8)])
+	def addTo(self, datagram):
+		datagram.appendData(self.getBytes())
+
+class BitReader:
+	"Reads back the fields of a BitWriter, pulling bytes from the iterator as it needs them."
+	def __init__(self, iterator):
+		self.iterator = iterator
+		self.data = 0
+		self.bits = 0
+	def read(self, bits):
+		while self.bits < bits:
+			self.data |= self.iterator.getUint8() << self.bits
+			self.bits += 8
+		value = self.data & ((1 << bits) - 1)
+		self.data >>= bits
+		self.bits -= bits
+		return value
+	def readBool(self):
+		return self.read(1) != 0
+	def readVarint(self):
+		value = 0
+		shift = 0
+		while True:
+			value |= self.read(VARINT_CHUNK) << shift
+			shift += VARINT_CHUNK
+			if not self.readBool():
+				return value
+	def readSignedVarint(self):
+		value = self.readVarint()
+		return value >> 1 if value & 1 == 0 else -((value + 1) >> 1)
+
+class Record(Object):
+	"A set of values to be packed through a Schema. Counts as one field in a Packet."
+	def __init__(self, schema, values):
+		self.schema = schema
+		self.data = values
+	def addTo(self, datagram):
+		datagram.appendData(self.schema.pack(*self.data))
\ No newline at end of file
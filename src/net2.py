@@ -1,84 +1,128 @@
 import controllers
+import entities
 import net
 import engine
 from direct.showbase.DirectObject import DirectObject
-from random import random
+from random import random, randint
 from direct.distributed.PyDatagram import PyDatagram
 from direct.distributed.PyDatagramIterator import PyDatagramIterator
 from pandac.PandaModules import Vec3, Quat, Vec4
 from Queue import Queue # So we have the Empty exception
+import math
+import struct
 
-class HighResVec3(net.Object):
-	def addTo(self, datagram):
-		x = net.HighResFloat(self.data.getX())
-		y = net.HighResFloat(self.data.getY())
-		z = net.HighResFloat(self.data.getZ())
-		x.addTo(datagram)
-		y.addTo(datagram)
-		z.addTo(datagram)
+QUAT_COMPONENT_BITS = 10 # Bits per component of a SmallestThreeQuat
+QUAT_COMPONENT_RANGE = 1.0 / math.sqrt(2.0) # None of the three smallest components of a unit quaternion can be bigger than this
+worldMin = None # Lower corner of the volume BoundedVec3 quantizes positions in. None until a map is loaded.
+worldScale = None # Quantization steps per unit, for each axis
+
+def setWorldBounds(minimum, maximum):
+	"Sets the volume BoundedVec3 quantizes positions in. Server and clients must use the same bounds."
+	global worldMin, worldScale
+	worldMin = Vec3(minimum)
+	worldScale = [65535.0 / max(maximum[i] - minimum[i], 0.001) for i in range(3)]
+
+class HighResVec3(net.FixedSizeObject):
+	format = "fff"
 	@staticmethod
-	def getFrom(iterator):
-		return Vec3(net.HighResFloat.getFrom(iterator), net.HighResFloat.getFrom(iterator), net.HighResFloat.getFrom(iterator))
-class StandardVec3(net.Object):
-	def addTo(self, datagram):
-		x = net.StandardFloat(self.data.getX())
-		y = net.StandardFloat(self.data.getY())
-		z = net.StandardFloat(self.data.getZ())
-		x.addTo(datagram)
-		y.addTo(datagram)
-		z.addTo(datagram)	
+	def encode(data):
+		return (data.getX(), data.getY(), data.getZ())
 	@staticmethod
-	def getFrom(iterator):
-		return Vec3(net.StandardFloat.getFrom(iterator), net.StandardFloat.getFrom(iterator), net.StandardFloat.getFrom(iterator))
-class StandardQuat(net.Object):
-	def addTo(self, datagram):
-		x = net.StandardFloat(self.data.getX())
-		y = net.StandardFloat(self.data.getY())
-		z = net.StandardFloat(self.data.getZ())
-		w = net.StandardFloat(self.data.getW())
-		x.addTo(datagram)
-		y.addTo(datagram)
-		z.addTo(datagram)	
-		w.addTo(datagram)
+	def decode(values, index):
+		return Vec3(values[index], values[index + 1], values[index + 2])
+class StandardVec3(net.FixedSizeObject):
+	format = "hhh"
 	@staticmethod
-	def getFrom(iterator):
-		return Quat(net.StandardFloat.getFrom(iterator), net.StandardFloat.getFrom(iterator), net.StandardFloat.getFrom(iterator), net.StandardFloat.getFrom(iterator))
-class HighResVec4(net.Object):
-	def addTo(self, datagram):
-		x = net.HighResFloat(self.data.getX())
-		y = net.HighResFloat(self.data.getY())
-		z = net.HighResFloat(self.data.getZ())
-		w = net.HighResFloat(self.data.getW())
-		x.addTo(datagram)
-		y.addTo(datagram)
-		z.addTo(datagram)	
-		w.addTo(datagram)
+	def encode(data):
+		return (net.clamp(int(data.getX() * 110.0), -32768, 32767), net.clamp(int(data.getY() * 110.0), -32768, 32767), net.clamp(int(data.getZ() * 110.0), -32768, 32767))
 	@staticmethod
-	def getFrom(iterator):
-		return Vec4(net.HighResFloat.getFrom(iterator), net.HighResFloat.getFrom(iterator), net.HighResFloat.getFrom(iterator), net.HighResFloat.getFrom(iterator))
-class LowResVec3(net.Object):
-	def addTo(self, datagram):
-		x = net.LowResFloat(self.data.getX())
-		y = net.LowResFloat(self.data.getY())
-		z = net.LowResFloat(self.data.getZ())
-		x.addTo(datagram)
-		y.addTo(datagram)
-		z.addTo(datagram)
+	def decode(values, index):
+		return Vec3(float(values[index]) / 110.0, float(values[index + 1]) / 110.0, float(values[index + 2]) / 110.0)
+class StandardQuat(net.FixedSizeObject):
+	format = "hhhh"
 	@staticmethod
-	def getFrom(iterator):
-		return Vec3(net.LowResFloat.getFrom(iterator), net.LowResFloat.getFrom(iterator), net.LowResFloat.getFrom(iterator))
-class SmallVec3(net.Object):
-	def addTo(self, datagram):
-		x = net.SmallFloat(self.data.getX())
-		y = net.SmallFloat(self.data.getY())
-		z = net.SmallFloat(self.data.getZ())
-		x.addTo(datagram)
-		y.addTo(datagram)
-		z.addTo(datagram)
+	def encode(data):
+		return (net.clamp(int(data.getX() * 110.0), -32768, 32767), net.clamp(int(data.getY() * 110.0), -32768, 32767), net.clamp(int(data.getZ() * 110.0), -32768, 32767), net.clamp(int(data.getW() * 110.0), -32768, 32767))
+	@staticmethod
+	def decode(values, index):
+		return Quat(float(values[index]) / 110.0, float(values[index + 1]) / 110.0, float(values[index + 2]) / 110.0, float(values[index + 3]) / 110.0)
+class HighResVec4(net.FixedSizeObject):
+	format = "ffff"
+	@staticmethod
+	def encode(data):
+		return (data.getX(), data.getY(), data.getZ(), data.getW())
+	@staticmethod
+	def decode(values, index):
+		return Vec4(values[index], values[index + 1], values[index + 2], values[index + 3])
+class LowResVec3(net.FixedSizeObject):
+	format = "hhh"
+	@staticmethod
+	def encode(data):
+		return (net.clamp(int(data.getX() * 50.0), -32768, 32767), net.clamp(int(data.getY() * 50.0), -32768, 32767), net.clamp(int(data.getZ() * 50.0), -32768, 32767))
 	@staticmethod
-	def getFrom(iterator):
-		return Vec3(net.SmallFloat.getFrom(iterator), net.SmallFloat.getFrom(iterator), net.SmallFloat.getFrom(iterator))
-class EntitySnapshot(net.Object):
+	def decode(values, index):
+		return Vec3(float(values[index]) / 50.0, float(values[index + 1]) / 50.0, float(values[index + 2]) / 50.0)
+class SmallVec3(net.FixedSizeObject):
+	format = "bbb"
+	@staticmethod
+	def encode(data):
+		return (net.clamp(int(data.getX() * (127.0 / 35.0)), -128, 127), net.clamp(int(data.getY() * (127.0 / 35.0)), -128, 127), net.clamp(int(data.getZ() * (127.0 / 35.0)), -128, 127))
+	@staticmethod
+	def decode(values, index):
+		return Vec3(float(values[index]) * (35.0 / 127.0), float(values[index + 1]) * (35.0 / 127.0), float(values[index + 2]) * (35.0 / 127.0))
+class SmallestThreeQuat(net.FixedSizeObject):
+	"""A unit quaternion in 32 bits. The largest component is dropped, since it can be rebuilt from the other three.
+	Two bits say which one was dropped, and the other three get QUAT_COMPONENT_BITS each."""
+	format = "I"
+	@staticmethod
+	def encode(data):
+		components = [data.getX(), data.getY(), data.getZ(), data.getW()]
+		length = math.sqrt(sum([x * x for x in components]))
+		if length < 0.000001:
+			components = [1.0, 0.0, 0.0, 0.0]
+			length = 1.0
+		largest = max(range(4), key = lambda i: abs(components[i]))
+		# q and -q are the same rotation. Flip the sign so the dropped component is positive.
+		scale = (1.0 if components[largest] >= 0 else -1.0) / length
+		steps = (1 << QUAT_COMPONENT_BITS) - 1
+		value = largest
+		for i in (x for x in range(4) if x != largest):
+			quantized = int((components[i] * scale + QUAT_COMPONENT_RANGE) * (steps / (2.0 * QUAT_COMPONENT_RANGE)) + 0.5)
+			value = (value << QUAT_COMPONENT_BITS) | net.clamp(quantized, 0, steps)
+		return (value,)
+	@staticmethod
+	def decode(values, index):
+		value = values[index]
+		steps = (1 << QUAT_COMPONENT_BITS) - 1
+		smallest = []
+		for i in range(3):
+			smallest.insert(0, float(value & steps) * (2.0 * QUAT_COMPONENT_RANGE / steps) - QUAT_COMPONENT_RANGE)
+			value >>= QUAT_COMPONENT_BITS
+		largest = value
+		components = smallest[:largest] + [math.sqrt(max(0.0, 1.0 - sum([x * x for x in smallest])))] + smallest[largest:]
+		return Quat(components[0], components[1], components[2], components[3])
+class BoundedVec3(net.FixedSizeObject):
+	"""A position quantized to 16 bits per axis within the bounds given to setWorldBounds.
+	Check contains() first; positions outside the bounds are clamped to them."""
+	format = "HHH"
+	@staticmethod
+	def contains(data):
+		if worldMin == None:
+			return False
+		for i in range(3):
+			if not 0.0 <= (data[i] - worldMin[i]) * worldScale[i] <= 65535.0:
+				return False
+		return True
+	@staticmethod
+	def encode(data):
+		return tuple([net.clamp(int((data[i] - worldMin[i]) * worldScale[i] + 0.5), 0, 65535) for i in range(3)])
+	@staticmethod
+	def decode(values, index):
+		return Vec3(worldMin[0] + values[index] / worldScale[0], worldMin[1] + values[index + 1] / worldScale[1], worldMin[2] + values[index + 2] / worldScale[2])
+class EntitySnapshot(net.FixedSizeObject):
+	"""Position and orientation of an entity at a point in time.
+	Encoded as a BoundedVec3 and a SmallestThreeQuat. Use FullEntitySnapshot for entities outside the world bounds."""
+	format = BoundedVec3.format + SmallestThreeQuat.format
 	def __init__(self):
 		self.pos = Vec3()
 		self.quat = Quat()
@@ -92,20 +136,28 @@ class EntitySnapshot(net.Object):
 		self.empty = False
 
 	def addTo(self, datagram):
-		pos = HighResVec3(self.pos)
-		quat = StandardQuat(self.quat)
-		pos.addTo(datagram)
-		quat.addTo(datagram)
-		
+		datagram.appendData(self.getStruct().pack(*self.encode(self)))
+	
+	def isInBounds(self):
+		return BoundedVec3.contains(self.pos)
+	
 	@staticmethod
-	def getFrom(iterator):
+	def build(pos, quat):
 		es = EntitySnapshot()
-		es.pos = HighResVec3.getFrom(iterator)
-		es.quat = StandardQuat.getFrom(iterator)
+		es.pos = pos
+		es.quat = quat
 		es.time = engine.clock.time
 		es.empty = False
 		return es
 	
+	@staticmethod
+	def encode(snapshot):
+		return BoundedVec3.encode(snapshot.pos) + SmallestThreeQuat.encode(snapshot.quat)
+	
+	@staticmethod
+	def decode(values, index):
+		return EntitySnapshot.build(BoundedVec3.decode(values, index), SmallestThreeQuat.decode(values, index + 3))
+	
 	def commitTo(self, entity):
 		entity.setQuaternion(self.quat)
 		entity.setPosition(self.pos)
@@ -113,7 +165,10 @@ class EntitySnapshot(net.Object):
 	def lerp(self, snapshot, scale):
 		result = EntitySnapshot()
 		result.pos = self.pos + ((snapshot.pos - self.pos) * scale)
-		result.quat = self.quat + ((snapshot.quat - self.quat) * scale)
+		target = snapshot.quat
+		if self.quat.dot(target) < 0:
+			target = target * -1.0 # Same rotation, but on our side of the hypersphere, so the lerp doesn't pass through zero
+		result.quat = self.quat + ((target - self.quat) * scale)
 		result.empty = False
 		return result
 
@@ -126,6 +181,315 @@ class EntitySnapshot(net.Object):
 	def almostEquals(self, snapshot):
 		return self.quat.almostEqual(snapshot.quat, 2) and self.pos.almostEqual(snapshot.pos, 0.2)
 	
+class FullEntitySnapshot(EntitySnapshot):
+	"An EntitySnapshot with a full-precision position, for entities outside the world bounds."
+	format = HighResVec3.format + SmallestThreeQuat.format
+	@staticmethod
+	def encode(snapshot):
+		return HighResVec3.encode(snapshot.pos) + SmallestThreeQuat.encode(snapshot.quat)
+	@staticmethod
+	def decode(values, index):
+		return EntitySnapshot.build(HighResVec3.decode(values, index), SmallestThreeQuat.decode(values, index + 3))
+
+SNAPSHOT_HISTORY = 32 # Oldest snapshot (relative to the current one) we'll use as a delta baseline
+INTEREST_RADIUS = 80.0 # Entities within this distance of a client's player droid are updated every snapshot
+FAR_UPDATE_INTERVAL = 0.5 # Seconds between updates for entities outside a client's area of interest. Keep this under SNAPSHOT_HISTORY ticks so delta baselines stay valid.
+
+packetErrors = (AssertionError, struct.error) # Raised when a packet runs out of data. Panda's datagram iterator asserts; net.CustomDatagram raises struct.error.
+
+def splitFields(packet):
+	"Serializes the given packet and splits the resulting data into its individual fields."
+	data = PyDatagram()
+	offsets = []
+	packet.addFieldsTo(data, offsets)
+	message = data.getMessage()
+	fields = []
+	start = 0
+	for end in offsets:
+		fields.append(message[start:end])
+		start = end
+	return fields
+
+RELIABLE_WINDOW = 32 # Messages past the cumulative ack covered by the selective ack bitfield
+INITIAL_RETRANSMIT_TIMEOUT = 0.5 # Seconds, until we have a round trip time measurement
+MIN_RETRANSMIT_TIMEOUT = 0.1
+MAX_RETRANSMIT_TIMEOUT = 3.0
+reliableAckSize = 11 # Packet code, epoch, cumulative ack, bitfield
+reliableHeaderSize = 11 # Packet code, epoch, sequence, data length
+
+def stripChannelRecords(message):
+	"Returns the given client packet without the acks and reliable messages at its start. Those were meant for the server alone."
+	offset = 0
+	while offset < len(message):
+		code = ord(message[offset])
+		if code == net.PACKET_SNAPSHOTACK:
+			offset += 3
+		elif code == net.PACKET_RELIABLEACK:
+			offset += reliableAckSize
+		elif code == net.PACKET_RELIABLE:
+			offset += reliableHeaderSize + net.formatUint32.unpack_from(message, offset + 7)[0]
+		else:
+			break
+	return message[offset:]
+
+class ReliableChannel:
+	"""Reliable, ordered delivery of messages to and from one remote machine, riding on the unreliable packets sent every tick.
+	Each message gets a sequence number. The receiver piggybacks a cumulative ack, plus a bitfield of the messages it holds past that, on its own traffic.
+	Unacknowledged messages are resent once the retransmit timeout runs out. The timeout follows the measured round trip time."""
+	def __init__(self):
+		self.smoothedRtt = None
+		self.rttVariance = 0.0
+		self.retransmitTimeout = INITIAL_RETRANSMIT_TIMEOUT
+		self.remoteEpoch = None
+		self.retiredEpochs = [] # Epochs the other end has moved on from. Stragglers from these are ignored.
+		self.reset()
+	
+	def reset(self):
+		"""Starts a new run of sequence numbers in both directions. Nothing queued before the reset gets delivered.
+		The other end's current epoch is retired, so its delayed packets can't pass for the run it starts next."""
+		self.epoch = randint(1, 0xffffffff) # Identifies this run of sequence numbers, so the other end notices when we start over
+		self.nextSequence = 0
+		self.unacked = dict() # Sequence -> [data, time first sent, time last sent, resent]
+		if self.remoteEpoch != None:
+			self.retiredEpochs = ([self.remoteEpoch] + self.retiredEpochs)[:4]
+		self.remoteEpoch = None
+		self.nextExpected = 0 # Sequence number of the next message to deliver
+		self.received = dict() # Sequence -> data, for messages that arrived ahead of one we're missing
+		self.ackPending = False
+	
+	def send(self, data):
+		self.unacked[self.nextSequence] = [data, None, None, False]
+		self.nextSequence = (self.nextSequence + 1) % 65536
+	
+	def hasTraffic(self, time):
+		"Returns true if we owe the other end an ack, or have a message due to be sent."
+		return self.ackPending or len([x for x in self.unacked.values() if x[2] == None or time - x[2] >= self.retransmitTimeout]) > 0
+	
+	def buildPacket(self, time):
+		"Returns our ack, if one is due, and every message that hasn't been sent yet or has timed out."
+		p = net.Packet()
+		if self.ackPending and self.remoteEpoch != None:
+			mask = 0
+			for i in range(RELIABLE_WINDOW):
+				if (self.nextExpected + 1 + i) % 65536 in self.received:
+					mask |= 1 << i
+			p.add(net.Uint8(net.PACKET_RELIABLEACK))
+			p.add(net.Uint32(self.remoteEpoch))
+			p.add(net.Uint16((self.nextExpected - 1) % 65536))
+			p.add(net.Uint32(mask))
+		self.ackPending = False
+		resent = False
+		for sequence in sorted(self.unacked.keys(), key = lambda x: (x - self.nextSequence) % 65536): # Oldest first
+			message = self.unacked[sequence]
+			if message[2] != None and time - message[2] < self.retransmitTimeout:
+				continue
+			if message[1] == None:
+				message[1] = time
+			else:
+				message[3] = True
+				resent = True
+			message[2] = time
+			p.add(net.Uint8(net.PACKET_RELIABLE))
+			p.add(net.Uint32(self.epoch))
+			p.add(net.Uint16(sequence))
+			p.add(net.Uint32(len(message[0]))) # Uber spawn packets can run past a String's 16-bit length
+			p.add(RawData(message[0]))
+		if resent:
+			self.retransmitTimeout = min(self.retransmitTimeout * 2.0, MAX_RETRANSMIT_TIMEOUT) # Back off until an ack gets through
+		return p
+	
+	def acknowledge(self, epoch, cumulative, mask, time):
+		"Forgets every message the other end says it has. Messages sent only once give us a round trip time sample."
+		if epoch != self.epoch:
+			return # An ack for an older run of sequence numbers
+		for sequence in self.unacked.keys():
+			if (cumulative - sequence) % 65536 < 32768:
+				acked = True
+			else:
+				offset = (sequence - cumulative - 2) % 65536
+				acked = offset < RELIABLE_WINDOW and mask & (1 << offset) != 0
+			if acked:
+				message = self.unacked.pop(sequence)
+				if message[1] != None and not message[3]:
+					self.addRttSample(time - message[1])
+	
+	def addRttSample(self, rtt):
+		# Jacobson/Karels estimator, as in RFC 6298
+		if self.smoothedRtt == None:
+			self.smoothedRtt = rtt
+			self.rttVariance = rtt / 2.0
+		else:
+			self.rttVariance = 0.75 * self.rttVariance + 0.25 * abs(self.smoothedRtt - rtt)
+			self.smoothedRtt = 0.875 * self.smoothedRtt + 0.125 * rtt
+		self.retransmitTimeout = net.clamp(self.smoothedRtt + 4.0 * self.rttVariance, MIN_RETRANSMIT_TIMEOUT, MAX_RETRANSMIT_TIMEOUT)
+	
+	def receive(self, epoch, sequence, data):
+		"Returns the list of messages that are now ready to be processed, in order."
+		if epoch in self.retiredEpochs:
+			return []
+		if epoch != self.remoteEpoch:
+			# The other end started a new run of sequence numbers
+			if self.remoteEpoch != None:
+				self.retiredEpochs = ([self.remoteEpoch] + self.retiredEpochs)[:4]
+			self.remoteEpoch = epoch
+			self.nextExpected = 0
+			self.received.clear()
+		self.ackPending = True
+		if (sequence - self.nextExpected) % 65536 >= 32768:
+			return [] # Already delivered. Our ack must have been lost.
+		self.received[sequence] = data
+		ready = []
+		while self.nextExpected in self.received:
+			ready.append(self.received.pop(self.nextExpected))
+			self.nextExpected = (self.nextExpected + 1) % 65536
+		return ready
+
+def serialize(packet):
+	"Returns the encoded data of the given packet or object."
+	data = PyDatagram()
+	packet.addTo(data)
+	return data.getMessage()
+
+def isNewerSequence(a, b):
+	"Returns true if 16-bit snapshot sequence number a comes after b, taking wraparound into account."
+	return a != b and (a - b) % 65536 < 32768
+
+ENTITY_DIGEST_BUCKETS = 16 # Entity IDs are hashed into this many buckets, so a mismatch narrows down which IDs differ. At most 16, to fit the Uint16 bitfield.
+
+def getNetworkedEntityIds(entityGroup):
+	return [x.getId() for x in entityGroup.entities.values() if x.active and x.getId() < entities.LOCAL_ID_OFFSET]
+
+def buildEntityDigest(ids):
+	"""Returns a 16-bit hash of the IDs in each bucket. Each ID is mixed with a multiplicative hash, and the results are XOR'd together,
+	so the order doesn't matter and equal counts of different IDs still give different hashes."""
+	digest = [0] * ENTITY_DIGEST_BUCKETS
+	for id in ids:
+		digest[id % ENTITY_DIGEST_BUCKETS] ^= ((id + 1) * 2654435761 & 0xffffffff) >> 16
+	return digest
+
+class RawData(net.Object):
+	"Pre-serialized data, written to the datagram as-is."
+	def addTo(self, datagram):
+		datagram.appendData(self.data)
+
+class DeltaControllerPacket(net.Object):
+	"""A controller update, split into fields and encoded against a baseline that the receiver has acknowledged.
+	Only the fields that differ from the baseline are sent. Without a baseline, every field is sent."""
+	def __init__(self, id, fields, baseline = None, baselineSequence = 0):
+		self.id = id
+		self.fields = fields
+		self.baseline = baseline
+		self.baselineSequence = baselineSequence
+	
+	@staticmethod
+	def addField(datagram, field):
+		# Fields are almost always shorter than 255 bytes. Longer ones (strings, mostly) get an escaped length.
+		if len(field) < 255:
+			datagram.addUint8(len(field))
+		else:
+			datagram.addUint8(255)
+			datagram.addUint16(len(field))
+		datagram.appendData(field)
+	
+	@staticmethod
+	def getField(iterator):
+		length = iterator.getUint8()
+		if length == 255:
+			length = iterator.getUint16()
+		return iterator.extractBytes(length)
+
+	def addTo(self, datagram):
+		datagram.addUint8(net.PACKET_DELTACONTROLLER)
+		datagram.addUint16(self.id)
+		datagram.addUint16(len(self.fields))
+		datagram.addBool(self.baseline != None)
+		if self.baseline == None:
+			for field in self.fields:
+				DeltaControllerPacket.addField(datagram, field)
+			return
+		datagram.addUint16(self.baselineSequence)
+		baselineSize = len(self.baseline)
+		changed = [i >= baselineSize or self.fields[i] != self.baseline[i] for i in range(len(self.fields))]
+		for i in range(0, len(changed), 8):
+			mask = 0
+			for bit in range(min(8, len(changed) - i)):
+				if changed[i + bit]:
+					mask |= 1 << bit
+			datagram.addUint8(mask)
+		for i in range(len(self.fields)):
+			if changed[i]:
+				DeltaControllerPacket.addField(datagram, self.fields[i])
+	
+	@staticmethod
+	def getFrom(iterator, history):
+		"""Reads a delta controller packet. history maps entity IDs to lists of (sequence, fields) tuples.
+		Returns the entity ID and the reconstructed fields. The fields are None if the baseline is unavailable."""
+		id = net.Uint16.getFrom(iterator)
+		numFields = net.Uint16.getFrom(iterator)
+		baseline = None
+		if net.Boolean.getFrom(iterator):
+			baselineSequence = net.Uint16.getFrom(iterator)
+			mask = [net.Uint8.getFrom(iterator) for _ in range((numFields + 7) / 8)]
+			for entry in history.get(id, []):
+				if entry[0] == baselineSequence:
+					baseline = entry[1]
+					break
+			fields = []
+			for i in range(numFields):
+				if mask[i / 8] & (1 << (i % 8)):
+					fields.append(DeltaControllerPacket.getField(iterator))
+				elif baseline != None and i < len(baseline):
+					fields.append(baseline[i])
+				else:
+					baseline = None
+			if baseline == None:
+				return id, None
+		else:
+			fields = [DeltaControllerPacket.getField(iterator) for _ in range(numFields)]
+		return id, fields
+
+class SnapshotBaselines:
+	"""Server-side record of which controller fields a single client has acknowledged receiving.
+	Controller updates for that client are delta-compressed against these baselines."""
+	def __init__(self):
+		self.baselines = dict() # Entity ID -> (entity, snapshot sequence, fields)
+		self.pending = dict() # Snapshot sequence -> list of (entity, fields) sent in that snapshot
+		self.skipped = dict() # Entity ID -> entity, for entities with culled updates that the client hasn't been resynced on yet
+		self.resyncing = dict() # Entity ID -> skipped entity we've asked for a full update of
+	
+	def buildPacket(self, entity, fields, sequence):
+		id = entity.getId()
+		baseline = self.baselines.get(id)
+		# The entity comparison keeps us from using a baseline that belonged to a deleted entity with the same ID.
+		if baseline != None and baseline[0] == entity and sequence - baseline[1] <= SNAPSHOT_HISTORY:
+			p = DeltaControllerPacket(id, fields, baseline[2], baseline[1] % 65536)
+		else:
+			p = DeltaControllerPacket(id, fields)
+		if not sequence in self.pending:
+			self.pending[sequence] = []
+		self.pending[sequence].append((entity, fields))
+		return p
+	
+	def acknowledge(self, sequence):
+		"Promotes the fields sent in the given (16-bit) snapshot to baselines."
+		matches = [x for x in self.pending.keys() if x % 65536 == sequence]
+		if len(matches) == 0:
+			return
+		acked = max(matches)
+		for entity, fields in self.pending[acked]:
+			baseline = self.baselines.get(entity.getId())
+			if entity.active and (baseline == None or baseline[0] != entity or baseline[1] < acked):
+				self.baselines[entity.getId()] = (entity, acked, fields)
+		for x in [x for x in self.pending.keys() if x <= acked]:
+			del self.pending[x]
+		for id in [id for id, baseline in self.baselines.items() if not baseline[0].active]:
+			del self.baselines[id]
+	
+	def prune(self, sequence):
+		"Forgets sent snapshots too old to ever be used as a baseline."
+		for x in [x for x in self.pending.keys() if sequence - x > SNAPSHOT_HISTORY]:
+			del self.pending[x]
+
 class NetManager(DirectObject):
 	def __init__(self):
 		self.lastPacketUpdate = 0
@@ -138,8 +502,19 @@ class NetManager(DirectObject):
 		self.totalIncomingPacketSize = 0
 		self.outgoingPackets = 0
 		self.totalOutgoingPacketSize = 0
+		self.droppedPackets = 0
 		self.requestedEntitySpawns = dict()
 		self.lastCheckSumSent = 0
+		self.snapshotSequence = 0 # Server only - sequence number of the last snapshot we broadcast
+		self.clientBaselines = dict() # Server only - client address -> SnapshotBaselines
+		self.receivedFields = dict() # Client only - entity ID -> list of (snapshot sequence, fields), most recent first
+		self.lastReceivedSnapshot = None # Client only - the snapshot we need to acknowledge
+		self.snapshotAckPending = False
+		self.incomingSnapshot = None # Sequence number of the snapshot currently being processed
+		self.incomingSnapshotComplete = True
+		self.relayedPackets = [] # Server only - (data, sender address) received from clients, to be merged into the next snapshot
+		self.channels = dict() # Address -> ReliableChannel. Clients only have one, for the host.
+		self.relayedReliable = [] # Server only - (data, sender address) of reliable messages from clients, to be passed on to the other clients
 		self.accept("chat-outgoing", self.chatHandler)
 	
 	def spawnEntity(self, entity):
@@ -157,6 +532,41 @@ class NetManager(DirectObject):
 		p = entity.controller.buildDeletePacket(killed)
 		self.deletePackets.append(p)
 	
+	def getChannel(self, address):
+		if net.netMode == net.MODE_CLIENT:
+			address = None # Everything goes to and from the host
+		if not address in self.channels:
+			self.channels[address] = ReliableChannel()
+		return self.channels[address]
+	
+	def resetChannels(self):
+		"Starts every reliable channel over, so nothing queued for the old map gets delivered on the new one."
+		for channel in self.channels.values():
+			channel.reset()
+		del self.relayedReliable[:]
+	
+	def sendReliable(self, packet, address = None):
+		"""Queues the given packet on the reliable channel. It goes out with the next tick, and is resent until it's acknowledged.
+		On the server, no address means every ready client. On a client, it always goes to the host."""
+		data = serialize(packet)
+		if net.netMode == net.MODE_SERVER and address == None:
+			for client in (x for x in net.context.activeConnections.values() if x.ready):
+				self.getChannel(client.address).send(data)
+		else:
+			self.getChannel(address).send(data)
+	
+	def applyLocalUpdate(self, backend, entity, fields):
+		"""Applies a local entity's controller update straight to its controller.
+		The update is read back from the fields we already serialized for the network. There's no tick datagram to assemble, and no trip through processPacket's dispatch and entity lookup."""
+		iterator = net.CustomDatagram("".join(fields)) # Reads straight from the joined string, with no Panda datagram in between
+		try:
+			while iterator.getRemainingSize() > 0:
+				# Critical packets queued on earlier frames come first, each with its own header.
+				iterator.skipBytes(controllers.controllerHeader.size) # PACKET_CONTROLLER, entity ID
+				entity.controller.clientUpdate(backend.aiWorld, backend.entityGroup, iterator)
+		except packetErrors:
+			engine.log.warning("Local update iteration failed for entity " + str(entity.getId()) + ". Discarding update.")
+	
 	def processPacket(self, packet, backend, sender = None):
 		iterator = PyDatagramIterator(packet)
 		lastId = "None"
@@ -167,7 +577,7 @@ class NetManager(DirectObject):
 				type = net.Uint8.getFrom(iterator)
 				if type == net.PACKET_CONTROLLER:
 					rebroadcast = True
-					id = net.Uint8.getFrom(iterator)
+					id = net.Uint16.getFrom(iterator)
 					entity = backend.entityGroup.getEntity(id)
 					if entity != None:
 						lastId = str(id)
@@ -178,16 +588,60 @@ class NetManager(DirectObject):
 						if sender != None and ((not id in self.requestedEntitySpawns.keys()) or (engine.clock.time - self.requestedEntitySpawns[id] > 2.0)): # Only send a request once every two seconds
 							p = net.Packet()
 							p.add(net.Uint8(net.PACKET_REQUESTSPAWNPACKET))
-							p.add(net.Uint8(id))
+							p.add(net.Uint16(id))
 							net.context.send(p, sender)
 							self.requestedEntitySpawns[id] = engine.clock.time
 							engine.log.info("Sending request for missing entity spawn packet. Entity ID: " + str(id))
 						return rebroadcast
+				elif type == net.PACKET_DELTACONTROLLER:
+					id, fields = DeltaControllerPacket.getFrom(iterator, self.receivedFields)
+					if fields == None:
+						# We no longer have the baseline. Don't acknowledge this snapshot, so the server falls back to a full update.
+						self.incomingSnapshotComplete = False
+						engine.log.warning("Missing delta baseline for entity " + str(id) + ". Discarding update.")
+					else:
+						if self.incomingSnapshot != None:
+							history = self.receivedFields.get(id, [])
+							history.insert(0, (self.incomingSnapshot, fields))
+							self.receivedFields[id] = history[:SNAPSHOT_HISTORY + 8]
+						self.processPacket(PyDatagram("".join(fields)), backend, sender)
+					rebroadcast = False
+				elif type == net.PACKET_SNAPSHOT:
+					self.incomingSnapshot = net.Uint16.getFrom(iterator)
+					self.incomingSnapshotComplete = True
+					rebroadcast = False
+				elif type == net.PACKET_SNAPSHOTACK:
+					sequence = net.Uint16.getFrom(iterator)
+					if net.netMode == net.MODE_SERVER and sender in self.clientBaselines:
+						self.clientBaselines[sender].acknowledge(sequence)
+					rebroadcast = False
+				elif type == net.PACKET_RELAYED:
+					# Each relayed client packet is processed on its own, so an update for an entity we don't have
+					# only cuts that client's packet short, rather than the rest of the snapshot.
+					length = net.Uint32.getFrom(iterator)
+					self.processPacket(PyDatagram(iterator.extractBytes(length)), backend, sender)
+					rebroadcast = False
+				elif type == net.PACKET_RELIABLE:
+					epoch = net.Uint32.getFrom(iterator)
+					sequence = net.Uint16.getFrom(iterator)
+					data = iterator.extractBytes(net.Uint32.getFrom(iterator))
+					for message in self.getChannel(sender).receive(epoch, sequence, data):
+						if self.processPacket(PyDatagram(message), backend, sender) and net.netMode == net.MODE_SERVER:
+							self.relayedReliable.append((message, sender))
+					rebroadcast = False
+				elif type == net.PACKET_RELIABLEACK:
+					epoch = net.Uint32.getFrom(iterator)
+					cumulative = net.Uint16.getFrom(iterator)
+					mask = net.Uint32.getFrom(iterator)
+					self.getChannel(sender).acknowledge(epoch, cumulative, mask, net.timeFunction())
+					rebroadcast = False
 				elif type == net.PACKET_SPAWN:
 					controllerType = net.Uint8.getFrom(iterator)
 					entity = controllers.types[controllerType].readSpawnPacket(backend.aiWorld, backend.entityGroup, iterator)
 					if entity.getId() in self.requestedEntitySpawns.keys():
 						del self.requestedEntitySpawns[entity.getId()]
+					if entity.getId() in self.receivedFields:
+						del self.receivedFields[entity.getId()] # Baselines from an old entity with this ID are useless now
 					if entity != None and backend.entityGroup.getEntity(entity.getId()) == None:
 						backend.entityGroup.addEntity(entity)
 					elif entity != None:
@@ -195,7 +649,7 @@ class NetManager(DirectObject):
 						entity.delete(backend.entityGroup, killed = False, localDelete = False)
 					rebroadcast = True
 				elif type == net.PACKET_DELETE:
-					id = net.Uint8.getFrom(iterator)
+					id = net.Uint16.getFrom(iterator)
 					entity = backend.entityGroup.getEntity(id)
 					killed = net.Boolean.getFrom(iterator)
 					if entity != None:
@@ -205,7 +659,7 @@ class NetManager(DirectObject):
 							entity.delete(backend.entityGroup, False, False)
 					rebroadcast = True
 				elif type == net.PACKET_REQUESTSPAWNPACKET:
-					self.clientSpawnPacketRequests.append((net.Uint8.getFrom(iterator), sender))
+					self.clientSpawnPacketRequests.append((net.Uint16.getFrom(iterator), sender))
 					rebroadcast = False
 				elif type == net.PACKET_SETUP:
 					if net.netMode == net.MODE_CLIENT:
@@ -244,50 +698,60 @@ class NetManager(DirectObject):
 					# This packet has already been handled by the NetContext.
 					rebroadcast = False
 				elif type == net.PACKET_ENTITYCHECKSUM:
-					checksum = net.Uint8.getFrom(iterator) # Number of active entities we're supposed to have
-					if net.netMode == net.MODE_CLIENT and checksum != len([x for x in backend.entityGroup.entities.values() if x.active and x.getId() < 256]):
-						# We don't have the right number of entities
-						p = net.Packet()
-						p.add(net.Uint8(net.PACKET_REQUESTENTITYLIST))
-						net.context.send(p, sender)
-						engine.log.info("Entity checksum failed. Requesting full entity list.")
+					digest = [net.Uint16.getFrom(iterator) for _ in range(ENTITY_DIGEST_BUCKETS)]
+					if net.netMode == net.MODE_CLIENT:
+						localDigest = buildEntityDigest(getNetworkedEntityIds(backend.entityGroup))
+						buckets = 0
+						for i in range(ENTITY_DIGEST_BUCKETS):
+							if digest[i] != localDigest[i]:
+								buckets |= 1 << i
+						if buckets != 0:
+							# Our entities don't match the server's
+							p = net.Packet()
+							p.add(net.Uint8(net.PACKET_REQUESTENTITYLIST))
+							p.add(net.Uint16(buckets))
+							net.context.send(p, sender)
+							engine.log.info("Entity checksum failed for " + str(len([i for i in range(ENTITY_DIGEST_BUCKETS) if buckets & (1 << i)])) + " buckets. Requesting entity list.")
 					rebroadcast = False
 				elif type == net.PACKET_REQUESTENTITYLIST:
+					buckets = net.Uint16.getFrom(iterator)
 					p = net.Packet()
 					p.add(net.Uint8(net.PACKET_ENTITYLIST))
-					entityList = [x for x in backend.entityGroup.entities.values() if x.active and x.getId() < 256]
-					p.add(net.Uint8(len(entityList)))
-					for entity in entityList:
-						p.add(net.Uint8(entity.getId()))
+					p.add(net.Uint16(buckets))
+					entityList = [x for x in getNetworkedEntityIds(backend.entityGroup) if buckets & (1 << (x % ENTITY_DIGEST_BUCKETS))]
+					p.add(net.Uint16(len(entityList)))
+					for id in entityList:
+						p.add(net.Uint16(id))
 					net.context.send(p, sender)
 					engine.log.info("Sending entity list to " + net.addressToString(sender))
 					rebroadcast = False
 				elif type == net.PACKET_ENTITYLIST:
-					total = net.Uint8.getFrom(iterator)
-					entities = []
+					buckets = net.Uint16.getFrom(iterator)
+					total = net.Uint16.getFrom(iterator)
+					entityIds = []
 					missingEntities = []
 					for _ in range(total):
-						id = net.Uint8.getFrom(iterator)
+						id = net.Uint16.getFrom(iterator)
 						if id not in backend.entityGroup.entities.keys():
 							missingEntities.append(id)
-						entities.append(id)
-					# Delete any extra entities, assuming they aren't ones that we just spawned on our end.
-					for entity in (x for x in backend.entityGroup.entities.values() if x.active and x.getId() < 256):
-						if entity.getId() not in entities and engine.clock.time - entity.spawnTime > 5.0:
+						entityIds.append(id)
+					# Delete any extra entities in the listed buckets, assuming they aren't ones that we just spawned on our end.
+					for entity in (x for x in backend.entityGroup.entities.values() if x.active and x.getId() < entities.LOCAL_ID_OFFSET and buckets & (1 << (x.getId() % ENTITY_DIGEST_BUCKETS))):
+						if entity.getId() not in entityIds and engine.clock.time - entity.spawnTime > 5.0:
 							entity.delete(backend.entityGroup, False, False)
 					if len(missingEntities) > 0:
 						# Request spawn packets for any missing entities
 						p = net.Packet()
 						for id in missingEntities:
 							p.add(net.Uint8(net.PACKET_REQUESTSPAWNPACKET))
-							p.add(net.Uint8(id))
+							p.add(net.Uint16(id))
 							self.requestedEntitySpawns[id] = engine.clock.time
 							engine.log.info("Sending request for missing entity spawn packet. Entity ID: " + str(id))
 						net.context.send(p, sender)
 					rebroadcast = False
 				else:
 					rebroadcast = False
-		except AssertionError:
+		except packetErrors:
 			engine.log.warning("Packet iteration failed. Discarding packet.")
 			rebroadcast = False
 		return rebroadcast
@@ -308,23 +772,28 @@ class NetManager(DirectObject):
 			del self.spawnPackets[:]
 		
 		entityList = backend.entityGroup.entities.values()
+		localEntities = [x for x in entityList if x.active and x.isLocal]
+		for entity in localEntities:
+			entity.controller.queueRayTests(backend.aiWorld)
+		backend.aiWorld.flushRays() # Wall clipping checks, all in one traversal
 		updatedEntities = []
-		controllerPacket = net.Packet()
-		for entity in (x for x in entityList if x.active and x.isLocal):
+		controllerUpdates = [] # List of (entity, packet)
+		for entity in (x for x in localEntities if x.active):
 			# Do a server update for local entities.
 			# The controller packet is only sent if we've exceeded the regular packet update interval.
 			p = entity.controller.serverUpdate(backend.aiWorld, backend.entityGroup, packetUpdate)
 			if p != None and entity.controller.needsToSendUpdate():
-				controllerPacket.add(p)
+				controllerUpdates.append((entity, p))
 				updatedEntities.append(entity)
+		backend.aiWorld.flushRays() # Bullets and visibility checks. Fills in the shot data in the packets above.
+		controllerUpdates = [(x[0], splitFields(x[1])) for x in controllerUpdates] # List of (entity, fields)
 
 		# Make sure we update our own copy of the entities.
 		sendController = False
-		if len(controllerPacket.dataObjects) > 0:
+		if len(controllerUpdates) > 0:
 			sendController = True
-			data = PyDatagram()
-			controllerPacket.addTo(data)
-			self.processPacket(data, backend)
+			for update in controllerUpdates:
+				self.applyLocalUpdate(backend, update[0], update[1])
 		
 		deletePacket = net.Packet()
 		sendDelete = False
@@ -335,46 +804,86 @@ class NetManager(DirectObject):
 			del self.deletePackets[:]
 		
 		if packetUpdate:
-			outboundPacket = net.Packet()
-			outboundPacket.add(spawnPacket)
-			outboundPacket.add(controllerPacket)
-			outboundPacket.add(deletePacket)
+			now = net.timeFunction()
+			reliablePacket = net.Packet() # Spawns, deletes and chat, delivered in order
+			reliablePacket.add(spawnPacket)
+			reliablePacket.add(deletePacket)
 			for chat in self.chatPackets:
-				outboundPacket.add(chat)
-			sendChat = len(self.chatPackets) > 0
+				reliablePacket.add(chat)
+			sendReliable = sendSpawn or sendDelete or len(self.chatPackets) > 0
 			del self.chatPackets[:]
 			for request in self.clientSpawnPacketRequests:
 				entity = backend.entityGroup.getEntity(request[0])
 				if entity != None:
 					if net.netMode == net.MODE_CLIENT:
-						outboundPacket.add(entity.controller.buildSpawnPacket())
+						reliablePacket.add(entity.controller.buildSpawnPacket())
+						sendReliable = True
 					else:
 						temp = net.Packet()
 						temp.add(entity.controller.buildSpawnPacket())
-						net.context.send(temp, request[1])
+						self.sendReliable(temp, request[1])
 					engine.log.info("Sending missed spawn packet (ID " + str(request[0]) + ") to client " + net.addressToString(request[1]))
 				else:
 					engine.log.warning("Client requested spawn packet for non-existent entity.")
 			del self.clientSpawnPacketRequests[:]
+			if sendReliable:
+				self.sendReliable(reliablePacket)
+			outboundPacket = net.Packet() # Everything after the controller updates
 			sendCheckSum = False
 			if net.netMode == net.MODE_SERVER and engine.clock.time - self.lastCheckSumSent > 5.0:
 				self.lastCheckSumSent = engine.clock.time
 				checkSumPacket = net.Packet()
 				checkSumPacket.add(net.Uint8(net.PACKET_ENTITYCHECKSUM))
-				checkSumPacket.add(net.Uint8(len([x for x in entityList if x.active and x.getId() < 256])))
+				for bucketHash in buildEntityDigest(getNetworkedEntityIds(backend.entityGroup)):
+					checkSumPacket.add(net.Uint16(bucketHash))
 				outboundPacket.add(checkSumPacket)
 				sendCheckSum = True
-			if sendSpawn or sendController or sendDelete or sendCheckSum or sendChat:
-				net.context.broadcast(outboundPacket)
+			if net.netMode == net.MODE_SERVER:
+				for address in [x for x in self.channels.keys() if not x in net.context.activeConnections]:
+					del self.channels[address]
+				for client in (x for x in net.context.activeConnections.values() if x.ready):
+					# Pass on reliable messages from the other clients
+					for data, sender in self.relayedReliable:
+						if not net.compareAddresses(sender, client.address):
+							self.getChannel(client.address).send(data)
+				del self.relayedReliable[:]
+				sendReliable = len([x for x in self.channels.values() if x.hasTraffic(now)]) > 0
+				if sendController or sendCheckSum or sendReliable or len(self.relayedPackets) > 0:
+					self.broadcastSnapshot(backend, controllerUpdates, outboundPacket, now)
+				del self.relayedPackets[:]
+			else:
+				clientPacket = net.Packet()
+				sendAck = self.snapshotAckPending
+				if sendAck:
+					# The ack goes first, so it doesn't keep the server from relaying the rest of this packet.
+					clientPacket.add(net.Uint8(net.PACKET_SNAPSHOTACK))
+					clientPacket.add(net.Uint16(self.lastReceivedSnapshot))
+					self.snapshotAckPending = False
+				channel = self.getChannel(None)
+				sendReliable = channel.hasTraffic(now)
+				if sendReliable:
+					clientPacket.add(channel.buildPacket(now))
+				for update in controllerUpdates:
+					clientPacket.add(RawData("".join(update[1])))
+				clientPacket.add(outboundPacket)
+				if sendController or sendReliable or sendAck:
+					net.context.broadcast(clientPacket)
 
 		packets = net.context.readTick()
 		for packet in packets:
 			data = PyDatagram(packet[0])
 			rebroadcast = self.processPacket(data, backend, packet[1])
+			if self.incomingSnapshot != None:
+				if self.incomingSnapshotComplete and (self.lastReceivedSnapshot == None or isNewerSequence(self.incomingSnapshot, self.lastReceivedSnapshot)):
+					self.lastReceivedSnapshot = self.incomingSnapshot
+					self.snapshotAckPending = True
+				self.incomingSnapshot = None
 			self.incomingPackets += 1
 			self.totalIncomingPacketSize += len(packet[0])
 			if net.netMode == net.MODE_SERVER and rebroadcast:
-				net.context.broadcastDatagramExcept(data, packet[1])
+				message = stripChannelRecords(packet[0]) # The acks and reliable messages were for us. Reliable messages get passed on separately.
+				if len(message) > 0:
+					self.relayedPackets.append((message, packet[1]))
 		del packets
 
 		if len(entityList) > len(updatedEntities):
@@ -387,7 +896,95 @@ class NetManager(DirectObject):
 		for client in (x for x in net.context.activeConnections.values() + clientAddress if net.timeFunction() - x.lastSentPacketTime > 0.5 and x.ready):
 			net.context.send(emptyPacket, client.address)
 		
-		net.context.writeTick()
-			
+		sentPackets, sentBytes, droppedPackets = net.context.writeTick()
+		self.outgoingPackets += sentPackets
+		self.totalOutgoingPacketSize += sentBytes
+		self.droppedPackets += droppedPackets
+	
+	def getStats(self):
+		"""Returns a summary of the packets sent and received since the last call, then resets the counters.
+		Incoming sizes are after decompression; outgoing sizes are what went out on the wire."""
+		elapsed = max(engine.clock.time - self.lastStatsLog, 0.001)
+		stats = "received %d packets (%.1f/s, %.1f KB/s), sent %d packets (%.1f/s, %.1f KB/s), dropped %d packets" \
+			% (self.incomingPackets, self.incomingPackets / elapsed, self.totalIncomingPacketSize / elapsed / 1024.0, \
+			self.outgoingPackets, self.outgoingPackets / elapsed, self.totalOutgoingPacketSize / elapsed / 1024.0, self.droppedPackets)
+		self.lastStatsLog = engine.clock.time
+		self.incomingPackets = 0
+		self.totalIncomingPacketSize = 0
+		self.outgoingPackets = 0
+		self.totalOutgoingPacketSize = 0
+		self.droppedPackets = 0
+		return stats
+	
+	def isInAreaOfInterest(self, entity, team):
+		"Returns true if the given entity matters enough to the client controlling the given team to be updated every snapshot."
+		if team == None or not isinstance(entity, entities.ObjectEntity):
+			return True
+		if isinstance(entity, entities.Actor) and entity.getTeam() != None and team.isAlly(entity.getTeam()):
+			return True
+		player = team.getPlayer()
+		if player == None or not player.active:
+			return True # Spectating; the camera can go anywhere
+		return (entity.getPosition() - player.getPosition()).length() < INTEREST_RADIUS + entity.radius
+	
+	def isRelevant(self, entity, team):
+		"""Returns true if the given entity's controller update should go to the client controlling the given team.
+		Entities outside the client's area of interest are only updated every FAR_UPDATE_INTERVAL seconds."""
+		if entity.controller.criticalUpdate or self.isInAreaOfInterest(entity, team):
+			return True
+		# Stagger far updates by entity ID so they don't all land on the same snapshot
+		farInterval = max(1, int(FAR_UPDATE_INTERVAL / net.SERVER_TICK))
+		return (self.snapshotSequence + entity.getId()) % farInterval == 0
+	
+	def resyncSkippedEntities(self, baselines, team, updatedEntities):
+		"""Asks for a full update of each entity the client missed updates for, once the entity comes to rest or enters the client's area of interest.
+		At rest, an entity stops sending updates, so without this the client would keep it wherever the last far update left it."""
+		for id, entity in baselines.skipped.items():
+			if not entity.active:
+				del baselines.skipped[id]
+				if id in baselines.resyncing:
+					del baselines.resyncing[id]
+			elif not entity in updatedEntities or self.isInAreaOfInterest(entity, team):
+				entity.controller.requestFullUpdate()
+				baselines.resyncing[id] = entity
+	
+	def broadcastSnapshot(self, backend, controllerUpdates, outboundPacket, time):
+		"""Sends a snapshot to each ready client. Controller updates are delta-compressed
+		against the last snapshot each client acknowledged, and culled to the client's area of interest,
+		so every client gets its own packet. Culled entities get a full update once they stop or come close.
+		Packets relayed from other clients are merged in, each with its own length, so each client gets one datagram per tick.
+		Reliable messages and acks go right after the header, so spawns are processed before the updates that need them.
+		Everything that's the same for every client is serialized once, up front."""
+		self.snapshotSequence += 1
+		outboundData = RawData(serialize(outboundPacket))
+		relayed = [(chr(net.PACKET_RELAYED) + net.formatUint32.pack(len(data)) + data, sender) for data, sender in self.relayedPackets]
+		updatedEntities = set([x[0] for x in controllerUpdates])
+		for address in [x for x in self.clientBaselines.keys() if not x in net.context.activeConnections or not net.context.activeConnections[x].ready]:
+			del self.clientBaselines[address]
+		for client in (x for x in net.context.activeConnections.values() if x.ready):
+			if not client.address in self.clientBaselines:
+				self.clientBaselines[client.address] = SnapshotBaselines()
+			baselines = self.clientBaselines[client.address]
+			baselines.prune(self.snapshotSequence)
+			team = backend.getClientTeam(client.address)
+			p = net.Packet()
+			p.add(net.Uint8(net.PACKET_SNAPSHOT))
+			p.add(net.Uint16(self.snapshotSequence % 65536))
+			p.add(self.getChannel(client.address).buildPacket(time))
+			for entity, fields in controllerUpdates:
+				id = entity.getId()
+				if baselines.resyncing.get(id) == entity: # The full update we asked for
+					del baselines.resyncing[id]
+					del baselines.skipped[id]
+					p.add(baselines.buildPacket(entity, fields, self.snapshotSequence))
+				elif self.isRelevant(entity, team):
+					p.add(baselines.buildPacket(entity, fields, self.snapshotSequence))
+				else:
+					baselines.skipped[id] = entity
+			self.resyncSkippedEntities(baselines, team, updatedEntities)
+			p.add(outboundData)
+			p.add(RawData("".join([x[0] for x in relayed if not net.compareAddresses(x[1], client.address)])))
+			net.context.send(p, client.address)
+	
 	def delete(self):
 		self.ignoreAll()
@@ -0,0 +1,56 @@
+import sys
+import time
+
+SAMPLE_COUNT = 1000 # Number of samples kept per stage
+LOG_INTERVAL = 30.0 # Seconds between profiler log lines in daemon mode
+
+if sys.platform == "win32":
+	timer = time.clock
+else:
+	timer = time.time
+
+stages = [] # In the order they were first recorded
+stageMap = dict() # Name -> Stage
+
+class Stage:
+	"""Timing samples for one stage of the frame, kept in a fixed-size ring buffer."""
+	def __init__(self, name):
+		self.name = name
+		self.samples = [0.0] * SAMPLE_COUNT
+		self.index = 0
+		self.count = 0
+
+	def add(self, duration):
+		self.samples[self.index] = duration
+		self.index = (self.index + 1) % SAMPLE_COUNT
+		self.count = min(self.count + 1, SAMPLE_COUNT)
+
+	def getPercentiles(self):
+		"Returns the 50th, 95th and 99th percentile and the maximum of the buffered samples, in seconds."
+		if self.count == 0:
+			return (0.0, 0.0, 0.0, 0.0)
+		samples = sorted(self.samples[:self.count])
+		def percentile(p):
+			return samples[min(self.count - 1, int(self.count * p))]
+		return (percentile(0.5), percentile(0.95), percentile(0.99), samples[-1])
+
+def record(name, start):
+	"Records the time elapsed since start (a value returned by timer()) as a sample for the given stage."
+	duration = timer() - start
+	if not name in stageMap:
+		stage = Stage(name)
+		stages.append(stage)
+		stageMap[name] = stage
+	stageMap[name].add(duration)
+
+def getStats():
+	"Returns a list of (stage name, p50, p95, p99, max) tuples, in seconds."
+	return [(stage.name,) + stage.getPercentiles() for stage in stages]
+
+def report():
+	"Returns a one-line summary of all stages, in milliseconds."
+	return " | ".join(["%s p50 %.2f p95 %.2f p99 %.2f max %.2f" % (x[0], x[1] * 1000.0, x[2] * 1000.0, x[3] * 1000.0, x[4] * 1000.0) for x in getStats()]) + " (ms)"
+
+def reset():
+	del stages[:]
+	stageMap.clear()